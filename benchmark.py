@@ -0,0 +1,675 @@
+"""
+Benchmarks for the hot paths of GOOPy on synthetic data.
+
+The generators below write synthetic GEOS-Chem SpeciesConc and
+LevelEdgeDiags files (on the GEOS-Chem Classic and GCHP cubed-sphere 
+grids) and synthetic satellite files in the formats read by parsers.py 
+(generic, TROPOMI, OCO, and TCCON). The benchmarks then record
+the wall time and peak memory of the interpolation, colocation, averaging
+kernel, and parser functions, and of an end-to-end run of main.py.
+
+Usage:
+    python benchmark.py --n_obs 100000 --n_levels 47 --n_tracers 1 \\
+        --n_days 2 --output results.json
+    python benchmark.py --compare results.json
+
+With --compare, benchmarks that are more than --tolerance slower than the
+saved results are reported and the script exits with an error.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+from interpolation import VerticalGrid
+import kernels
+import utilities as util
+import parsers
+import operators
+
+
+## ---------------------------------------------------------------------------
+## Synthetic data
+## ---------------------------------------------------------------------------
+
+def get_dates(n_days, start="2020-01-01"):
+    return [str(d.date()) for d in pd.date_range(start, periods=n_days)]
+
+
+def make_geoschem_files(directory, dates, n_levels=47, n_tracers=1,
+                        resolution=(4, 5), time_step="1h", seed=0):
+    """
+    Writes one daily SpeciesConc and LevelEdgeDiags file per date to
+    directory on a global GEOS-Chem grid with half-polar boxes. The
+    SpeciesConc files have n_tracers variables named SpeciesConcVV_CH4_NNNN.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    dlat, dlon = resolution
+    lat = np.concatenate([[-90 + dlat/4],
+                          np.arange(-90 + dlat, 90 - dlat/2, dlat),
+                          [90 - dlat/4]])
+    lon = np.arange(-180, 180, dlon, dtype=float)
+    sigma = np.linspace(1, 0.0001, n_levels + 1).astype("float32")
+    for date in dates:
+        times = (pd.date_range(date, periods=pd.Timedelta("1D")
+                               // pd.Timedelta(time_step), freq=time_step)
+                 + pd.Timedelta(time_step) / 2)
+        shape = (len(times), n_levels, len(lat), len(lon))
+        coords = {"time" : times, "lev" : np.arange(n_levels) + 0.5,
+                  "ilev" : np.arange(n_levels + 1), "lat" : lat, "lon" : lon}
+
+        surface_pressure = rng.uniform(
+            950, 1013, (len(times), len(lat), len(lon))).astype("float32")
+        edges = xr.Dataset(
+            {"Met_PEDGE" : (("time", "ilev", "lat", "lon"),
+                            surface_pressure[:, None]
+                            * sigma[None, :, None, None])},
+            coords=coords)
+        edges.to_netcdf(f"{directory}/GEOSChem.LevelEdgeDiags."
+                        f"{date.replace('-', '')}_0000z.nc4")
+
+        conc = xr.Dataset(coords=coords)
+        for i in range(n_tracers):
+            conc[f"SpeciesConcVV_CH4_{i:04d}"] = (
+                ("time", "lev", "lat", "lon"),
+                rng.uniform(1.7e-6, 1.9e-6, shape).astype("float32"))
+        conc.to_netcdf(f"{directory}/GEOSChem.SpeciesConc."
+                       f"{date.replace('-', '')}_0000z.nc4")
+
+
+def get_cubed_sphere_grid(cube_size):
+    """
+    Gets the cell center latitudes and longitudes (6 x cube_size x 
+    cube_size, longitudes in [0, 360) as in GCHP output) of a gnomonic 
+    equiangular cubed-sphere grid.
+    """
+    a = np.tan(np.linspace(-np.pi/4, np.pi/4, 2*cube_size + 1)[1::2])
+    y, x = np.meshgrid(a, a, indexing="ij")
+    one = np.ones_like(x)
+    xyz = np.stack([np.stack(face) for face in 
+                    [(one, x, y), (-x, one, y), (-one, -x, y), (x, -one, y),
+                     (-y, x, one), (y, x, -one)]])
+    xyz /= np.linalg.norm(xyz, axis=1, keepdims=True)
+    lats = np.degrees(np.arcsin(xyz[:, 2]))
+    lons = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+    return lats, lons
+
+
+def make_GCHP_files(directory, dates, n_levels=47, n_tracers=1, 
+                    cube_size=24, time_step="1h", seed=0):
+    """
+    Writes one daily SpeciesConc and LevelEdgeDiags file per date to 
+    directory on a cubed-sphere grid, in the layout of native GCHP output
+    (nf x Ydim x Xdim, with 3D lats and lons).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    lats, lons = get_cubed_sphere_grid(cube_size)
+    sigma = np.linspace(1, 0.0001, n_levels + 1).astype("float32")
+    grid_dims = ("nf", "Ydim", "Xdim")
+    for date in dates:
+        times = (pd.date_range(date, periods=pd.Timedelta("1D")
+                               // pd.Timedelta(time_step), freq=time_step)
+                 + pd.Timedelta(time_step) / 2)
+        shape = (len(times), n_levels) + lats.shape
+        coords = {"time" : times, "lev" : np.arange(n_levels) + 0.5,
+                  "ilev" : np.arange(n_levels + 1), 
+                  "nf" : np.arange(1, 7.), 
+                  "Ydim" : np.arange(1, cube_size + 1.),
+                  "Xdim" : np.arange(1, cube_size + 1.),
+                  "lats" : (grid_dims, lats), "lons" : (grid_dims, lons)}
+
+        surface_pressure = rng.uniform(
+            950, 1013, (len(times),) + lats.shape).astype("float32")
+        edges = xr.Dataset(
+            {"Met_PEDGE" : (("time", "ilev") + grid_dims,
+                            surface_pressure[:, None]
+                            * sigma[None, :, None, None, None])},
+            coords=coords)
+        edges.to_netcdf(f"{directory}/GCHP.LevelEdgeDiags."
+                        f"{date.replace('-', '')}_0000z.nc4")
+
+        conc = xr.Dataset(coords=coords)
+        for i in range(n_tracers):
+            conc[f"SpeciesConcVV_CH4_{i:04d}"] = (
+                ("time", "lev") + grid_dims,
+                rng.uniform(1.7e-6, 1.9e-6, shape).astype("float32"))
+        conc.to_netcdf(f"{directory}/GCHP.SpeciesConc."
+                       f"{date.replace('-', '')}_0000z.nc4")
+
+
+def make_observations(n_obs, n_levels, dates, seed=0):
+    """
+    Gets random satellite observations within the dates with n_levels
+    pressure edges (decreasing from the surface).
+    """
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(dates[0], "ns")
+    seconds = rng.uniform(0, len(dates) * 86400, n_obs)
+    surface_pressure = rng.uniform(900, 1020, n_obs)
+    return {
+        "time" : np.sort(start + (seconds * 1e9).astype("timedelta64[ns]")),
+        "latitude" : rng.uniform(-90, 90, n_obs),
+        "longitude" : rng.uniform(-180, 180, n_obs),
+        "surface_pressure" : surface_pressure,
+        "pressure_edges" : (surface_pressure[:, None]
+                            * np.linspace(1, 0.005, n_levels)),
+        "pressure_weight" : rng.dirichlet(np.ones(n_levels), n_obs),
+        "averaging_kernel" : rng.uniform(0.5, 1.2, (n_obs, n_levels)),
+        "prior_profile" : rng.uniform(1.7e-6, 1.9e-6, (n_obs, n_levels)),
+        "column" : rng.uniform(1.7e-6, 1.9e-6, n_obs),
+        "quality_flag" : rng.integers(0, 2, n_obs),
+    }
+
+
+def make_generic_file(file_path, observations):
+    """
+    Writes a satellite file for read_satellite_file with the GOSATv9_0
+    DATA_FIELDS in config.yaml.
+    """
+    obs = observations
+    xr.Dataset({
+        "time" : ("n", obs["time"]),
+        "latitude" : ("n", obs["latitude"]),
+        "longitude" : ("n", obs["longitude"]),
+        "pressure_levels" : (("n", "m"), obs["pressure_edges"]),
+        "pressure_weight" : (("n", "m"), obs["pressure_weight"]),
+        "xch4_averaging_kernel" : (("n", "m"), obs["averaging_kernel"]),
+        "ch4_profile_apriori" : (("n", "m"), obs["prior_profile"]),
+        "xch4" : ("n", obs["column"]),
+        "xch4_quality_flag" : ("n", obs["quality_flag"]),
+    }).to_netcdf(file_path)
+
+
+def make_OCO_file(file_path, observations):
+    """
+    Writes a satellite file for read_OCO2_v11_1_preprocessed (in ppm).
+    """
+    obs = observations
+    xr.Dataset({
+        "time" : ("sounding_id", obs["time"]),
+        "latitude" : ("sounding_id", obs["latitude"]),
+        "longitude" : ("sounding_id", obs["longitude"]),
+        "pressure_levels" : (("sounding_id", "levels"),
+                             obs["pressure_edges"]),
+        "pressure_weight" : (("sounding_id", "levels"),
+                             obs["pressure_weight"]),
+        "xco2_averaging_kernel" : (("sounding_id", "levels"),
+                                   obs["averaging_kernel"]),
+        "co2_profile_apriori" : (("sounding_id", "levels"),
+                                 obs["prior_profile"] * 2e8),
+        "xco2_x2019" : ("sounding_id", obs["column"] * 2e8),
+    }).to_netcdf(file_path)
+
+
+def make_TROPOMI_file(file_path, n_obs, n_layers, dates, n_pixels=215,
+                      valid_fraction=0.2, seed=0):
+    """
+    Writes a TROPOMI L2 methane file for read_TROPOMI with about n_obs
+    valid pixels (valid_fraction of the swath) in the PRODUCT,
+    DETAILED_RESULTS, INPUT_DATA, and GEOLOCATIONS groups. The pixels are 
+    about 0.1 x 0.1 degrees.
+    """
+    rng = np.random.default_rng(seed)
+    n_scanlines = max(int(n_obs / (n_pixels * valid_fraction)), 1)
+    shape = (1, n_scanlines, n_pixels)
+    d3 = ("time", "scanline", "ground_pixel")
+    d4 = d3 + ("layer",)
+    coords = {"time" : [0], "scanline" : np.arange(n_scanlines),
+              "ground_pixel" : np.arange(n_pixels),
+              "layer" : np.arange(n_layers)}
+
+    # The scanlines are evenly spaced over the dates
+    start = pd.Timestamp(dates[0])
+    step = len(dates) * pd.Timedelta("1D") / n_scanlines
+    time_utc = np.array([(start + i * step).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                         for i in range(n_scanlines)], dtype=object)
+    column = rng.uniform(1800, 1900, shape).astype("float32")
+    column[rng.random(shape) > valid_fraction] = np.nan
+    latitude = rng.uniform(-89, 89, shape)
+    longitude = rng.uniform(-180, 180, shape)
+
+    xr.Dataset(
+        {"methane_mixing_ratio_bias_corrected" : (d3, column),
+         "qa_value" : (d3, rng.uniform(0, 1, shape).astype("float32")),
+         "time_utc" : (("time", "scanline"), time_utc[None])},
+        coords={**{k : coords[k] for k in d3},
+                "latitude" : (d3, latitude.astype("float32")),
+                "longitude" : (d3, longitude.astype("float32"))}
+    ).to_netcdf(file_path, group="PRODUCT", mode="w")
+
+    # The corners go around the pixel center, wrapping around +/-180
+    corner_lat = np.array([-0.05, -0.05, 0.05, 0.05])
+    corner_lon = np.array([-0.05, 0.05, 0.05, -0.05])
+    xr.Dataset(
+        {"latitude_bounds" : (d3 + ("corner",), 
+                              (latitude[..., None] + corner_lat)
+                              .astype("float32")),
+         "longitude_bounds" : (d3 + ("corner",), 
+                               ((longitude[..., None] + corner_lon + 180) 
+                                % 360 - 180).astype("float32"))},
+        coords={**coords, "corner" : np.arange(4)}
+    ).to_netcdf(file_path, group="PRODUCT/SUPPORT_DATA/GEOLOCATIONS",
+                mode="a")
+
+    random = lambda low, high, dims : (
+        dims, rng.uniform(low, high, shape + (n_layers,)*(len(dims) - 3))
+        .astype("float32"))
+    xr.Dataset(
+        {"surface_albedo_SWIR" : random(0, 1, d3),
+         "surface_albedo_NIR" : random(0, 1, d3),
+         "column_averaging_kernel" : random(0.5, 1.5, d4)},
+        coords=coords
+    ).to_netcdf(file_path, group="PRODUCT/SUPPORT_DATA/DETAILED_RESULTS",
+                mode="a")
+    xr.Dataset(
+        {"surface_altitude" : random(0, 1000, d3),
+         "surface_pressure" : random(9e4, 1.02e5, d3),
+         "pressure_interval" : random(7000, 8500, d3),
+         "methane_profile_apriori" : random(1, 2, d4),
+         "dry_air_subcolumns" : random(1000, 1100, d4),
+         "surface_classification" : (d3, rng.integers(0, 5, shape)
+                                     .astype("uint8"))},
+        coords=coords
+    ).to_netcdf(file_path, group="PRODUCT/SUPPORT_DATA/INPUT_DATA",
+                mode="a")
+
+
+def make_TCCON_file(file_path, observations):
+    """
+    Writes a TCCON MIP site file for read_TCCON_MIP (CO2 group, in Pa and
+    ppm) with the averaging kernel on a fixed pressure grid.
+    """
+    obs = observations
+    n_obs, n_levels = obs["pressure_edges"].shape
+    time = pd.DatetimeIndex(obs["time"])
+    dims = ("n_obs_instr", "n_lev")
+    xr.Dataset({
+        "cdate" : (("n_obs_instr", "idate"),
+                   np.column_stack([time.year, time.month, time.day,
+                                    time.hour, time.minute, time.second])),
+        "latitude" : ("n_obs_instr", obs["latitude"]),
+        "longitude" : ("n_obs_instr", obs["longitude"]),
+        "avg_kernel" : (dims, obs["averaging_kernel"]),
+        "prior_mixing" : (dims, obs["prior_profile"] * 2e8),
+        "p_levels_prior" : (dims, np.tile(np.linspace(1040e2, 5, n_levels),
+                                          (n_obs, 1))),
+        "p_levels_ak" : ("n_lev", np.linspace(1030e2, 10, n_levels)),
+        "p_surf" : ("n_obs_instr", obs["surface_pressure"] * 100),
+        "column_mixing" : ("n_obs_instr", obs["column"] * 2e8),
+        "sigma_column_mixing" : ("n_obs_instr", np.full(n_obs, 0.5)),
+        "prior_h2o" : (dims, np.zeros((n_obs, n_levels))),
+        "sza" : ("n_obs_instr", np.zeros(n_obs)),
+        "prior_mixing_tccon" : (dims, np.zeros((n_obs, n_levels))),
+        "public" : ("n_obs_instr", np.ones(n_obs)),
+        "solar_time_bin" : ("n_obs_instr", np.zeros(n_obs)),
+    }).to_netcdf(file_path, group="CO2")
+
+
+def make_config(directory, **local_settings):
+    """
+    Gets a config for an end-to-end run on the generic satellite files in
+    <directory>/obs and the GEOS-Chem files in <directory>/gc.
+    local_settings are added to LOCAL_SETTINGS.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "config.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["LOCAL_SETTINGS"].update({
+        "REPROCESS" : "True",
+        "SAVE_SATELLITE_DATA" : "True",
+        "SAVE_INTERPOLATION" : "False",
+        "SATELLITE_NAME" : "GOSATv9_0",
+        "OBS_DIR" : f"{directory}/obs",
+        "OBS_FILE_FORMAT" : "generic_*.nc",
+        "MODEL_LEVEL_EDGE_DIR" : f"{directory}/gc",
+        "MODEL_CONCENTRATION_DIR" : f"{directory}/gc",
+        "SAVE_DIR" : f"{directory}/out",
+        "N_THREADS" : 1})
+    config["LOCAL_SETTINGS"].update(local_settings)
+    config["GOSATv9_0"]["PARSER"] = "read_satellite_file"
+    return config
+
+
+## ---------------------------------------------------------------------------
+## Benchmarks
+## ---------------------------------------------------------------------------
+
+def measure(func, *args, repeat=3, **kwargs):
+    """
+    Gets the best wall time of repeat calls of func and the peak memory
+    allocated by one call (measured separately with tracemalloc, which
+    slows the call down).
+    """
+    times = []
+    with contextlib.redirect_stdout(None):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func(*args, **kwargs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"time" : min(times), "peak_memory" : peak_memory}
+
+
+def measure_main(config, directory):
+    """
+    Gets the wall time and peak RSS of an end-to-end run of main.py with
+    config in a separate process.
+    """
+    config_file = f"{directory}/config.yaml"
+    with open(config_file, "w") as f:
+        yaml.safe_dump(config, f)
+    shutil.rmtree(config["LOCAL_SETTINGS"]["SAVE_DIR"], ignore_errors=True)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "main.py", config_file], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kB on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {"time" : elapsed, "peak_memory" : peak_memory}
+
+
+def get_precision_error(model, satellite, precision):
+    """
+    Gets the largest relative difference between the model columns computed
+    with PRECISION precision and with float64, along with the reduced 
+    precision model and satellite data.
+    """
+    dtype, _ = util.PRECISIONS[precision]
+    conc_vars = operators.get_conc_vars(model)
+    with contextlib.redirect_stdout(None):
+        reference = operators.ObservationOperator.build(
+            model, satellite, "edges").apply_to_model(model, conc_vars)
+        model = model.assign({v : model[v].astype(dtype) 
+                              for v in model.data_vars 
+                              if model[v].dtype.kind == "f"})
+        satellite = parsers.set_precision(satellite, dtype)
+        operator = operators.ObservationOperator.build(
+            model, satellite, "edges", precision=precision)
+    model_columns = operator.apply_to_model(model, conc_vars)
+    error = float(np.nanmax(np.abs(model_columns - reference) 
+                            / np.abs(reference)))
+    return error, model, satellite
+
+
+def run_benchmarks(args, directory):
+    """
+    Generates the synthetic data in directory and runs the benchmarks.
+    Returns a dictionary of {name : {"time", "peak_memory"}}.
+    """
+    dates = get_dates(args.n_days)
+    print(f"Generating synthetic data in {directory}")
+    make_geoschem_files(f"{directory}/gc", dates, args.n_levels,
+                        args.n_tracers, tuple(args.resolution))
+    make_GCHP_files(f"{directory}/gchp", dates[:1], args.n_levels,
+                    args.n_tracers, args.cube_size)
+    observations = make_observations(args.n_obs, args.n_satellite_levels,
+                                     dates)
+    os.makedirs(f"{directory}/obs", exist_ok=True)
+    make_generic_file(f"{directory}/obs/generic_0.nc", observations)
+    make_OCO_file(f"{directory}/obs/oco_0.nc", observations)
+    make_TCCON_file(f"{directory}/obs/tccon_0.nc", observations)
+    make_TROPOMI_file(f"{directory}/obs/tropomi_0.nc", args.n_obs,
+                      args.n_satellite_levels - 1, dates)
+
+    with open(os.path.join(os.path.dirname(__file__), "config.yaml")) as f:
+        fields = yaml.safe_load(f)
+
+    results = {}
+    def run(name, func, *func_args, **kwargs):
+        results[name] = measure(func, *func_args, repeat=args.repeat,
+                                **kwargs)
+        print(f"  {name:<40s} {results[name]['time']:9.3f} s "
+              f"{results[name]['peak_memory'] / 1e6:10.1f} MB")
+
+    print(f"Benchmarks (n_obs = {args.n_obs}, n_levels = {args.n_levels}, "
+          f"n_tracers = {args.n_tracers}, n_days = {args.n_days})")
+
+    # Parsers
+    run("read_satellite_file", lambda : parsers.read_satellite_file(
+        f"{directory}/obs/generic_0.nc",
+        fields["GOSATv9_0"]["DATA_FIELDS"]).load())
+    run("read_OCO2_v11_1_preprocessed", 
+        lambda : parsers.read_OCO2_v11_1_preprocessed(
+            f"{directory}/obs/oco_0.nc",
+            fields["OCO2_v11.1_preprocessed"]["DATA_FIELDS"]).load())
+    run("read_TCCON_MIP", parsers.read_TCCON_MIP,
+        f"{directory}/obs/tccon_0.nc", fields["TCCON_MIP"]["DATA_FIELDS"])
+    run("read_TROPOMI", parsers.read_TROPOMI,
+        f"{directory}/obs/tropomi_0.nc", fields["TROPOMI"]["DATA_FIELDS"])
+
+    # Model read for the first date
+    model_files = [np.array([f"{directory}/gc/GEOSChem.{kind}."
+                             f"{dates[0].replace('-', '')}_0000z.nc4"])
+                   for kind in ["SpeciesConc", "LevelEdgeDiags"]]
+    run("read_geoschem_file", parsers.read_geoschem_file, *model_files,
+        fields["MODEL"]["DATA_FIELDS"])
+
+    # Model file catalog, and the lookup of the files for the observations
+    edge_files = [f"{directory}/gc/GEOSChem.LevelEdgeDiags."
+                  f"{date.replace('-', '')}_0000z.nc4" for date in dates]
+    run("get_model_catalog", util.get_model_catalog, edge_files, {},
+        fields["MODEL"]["DATA_FIELDS"]["TIME"])
+    catalog = util.get_model_catalog(edge_files, {},
+                                     fields["MODEL"]["DATA_FIELDS"]["TIME"])
+    run("ModelCatalog.get_files", catalog.get_files, observations["time"])
+
+    # Colocation with the observations on the first date
+    with contextlib.redirect_stdout(None):
+        satellite = parsers.check_satellite_data(parsers.read_satellite_file(
+            f"{directory}/obs/generic_0.nc",
+            fields["GOSATv9_0"]["DATA_FIELDS"]).load())
+    satellite = satellite.isel(N_OBS=np.where(
+        satellite["TIME"].values < np.datetime64(dates[0])
+        + np.timedelta64(1, "D"))[0])
+    model = parsers.read_geoschem_file(*model_files,
+                                       fields["MODEL"]["DATA_FIELDS"])
+    run("get_closest_index", util.get_closest_index,
+        model["LONGITUDE"].values, satellite["LONGITUDE"].values)
+    run("get_grid_index", util.get_grid_index,
+        model["LONGITUDE"].values, satellite["LONGITUDE"].values,
+        periodic=True)
+    run("colocate_obs", util.colocate_obs, model, satellite)
+
+    # Vertical interpolation
+    with contextlib.redirect_stdout(None):
+        colocated = util.colocate_obs(model, satellite)
+    model_edges = colocated["PRESSURE_EDGES"].values
+    satellite_edges = satellite["PRESSURE_EDGES"].values
+    conc_vars = operators.get_conc_vars(model)
+    model_conc = np.stack([colocated[v].values for v in conc_vars], axis=-1)
+    n_dense = min(len(satellite_edges), args.n_dense)
+    run(f"get_interpolation_map (dense, {n_dense} obs)",
+        VerticalGrid.get_interpolation_map,
+        model_edges[:n_dense], satellite_edges[:n_dense])
+    run("get_sparse_interpolation_map",
+        VerticalGrid.get_sparse_interpolation_map,
+        model_edges, satellite_edges)
+    vertical_grid = VerticalGrid(model_conc, model_edges, satellite_edges,
+                                 "edges", "False", None)
+    run("VerticalGrid.interpolate", vertical_grid.interpolate)
+
+    # Interpolation and averaging kernel, applied to the colocated model
+    # profiles
+    run("ObservationOperator.build", operators.ObservationOperator.build,
+        model, satellite, "edges")
+    with contextlib.redirect_stdout(None):
+        operator = operators.ObservationOperator.build(model, satellite, 
+                                                       "edges")
+    run("ObservationOperator.apply", operator.apply, model_conc)
+    run("ObservationOperator.apply_to_model", operator.apply_to_model,
+        model, conc_vars)
+
+    # Reduced precision. The relative error with respect to float64 is 
+    # checked against the documented bound.
+    for precision in ["float32", "mixed"]:
+        error, model_p, satellite_p = get_precision_error(model, satellite,
+                                                          precision)
+        run(f"ObservationOperator.build ({precision})", 
+            operators.ObservationOperator.build, model_p, satellite_p, 
+            "edges", precision=precision)
+        with contextlib.redirect_stdout(None):
+            operator_p = operators.ObservationOperator.build(
+                model_p, satellite_p, "edges", precision=precision)
+        name = f"apply_to_model ({precision})"
+        run(name, operator_p.apply_to_model, model_p, conc_vars)
+        results[name]["relative_error"] = error
+        bound = util.PRECISION_TOLERANCE[precision]
+        print(f"    relative error {error:.1e} (bound {bound:.0e})"
+              f"{'' if error <= bound else '  <-- exceeds bound'}")
+
+    # Footprint sampling, with footprints the size of the model grid cells
+    # so that most observations overlap four cells
+    steps = [np.median(np.diff(model[v].values)) 
+             for v in ["LATITUDE", "LONGITUDE"]]
+    satellite_footprint = satellite.assign(
+        LATITUDE_BOUNDS=(("N_OBS", "N_CORNERS"), np.clip(
+            satellite["LATITUDE"].values[:, None] 
+            + steps[0] * np.array([-0.5, -0.5, 0.5, 0.5]), -90, 90)),
+        LONGITUDE_BOUNDS=(("N_OBS", "N_CORNERS"), 
+            satellite["LONGITUDE"].values[:, None] 
+            + steps[1] * np.array([-0.5, 0.5, 0.5, -0.5])))
+    run("get_footprint_weights", util.get_footprint_weights,
+        model["LATITUDE"].values, model["LONGITUDE"].values,
+        satellite_footprint["LATITUDE_BOUNDS"].values,
+        satellite_footprint["LONGITUDE_BOUNDS"].values)
+    run("ObservationOperator.build (footprint)", 
+        operators.ObservationOperator.build, model, satellite_footprint, 
+        "edges", footprint=True)
+    with contextlib.redirect_stdout(None):
+        operator_footprint = operators.ObservationOperator.build(
+            model, satellite_footprint, "edges", footprint=True)
+    run("apply_to_model (footprint)", operator_footprint.apply_to_model,
+        model, conc_vars)
+
+    # Colocation on the cubed-sphere grid
+    gchp_files = [np.array([f"{directory}/gchp/GCHP.{kind}."
+                            f"{dates[0].replace('-', '')}_0000z.nc4"])
+                  for kind in ["SpeciesConc", "LevelEdgeDiags"]]
+    gchp_fields = dict(fields["MODEL"]["DATA_FIELDS"], LATITUDE="lats", 
+                       LONGITUDE="lons")
+    run("read_geoschem_file (cubed sphere)", parsers.read_geoschem_file, 
+        *gchp_files, gchp_fields)
+    gchp = parsers.read_geoschem_file(*gchp_files, gchp_fields)
+    run(f"SpatialIndex (C{args.cube_size})", util.SpatialIndex,
+        gchp["LATITUDE"].values, gchp["LONGITUDE"].values)
+    index = util.SpatialIndex(gchp["LATITUDE"].values, 
+                              gchp["LONGITUDE"].values)
+    run("SpatialIndex.query", index.query, satellite["LATITUDE"].values,
+        satellite["LONGITUDE"].values)
+    run("colocate_obs (cubed sphere)", util.colocate_obs, gchp, satellite)
+
+    # Compiled kernels (only if numba is installed). The first call compiles
+    # them, so it is not timed.
+    if kernels.numba is not None:
+        vertical_grid.backend = "numba"
+        vertical_grid.interpolate()
+        with contextlib.redirect_stdout(None):
+            operators.ObservationOperator.build(model, satellite, "edges",
+                                                backend="numba")
+        run("VerticalGrid.interpolate (numba)", vertical_grid.interpolate)
+        run("ObservationOperator.build (numba)", 
+            operators.ObservationOperator.build, model, satellite, "edges",
+            backend="numba")
+
+    # End to end
+    name = "apply_operator (main.py)"
+    results[name] = measure_main(make_config(directory), directory)
+    print(f"  {name:<40s} {results[name]['time']:9.3f} s "
+          f"{results[name]['peak_memory'] / 1e6:10.1f} MB (peak RSS)")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the benchmarks that are more than tolerance (fractional) slower
+    than the baseline. Returns the names of the regressions.
+    """
+    regressions = []
+    print(f"Comparison with the baseline (tolerance = {tolerance:.0%})")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["time"] / max(baseline[name]["time"], 1e-9)
+        memory_ratio = (result["peak_memory"]
+                        / max(baseline[name]["peak_memory"], 1))
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  <-- slower"
+            regressions.append(name)
+        print(f"  {name:<40s} {ratio:6.2f}x time {memory_ratio:6.2f}x "
+              f"memory{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n_obs", type=int, default=100000,
+                        help="number of satellite observations per file")
+    parser.add_argument("--n_satellite_levels", type=int, default=20,
+                        help="number of satellite pressure edges")
+    parser.add_argument("--n_levels", type=int, default=47,
+                        help="number of model levels")
+    parser.add_argument("--n_tracers", type=int, default=1,
+                        help="number of model tracers")
+    parser.add_argument("--n_days", type=int, default=2,
+                        help="number of days of model and satellite data")
+    parser.add_argument("--resolution", type=float, nargs=2, default=[4, 5],
+                        help="model grid resolution (lat lon)")
+    parser.add_argument("--cube_size", type=int, default=24,
+                        help="cells along each cube face edge for the "
+                             "cubed-sphere (GCHP) benchmarks, e.g. 24 for "
+                             "C24")
+    parser.add_argument("--n_dense", type=int, default=10000,
+                        help="number of observations for the dense "
+                             "interpolation map, which needs much more memory")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed repeats (the best is kept)")
+    parser.add_argument("--directory", default=None,
+                        help="directory for the synthetic data (default: a "
+                             "temporary directory that is removed)")
+    parser.add_argument("--output", default=None,
+                        help="save the results to this json file")
+    parser.add_argument("--compare", default=None,
+                        help="json file with results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional slowdown reported as a regression")
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix="goopy_benchmark_")
+    try:
+        results = run_benchmarks(args, directory)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"settings" : vars(args), "results" : results}, f,
+                      indent=1)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+        if len(compare(results, baseline, args.tolerance)) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
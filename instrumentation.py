@@ -0,0 +1,164 @@
+"""
+Per-stage timing and memory instrumentation. Each stage of a run (e.g.,
+satellite parse, model read, colocation) is wrapped in stage(), which
+records its wall time, the resident memory (RSS) and peak RSS of the
+process, the bytes read, and the number of observations, along with the
+satellite file and chunk it belongs to. At the end of a run, write_report
+saves the records and a summary with the throughput (obs/s) to json and
+csv.
+"""
+import contextlib
+import csv
+import json
+import os
+import resource
+import time
+
+# The records of the current process and the file and chunk being processed
+_records = []
+_context = {"file" : None, "chunk" : None}
+
+# The stage whose observations count towards the throughput
+THROUGHPUT_STAGE = "operator_apply"
+
+
+def get_rss():
+    """
+    Gets the current resident memory of the process in bytes (Linux only,
+    None elsewhere).
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss():
+    """
+    Gets the peak resident memory of the process in bytes.
+    """
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def set_context(**context):
+    """
+    Sets the satellite file and/or chunk that the following stages belong
+    to, e.g., set_context(file="sat.nc", chunk=None).
+    """
+    _context.update(context)
+
+
+@contextlib.contextmanager
+def stage(name, n_obs=None):
+    """
+    Records the wall time and memory of the code in the with block. The
+    record is yielded so that the caller can add the bytes read or the
+    number of observations once they are known:
+
+        with instrumentation.stage("model_read") as record:
+            model = read(...)
+            record["bytes_read"] = model.nbytes
+    """
+    record = {"stage" : name, **_context, "n_obs" : n_obs,
+              "bytes_read" : None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["time"] = time.perf_counter() - start
+        record["rss"] = get_rss()
+        record["peak_rss"] = get_peak_rss()
+        _records.append(record)
+
+
+def get_records(clear=False):
+    """
+    Gets the records of this process (e.g., to send them from a worker
+    process to the main process).
+    """
+    records = list(_records)
+    if clear:
+        _records.clear()
+    return records
+
+
+def add_records(records):
+    """
+    Adds records from another process.
+    """
+    _records.extend(records)
+
+
+def get_summary(records, total_time):
+    """
+    Sums the records by stage and by satellite file. The throughput is the
+    number of observations that the operator was applied to per second.
+    """
+    def total(records, key):
+        return sum(r[key] for r in records if r[key] is not None)
+
+    by_stage = {}
+    for name in dict.fromkeys(r["stage"] for r in records):
+        stage_records = [r for r in records if r["stage"] == name]
+        by_stage[name] = {
+            "time" : total(stage_records, "time"),
+            "count" : len(stage_records),
+            "bytes_read" : total(stage_records, "bytes_read"),
+            "max_peak_rss" : max(r["peak_rss"] for r in stage_records)}
+
+    by_file = {}
+    for name in dict.fromkeys(r["file"] for r in records
+                              if r["file"] is not None):
+        file_records = [r for r in records if r["file"] == name]
+        n_obs = total([r for r in file_records
+                       if r["stage"] == THROUGHPUT_STAGE], "n_obs")
+        file_time = total(file_records, "time")
+        by_file[name] = {
+            "time" : file_time,
+            "n_obs" : n_obs,
+            "n_chunks" : len({r["chunk"] for r in file_records
+                              if r["chunk"] is not None}),
+            "bytes_read" : total(file_records, "bytes_read"),
+            "max_peak_rss" : max(r["peak_rss"] for r in file_records),
+            "obs_per_second" : n_obs / file_time if file_time > 0 else None}
+
+    n_obs = total([r for r in records if r["stage"] == THROUGHPUT_STAGE],
+                  "n_obs")
+    return {"total_time" : total_time,
+            "n_obs" : n_obs,
+            "obs_per_second" : n_obs / total_time if total_time > 0 else None,
+            "stages" : by_stage,
+            "files" : by_file}
+
+
+def print_summary(summary):
+    print(f"Processed {summary['n_obs']} observations in "
+          f"{summary['total_time']:.1f} s "
+          f"({summary['obs_per_second'] or 0:.0f} obs/s).")
+    for name, s in summary["stages"].items():
+        print(f"  {name:<20s} {s['time']:10.2f} s "
+              f"({s['time'] / max(summary['total_time'], 1e-9):6.1%})")
+
+
+def write_report(report_path, total_time):
+    """
+    Writes the records to <report_path>.csv and the records and summary to
+    <report_path>.json. Returns the summary.
+    """
+    summary = get_summary(_records, total_time)
+    report_dir = os.path.dirname(report_path)
+    if report_dir != "" and not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+
+    with open(f"{report_path}.json", "w") as f:
+        json.dump({"summary" : summary, "records" : _records}, f, indent=1)
+
+    fields = ["file", "chunk", "stage", "time", "n_obs", "bytes_read",
+              "rss", "peak_rss"]
+    with open(f"{report_path}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(_records)
+    return summary
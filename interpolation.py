@@ -1,4 +1,17 @@
+import os
 import numpy as np
+import kernels
+
+def get_sparse_map_dtype(weight_dtype=np.float64):
+    """
+    Structured dtype used to store the sparse interpolation map. Each entry 
+    is one segment of overlap between a model layer and a satellite layer.
+    """
+    return np.dtype([("model_index", np.int32),
+                     ("satellite_index", np.int32),
+                     ("weight", weight_dtype)])
+
+SPARSE_MAP_DTYPE = get_sparse_map_dtype()
 
 class VerticalGrid:
     """
@@ -7,10 +20,21 @@ class VerticalGrid:
 
     model_conc_at_layers: nobs x n_model_edges-1,
                           units: concentration-type (ppb, vmr, etc.)
+                          May be None if only the interpolation 
+                          components are needed.
     satellite_edges:      nobs x n_satellite_edges
                        units: pressure
     model_edges:       nobs x n_model_edges
                        units: pressure
+    backend:           'numpy' or 'numba' (see kernels.py). With 'numba',
+                       interpolate() uses the compiled kernel and does not 
+                       build the interpolation map.
+    dtype:             Optional dtype of the interpolation map and the 
+                       output (e.g., np.float32). By default, this follows
+                       the inputs.
+    accumulate_dtype:  Optional dtype used to sum the segments in each 
+                       satellite layer (e.g., np.float64 with float32 
+                       inputs).
     """
 
     def __init__(
@@ -21,7 +45,10 @@ class VerticalGrid:
         interpolate_to_centers_or_edges,
         save_interpolation,
         save_dir,
-        expand_model_edges=True
+        expand_model_edges=True,
+        backend="numpy",
+        dtype=None,
+        accumulate_dtype=None
     ):
         self.model_conc_at_layers = model_conc_at_layers
         self.model_edges = model_edges
@@ -30,6 +57,9 @@ class VerticalGrid:
         self.save_interpolation = save_interpolation
         self.save_dir = save_dir
         self.expand_model_edges = expand_model_edges 
+        self.backend = backend
+        self.dtype = dtype
+        self.accumulate_dtype = accumulate_dtype
         # NOTE: This should always be True. We set it as a variable because
         # we use this class to do some additional interpolation for the TCCON
         # parser, and it requires some flexibility in this assumption
@@ -37,7 +67,7 @@ class VerticalGrid:
         self.__expand_profile_dims()
         self.__check_input_structure()
 
-        self.n_obs = self.model_conc_at_layers.shape[0]
+        self.n_obs = self.model_edges.shape[0]
         self.n_satellite_edges = self.satellite_edges.shape[1]
         self.n_model_edges = self.model_edges.shape[1]
 
@@ -46,7 +76,8 @@ class VerticalGrid:
         If profiles have only one observation,
         expand to a 2D array with dims (n_obs x n_model_edges) where n_obs=1.
         """
-        if self.model_conc_at_layers.ndim == 1:
+        if (self.model_conc_at_layers is not None 
+            and self.model_conc_at_layers.ndim == 1):
             self.model_conc_at_layers = np.expand_dims(
                 self.model_conc_at_layers, axis=0
             )
@@ -56,9 +87,6 @@ class VerticalGrid:
             self.satellite_edges = np.expand_dims(self.satellite_edges, axis=0)
 
     def __check_input_structure(self):
-        assert (
-            self.model_conc_at_layers.ndim >= 2
-        ), "GEOS-Chem methane layers must be 2D (nobs x nlevels) or 3D (nobs x nlevels x nspecies)."
         assert (
             self.model_edges.ndim == 2
         ), "GEOS-Chem pressure edges must be 2D (nobs x nlevels)."
@@ -77,6 +105,19 @@ class VerticalGrid:
             np.diff(self.satellite_edges) <= 0
         ), "Satellite pressure levels must be in descending order."
 
+        assert self.model_edges.shape[0] == self.satellite_edges.shape[0], (
+            f"GEOS-Chem and satellite must have the same number of observations. "
+            f"model_edges nobs = {self.model_edges.shape[0]} "
+            f"satellite_edges nobs = {self.satellite_edges.shape[0]} "
+        )
+
+        # The remaining checks are only needed if we have concentrations
+        if self.model_conc_at_layers is None:
+            return
+
+        assert (
+            self.model_conc_at_layers.ndim >= 2
+        ), "GEOS-Chem methane layers must be 2D (nobs x nlevels) or 3D (nobs x nlevels x nspecies)."
         assert (
             self.model_edges.shape[0]
             == self.satellite_edges.shape[0]
@@ -136,6 +177,106 @@ class VerticalGrid:
 
         return interpolation_map
 
+    @staticmethod
+    def get_sparse_interpolation_map(model_edges, satellite_edges, 
+                                     weight_dtype=np.float64):
+        """
+        Sparse equivalent of get_interpolation_map. Most entries of the dense
+        map are zero because each model layer only overlaps one or two 
+        satellite layers. Because both sets of edges are monotonic, we can 
+        instead merge them: each pair of consecutive merged edges bounds a 
+        segment that lies within exactly one model layer and one satellite
+        layer, and there are n_model_edges + n_satellite_edges - 1 segments.
+
+        The map is a structured array with dimension (nobs x nsegments) and
+        fields model_index, satellite_index, and weight (the pressure 
+        thickness of the segment). Summing weight over the segments with the
+        same model_index and satellite_index recovers the dense map. Segments
+        that fall outside either grid have weight 0. The weights are stored
+        as weight_dtype.
+        """
+        n_model_edges = model_edges.shape[1]
+        n_satellite_edges = satellite_edges.shape[1]
+
+        # Merge the edges in descending order of pressure, keeping track of 
+        # which edges come from the model grid. NaNs are sorted to the end.
+        edges = np.concatenate([model_edges, satellite_edges], axis=1)
+        is_model_edge = np.zeros(edges.shape, dtype=bool)
+        is_model_edge[:, :n_model_edges] = True
+        order = np.argsort(-edges, axis=1, kind="stable")
+        edges = np.take_along_axis(edges, order, axis=1)
+        is_model_edge = np.take_along_axis(is_model_edge, order, axis=1)
+
+        # The layer that contains each segment is given by the number of edges
+        # from that grid at or below the bottom of the segment (minus one).
+        model_index = np.cumsum(is_model_edge, axis=1)[:, :-1] - 1
+        satellite_index = np.cumsum(~is_model_edge, axis=1)[:, :-1] - 1
+        weight = edges[:, :-1] - edges[:, 1:]
+
+        # Remove segments that are outside of either grid or that are in a 
+        # layer with a missing edge (as in get_interpolation_map)
+        valid = ((model_index >= 0) & (model_index < n_model_edges - 1) &
+                 (satellite_index >= 0) & 
+                 (satellite_index < n_satellite_edges - 1))
+        model_index = model_index.clip(0, n_model_edges - 2)
+        satellite_index = satellite_index.clip(0, n_satellite_edges - 2)
+        model_layer_is_finite = np.isfinite(np.diff(model_edges))
+        satellite_layer_is_finite = np.isfinite(np.diff(satellite_edges))
+        valid &= np.take_along_axis(model_layer_is_finite, model_index, axis=1)
+        valid &= np.take_along_axis(satellite_layer_is_finite, 
+                                    satellite_index, axis=1)
+
+        interpolation_map = np.zeros(weight.shape, 
+                                     dtype=get_sparse_map_dtype(weight_dtype))
+        interpolation_map["model_index"] = model_index
+        interpolation_map["satellite_index"] = satellite_index
+        interpolation_map["weight"] = np.where(valid, weight, 0)
+
+        return interpolation_map
+
+    @staticmethod
+    def apply_interpolation_map(interpolation_map, 
+                                model_conc_at_layers, 
+                                n_satellite_layers,
+                                accumulate_dtype=None):
+        """
+        Applies a dense (nobs x ngc x nsat) or sparse (nobs x nsegments) 
+        interpolation map to the model concentrations (nobs x ngc x nspecies)
+        and returns the satellite partial columns (nobs x nsat x nspecies).
+        The sums over the model layers are done in accumulate_dtype if it is
+        given.
+        """
+        # Dense maps (e.g., from older _interpolation.npy files). This is a
+        # matrix multiplication across nobs model vectors.
+        if interpolation_map.dtype.names is None:
+            return (
+                interpolation_map[:, :, :, None] * 
+                model_conc_at_layers[:, :, None, :]
+            ).sum(axis=1, dtype=accumulate_dtype)
+
+        # Weight the model concentration in each segment
+        n_obs, n_segments = interpolation_map.shape
+        n_species = model_conc_at_layers.shape[-1]
+        segment_partial_columns = np.take_along_axis(
+            model_conc_at_layers, 
+            interpolation_map["model_index"][:, :, None], 
+            axis=1)
+        segment_partial_columns *= interpolation_map["weight"][:, :, None]
+
+        # Sum the segments in each satellite layer. satellite_index is sorted
+        # within each observation and every satellite layer contains at least
+        # one segment, so we can sum contiguous runs with reduceat.
+        target = (np.arange(n_obs)[:, None] * n_satellite_layers 
+                  + interpolation_map["satellite_index"]).ravel()
+        starts = np.searchsorted(target, np.arange(n_obs * n_satellite_layers))
+        satellite_partial_columns = np.add.reduceat(
+            segment_partial_columns.reshape((n_obs * n_segments, n_species)),
+            starts,
+            axis=0,
+            dtype=accumulate_dtype)
+        return satellite_partial_columns.reshape(
+            (n_obs, n_satellite_layers, n_species))
+
     def get_hprime_satellite_edges(self):
         """
         Equivalent to hprime in equation 11 of of Keppens et al. (2019).
@@ -153,11 +294,16 @@ class VerticalGrid:
         hprime_edges[:, -1] = self.satellite_edges[:, -1]
         return hprime_edges
 
-    def interpolate(self):
+    def get_interpolation_components(self):
         """
-        Interpolate GEOS-Chem methane to satellite edges OR centers. Use
-        a pre-calculating interpolation_map if available--this is to optimize 
+        Gets the parts of the interpolation that only depend on the pressure
+        edges: the interpolation map (W * M_in) and the conversion from 
+        satellite partial columns to concentrations (M_out*). Use a
+        pre-calculated interpolation_map if available--this is to optimize
         Jacobian construction.
+
+        Returns the interpolation map and partial_column_to_conc 
+        (nobs x nsat).
         """
         if self.expand_model_edges:
             expanded_model_edges = self.expand_model_to_satellite_range()
@@ -174,14 +320,25 @@ class VerticalGrid:
                 f" not {self.interpolate_to_centers_or_edges}"
             )
 
-        # Get the interpolation map
-        try:
-            interpolation_map = np.load(f"{self.save_dir}_interpolation.npy")
-            print("  Using pre-computed interpolation map.")
-        except:
-            interpolation_map = self.get_interpolation_map(
+        # Get the interpolation map. Both sparse and (older) dense maps can be
+        # reloaded.
+        interpolation_map = None
+        map_file = f"{self.save_dir}_interpolation.npy"
+        if self.save_dir is not None and os.path.exists(map_file):
+            interpolation_map = np.load(map_file, mmap_mode="r")
+            if interpolation_map.shape[0] == self.n_obs:
+                print("  Using pre-computed interpolation map.")
+            else:
+                print("  Pre-computed interpolation map does not match the "
+                      "satellite dimension. Recomputing.")
+                interpolation_map = None
+
+        if interpolation_map is None:
+            interpolation_map = self.get_sparse_interpolation_map(
                 model_edges=expanded_model_edges, 
-                satellite_edges=satellite_edges
+                satellite_edges=satellite_edges,
+                weight_dtype=(np.float64 if self.dtype is None 
+                              else self.dtype)
             )
             
             # Save out the interpolation map
@@ -195,14 +352,39 @@ class VerticalGrid:
         # where the column is truncated.
         with np.errstate(divide='ignore', invalid='ignore'):
             partial_column_to_conc = 1 / np.abs(np.diff(satellite_edges))
-        partial_column_to_conc = np.nan_to_num(partial_column_to_conc, 0)
+        partial_column_to_conc = np.nan_to_num(
+            partial_column_to_conc, nan=0.0, posinf=0.0)
+        if self.dtype is not None:
+            partial_column_to_conc = partial_column_to_conc.astype(
+                self.dtype, copy=False)
+
+        return interpolation_map, partial_column_to_conc
+
+    def interpolate(self):
+        """
+        Interpolate GEOS-Chem methane to satellite edges OR centers.
+        """
+        if self.backend == "numba":
+            satellite_conc = kernels.interpolate(
+                self.model_conc_at_layers, self.model_edges, 
+                self.satellite_edges, self.interpolate_to_centers_or_edges,
+                self.expand_model_edges)
+            if self.dtype is not None:
+                satellite_conc = satellite_conc.astype(self.dtype, copy=False)
+            return satellite_conc
+
+        interpolation_map, partial_column_to_conc = (
+            self.get_interpolation_components())
 
         # Calculate the satellite partial column
-        satellite_partial_columns = (
-            interpolation_map[:, :, :, None] * 
-            self.model_conc_at_layers[:, :, None, :]
-        ).sum(axis=1)  # matrix multiplication across nobs model vectors
+        satellite_partial_columns = self.apply_interpolation_map(
+            interpolation_map, 
+            self.model_conc_at_layers, 
+            partial_column_to_conc.shape[1],
+            self.accumulate_dtype)
         satellite_conc = (partial_column_to_conc[:, :, None] * 
                           satellite_partial_columns)
+        if self.dtype is not None:
+            satellite_conc = satellite_conc.astype(self.dtype, copy=False)
 
         return satellite_conc
@@ -0,0 +1,268 @@
+"""
+Optional compiled kernels for the vertical interpolation and the
+averaging kernel. Instead of building the interpolation map and the
+broadcast products in interpolation.py and operators.py, these loop over
+the observations (in parallel) and, for each one, walk down the model and
+satellite pressure edges together, adding the overlap of each pair of
+layers directly to the output. No intermediate arrays are allocated.
+
+The kernels are compiled with numba if it is installed (BACKEND: 'numba').
+Otherwise get_backend falls back to the numpy code, which gives the same
+results to within floating point round-off.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ["numpy", "numba"]
+
+# Without numba, the kernels below are plain python functions. They give the
+# same results but are far too slow for real use, so get_backend does not
+# select them.
+if numba is not None:
+    _jit = numba.njit(cache=True)
+    _parallel_jit = numba.njit(parallel=True, cache=True)
+    prange = numba.prange
+else:
+    _jit = _parallel_jit = lambda function: function
+    prange = range
+
+
+def get_backend(local_config, verbose=False):
+    """
+    Gets the backend used to build the observation operator from 
+    LOCAL_SETTINGS (BACKEND, 'numpy' by default). Falls back to 'numpy' if
+    'numba' is requested but numba is not installed.
+    """
+    backend = str(local_config.get("BACKEND", "numpy")).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"BACKEND must be one of {BACKENDS}, not {backend}")
+    if backend == "numba" and numba is None:
+        if verbose:
+            print("numba is not installed. Using the numpy backend.")
+        backend = "numpy"
+    return backend
+
+
+@_jit
+def _model_edge(model_edges, satellite_edges, o, k, expand_model_edges):
+    """
+    Gets model edge k of observation o, extended to the satellite surface
+    and top (see VerticalGrid.expand_model_to_satellite_range).
+    """
+    edge = model_edges[o, k]
+    if expand_model_edges:
+        if k == 0 and edge < satellite_edges[o, 0]:
+            edge = satellite_edges[o, 0]
+        elif (k == model_edges.shape[1] - 1
+              and edge > satellite_edges[o, satellite_edges.shape[1] - 1]):
+            edge = satellite_edges[o, satellite_edges.shape[1] - 1]
+    return edge
+
+
+@_jit
+def _satellite_edge(satellite_edges, o, k, to_edges):
+    """
+    Gets satellite edge k of observation o. If the averaging kernel is on
+    the satellite edges, these are the hprime edges (see
+    VerticalGrid.get_hprime_satellite_edges).
+    """
+    n_satellite_edges = satellite_edges.shape[1]
+    if not to_edges:
+        return satellite_edges[o, k]
+    if k == 0:
+        return satellite_edges[o, 0]
+    if k == n_satellite_edges:
+        return satellite_edges[o, n_satellite_edges - 1]
+    return 0.5 * (satellite_edges[o, k - 1] + satellite_edges[o, k])
+
+
+@_jit
+def _partial_column_to_conc(high, low):
+    """
+    Gets the factor that converts a satellite partial column to a
+    concentration (0 for empty layers, as in
+    VerticalGrid.get_interpolation_components).
+    """
+    thickness = abs(high - low)
+    if thickness > 0 and np.isfinite(thickness):
+        return 1 / thickness
+    return 0.0
+
+
+@_jit
+def _skip_missing_layer(model_high, model_low, satellite_high, satellite_low):
+    """
+    Gets whether to skip the current model or satellite layer because one 
+    of its edges is missing (NaN). Such layers do not overlap anything, as 
+    in VerticalGrid.get_interpolation_map, and the comparisons that move 
+    the walk on would otherwise both be False.
+    """
+    if not (np.isfinite(model_high) and np.isfinite(model_low)):
+        return True, False
+    if not (np.isfinite(satellite_high) and np.isfinite(satellite_low)):
+        return False, True
+    return False, False
+
+
+@_parallel_jit
+def _build_operator(model_edges, satellite_edges, pressure_weight,
+                    averaging_kernel, prior_profile, to_edges, h, c):
+    n_obs = model_edges.shape[0]
+    n_model_layers = model_edges.shape[1] - 1
+    n_satellite_layers = pressure_weight.shape[1]
+    for o in prange(n_obs):
+        c[o] = 0.0
+        for s in range(n_satellite_layers):
+            c[o] += (pressure_weight[o, s] * (1 - averaging_kernel[o, s])
+                     * prior_profile[o, s])
+        for m in range(n_model_layers):
+            h[o, m] = 0.0
+
+        # Both sets of edges are in descending order, so we step through
+        # the layers together and move on from whichever layer ends first.
+        m = 0
+        s = 0
+        model_high = _model_edge(model_edges, satellite_edges, o, 0, True)
+        model_low = _model_edge(model_edges, satellite_edges, o, 1, True)
+        satellite_high = _satellite_edge(satellite_edges, o, 0, to_edges)
+        satellite_low = _satellite_edge(satellite_edges, o, 1, to_edges)
+        satellite_weight = (
+            pressure_weight[o, 0] * averaging_kernel[o, 0]
+            * _partial_column_to_conc(satellite_high, satellite_low))
+        while m < n_model_layers and s < n_satellite_layers:
+            next_model, next_satellite = _skip_missing_layer(
+                model_high, model_low, satellite_high, satellite_low)
+            if not (next_model or next_satellite):
+                overlap = (min(model_high, satellite_high)
+                           - max(model_low, satellite_low))
+                if overlap > 0:
+                    h[o, m] += overlap * satellite_weight
+                next_model = model_low >= satellite_low
+                next_satellite = satellite_low >= model_low
+            if next_model:
+                m += 1
+                if m < n_model_layers:
+                    model_high = model_low
+                    model_low = _model_edge(model_edges, satellite_edges,
+                                            o, m + 1, True)
+            if next_satellite:
+                s += 1
+                if s < n_satellite_layers:
+                    satellite_high = satellite_low
+                    satellite_low = _satellite_edge(satellite_edges, o,
+                                                    s + 1, to_edges)
+                    satellite_weight = (
+                        pressure_weight[o, s] * averaging_kernel[o, s]
+                        * _partial_column_to_conc(satellite_high,
+                                                  satellite_low))
+
+
+@_parallel_jit
+def _interpolate(model_conc_at_layers, model_edges, satellite_edges,
+                 to_edges, expand_model_edges, satellite_conc):
+    n_obs = model_edges.shape[0]
+    n_model_layers = model_edges.shape[1] - 1
+    n_satellite_layers = satellite_conc.shape[1]
+    n_species = satellite_conc.shape[2]
+    for o in prange(n_obs):
+        for s in range(n_satellite_layers):
+            for k in range(n_species):
+                satellite_conc[o, s, k] = 0.0
+
+        # Sum the overlapping model partial columns in each satellite layer
+        m = 0
+        s = 0
+        model_high = _model_edge(model_edges, satellite_edges, o, 0,
+                                 expand_model_edges)
+        model_low = _model_edge(model_edges, satellite_edges, o, 1,
+                                expand_model_edges)
+        satellite_high = _satellite_edge(satellite_edges, o, 0, to_edges)
+        satellite_low = _satellite_edge(satellite_edges, o, 1, to_edges)
+        while m < n_model_layers and s < n_satellite_layers:
+            next_model, next_satellite = _skip_missing_layer(
+                model_high, model_low, satellite_high, satellite_low)
+            if not (next_model or next_satellite):
+                overlap = (min(model_high, satellite_high)
+                           - max(model_low, satellite_low))
+                if overlap > 0:
+                    for k in range(n_species):
+                        satellite_conc[o, s, k] += (
+                            overlap * model_conc_at_layers[o, m, k])
+                next_model = model_low >= satellite_low
+                next_satellite = satellite_low >= model_low
+            if next_model:
+                m += 1
+                if m < n_model_layers:
+                    model_high = model_low
+                    model_low = _model_edge(model_edges, satellite_edges,
+                                            o, m + 1, expand_model_edges)
+            if next_satellite:
+                # Convert the finished layer to a concentration
+                conversion = _partial_column_to_conc(satellite_high,
+                                                     satellite_low)
+                for k in range(n_species):
+                    satellite_conc[o, s, k] *= conversion
+                s += 1
+                if s < n_satellite_layers:
+                    satellite_high = satellite_low
+                    satellite_low = _satellite_edge(satellite_edges, o,
+                                                    s + 1, to_edges)
+
+        # Convert the satellite layers above the top of the model
+        while s < n_satellite_layers:
+            conversion = _partial_column_to_conc(satellite_high,
+                                                 satellite_low)
+            for k in range(n_species):
+                satellite_conc[o, s, k] *= conversion
+            s += 1
+            if s < n_satellite_layers:
+                satellite_high = satellite_low
+                satellite_low = _satellite_edge(satellite_edges, o, s + 1,
+                                                to_edges)
+
+
+def build_operator(model_edges, satellite_edges, pressure_weight,
+                   averaging_kernel, prior_profile, avker_center_or_edges):
+    """
+    Equivalent to the interpolation map and averaging kernel steps of
+    operators.ObservationOperator.build. Returns h (nobs x n_model_levels)
+    and c (nobs). 
+    
+    The calculation is done in float64. The numpy path rounds the model 
+    surface and top edges to the model precision (float32 for GEOS-Chem) 
+    when they are extended to the satellite grid, so the two differ by up 
+    to ~1e-7 (relative) in that case.
+    """
+    n_obs, n_model_edges = model_edges.shape
+    h = np.empty((n_obs, n_model_edges - 1))
+    c = np.empty(n_obs)
+    _build_operator(np.ascontiguousarray(model_edges, dtype=np.float64),
+                    np.ascontiguousarray(satellite_edges, dtype=np.float64),
+                    np.ascontiguousarray(pressure_weight, dtype=np.float64),
+                    np.ascontiguousarray(averaging_kernel, dtype=np.float64),
+                    np.ascontiguousarray(prior_profile, dtype=np.float64),
+                    avker_center_or_edges == "edges", h, c)
+    return h, c
+
+
+def interpolate(model_conc_at_layers, model_edges, satellite_edges,
+                interpolate_to_centers_or_edges, expand_model_edges=True):
+    """
+    Equivalent to VerticalGrid.interpolate. model_conc_at_layers has
+    dimension (nobs x n_model_levels x nspecies), and the satellite
+    concentrations are returned with dimension (nobs x nsat x nspecies).
+    """
+    to_edges = interpolate_to_centers_or_edges == "edges"
+    n_satellite_layers = satellite_edges.shape[1] - (0 if to_edges else 1)
+    satellite_conc = np.empty((model_conc_at_layers.shape[0],
+                               n_satellite_layers,
+                               model_conc_at_layers.shape[2]))
+    _interpolate(np.ascontiguousarray(model_conc_at_layers, dtype=np.float64),
+                 np.ascontiguousarray(model_edges, dtype=np.float64),
+                 np.ascontiguousarray(satellite_edges, dtype=np.float64),
+                 to_edges, expand_model_edges, satellite_conc)
+    return satellite_conc
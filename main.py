@@ -8,17 +8,34 @@ config_file = sys.argv[1] if len(sys.argv) > 1 else 'config.yaml'
 with open(config_file, 'r') as f:
     config = yaml.safe_load(f)
 
-os.environ['OPENBLAS_NUM_THREADS'] = str(config['LOCAL_SETTINGS']['N_THREADS'])
-os.environ['MPI_NUM_THREADS'] = str(config['LOCAL_SETTINGS']['N_THREADS'])
-os.environ['MKL_NUM_THREADS'] = str(config['LOCAL_SETTINGS']['N_THREADS'])
-os.environ['OMP_NUM_THREADS'] = str(config['LOCAL_SETTINGS']['N_THREADS'])
+# Split N_THREADS between the worker processes (one satellite file each) and
+# the BLAS threads used by each worker. This has to happen before numpy is
+# imported, including in the worker processes, which re-run this block.
+n_workers = int(config['LOCAL_SETTINGS'].get('N_WORKERS', 1))
+n_threads = max(1, int(config['LOCAL_SETTINGS']['N_THREADS']) // n_workers)
+os.environ['OPENBLAS_NUM_THREADS'] = str(n_threads)
+os.environ['MPI_NUM_THREADS'] = str(n_threads)
+os.environ['MKL_NUM_THREADS'] = str(n_threads)
+os.environ['OMP_NUM_THREADS'] = str(n_threads)
+os.environ['NUMBA_NUM_THREADS'] = str(n_threads)
 
 # Additional imports
+import contextlib
+import multiprocessing
+import resource
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import time
+import dask
+import dask.array as da
 import numpy as np
 import xarray as xr
 import utilities as util
 import parsers
 import operators
+import instrumentation
+import kernels
 
 
 def apply_operator(config):
@@ -34,141 +51,717 @@ def apply_operator(config):
     
     """
 
+    start_time = time.perf_counter()
+    kernels.get_backend(config["LOCAL_SETTINGS"], verbose=True)
+    util.get_output_store(config["LOCAL_SETTINGS"]) # Check before processing
+
     # Make save out directory
     if not os.path.exists(config["LOCAL_SETTINGS"]["SAVE_DIR"]):
         os.makedirs(config["LOCAL_SETTINGS"]["SAVE_DIR"])
 
     # Also make a directory to save out the components of the operator (e.g.,
     # space and time indices and the interpolation map) if needed.
-    if config["LOCAL_SETTINGS"]["SAVE_INTERPOLATION"]:
+    if config["LOCAL_SETTINGS"]["SAVE_INTERPOLATION"].lower() == "true":
         save_dir = f'{config["LOCAL_SETTINGS"]["OBS_DIR"]}/operator_components'
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
-    # Obtain a list of the satellite and GEOS-Chem files.
-    files = util.get_file_lists(config["LOCAL_SETTINGS"])
-    satellite_files, model_edge_files, model_conc_files = files
+    # Obtain a list of the satellite files and catalogs of the time steps in
+    # the GEOS-Chem files.
+    files = util.get_file_lists(config["LOCAL_SETTINGS"], 
+                                util.get_config_fingerprint(config),
+                                config["MODEL"]["DATA_FIELDS"]["TIME"])
+    satellite_files, edge_catalog, conc_catalogs = files
+
+    # Get the dates for which we have model data. In batch mode, every model
+    # run needs to have the date.
+    model_dates = edge_catalog.get_dates()
+    for conc_catalog in conc_catalogs:
+        model_dates = np.intersect1d(model_dates, conc_catalog.get_dates())
 
-    # Get the dates for which we have model files.
-        # TO DO: Currently, this assumes that the GEOS-Chem files are daily or
-        # monthly. We should update this to be more flexible.
-    model_dates = np.unique(
-        [date for date in util.get_gc_dates(model_edge_files)
-         if date in util.get_gc_dates(model_conc_files)])
+    # Process the satellite files, either one at a time or concurrently in a
+    # pool of worker processes.
+    if int(config["LOCAL_SETTINGS"].get("N_WORKERS", 1)) > 1:
+        apply_operator_in_pool(
+            satellite_files, conc_catalogs, edge_catalog, model_dates, 
+            config)
+        update_output_store(config)
+        report(config, time.perf_counter() - start_time)
+        return
 
     # Get the satellite parser. 
     read_satellite = parsers.get_satellite_parser(config)
 
+    # Keep recently used model files in memory, since the same model days
+    # are needed by many satellite files and chunks.
+    cache = get_model_cache(config)
+
     for sf in satellite_files:
-        short_name = sf.split("/")[-1]
+        process_satellite_file(sf, conc_catalogs, edge_catalog, 
+                               model_dates, read_satellite, config, cache)
+
+    if cache is not None:
+        print(cache)
+
+    update_output_store(config)
+    report(config, time.perf_counter() - start_time)
+
+
+def update_output_store(config):
+    """ Adds the new and reprocessed output files to the store at 
+    OUTPUT_STORE, if it is set (see utilities.OutputStore). """
+    if util.get_output_store(config["LOCAL_SETTINGS"]) is None:
+        return
+    instrumentation.set_context(file=None, chunk=None)
+    with instrumentation.stage("output_store"):
+        util.update_output_store(config["LOCAL_SETTINGS"])
+
+
+def report(config, total_time):
+    """ Prints the time spent in each stage and, if RUN_REPORT is set, 
+    writes the timing and memory of each stage to <RUN_REPORT>.json and
+    <RUN_REPORT>.csv (see instrumentation.py). """
+    report_path = str(config["LOCAL_SETTINGS"].get("RUN_REPORT", "none"))
+    if report_path.lower() == "none":
+        summary = instrumentation.get_summary(
+            instrumentation.get_records(), total_time)
+    else:
+        summary = instrumentation.write_report(report_path, total_time)
+        print(f"Saved the run report to {report_path}.json and .csv")
+    instrumentation.print_summary(summary)
+
+
+def get_model_cache(config):
+    """ Returns a parsers.ModelCache with the MODEL_CACHE_SIZE budget, or None
+    if the cache is disabled. """
+    cache_size = float(config["LOCAL_SETTINGS"].get("MODEL_CACHE_SIZE", 0))
+    return parsers.ModelCache(cache_size) if cache_size > 0 else None
 
-        print(f"Processing {short_name}")
+
+def process_satellite_file(sf, 
+                           conc_catalogs, 
+                           edge_catalog, 
+                           model_dates, 
+                           read_satellite, 
+                           config, 
+                           cache=None):
+    """ Apply the operator to a single satellite file.
+
+    Inputs:
+        sf: satellite filepath
+        conc_catalogs: list with a util.ModelCatalog of the model 
+                       concentration files for each model run
+        edge_catalog: util.ModelCatalog of the model edge files
+        model_dates: dates for which we have model files
+        read_satellite: satellite parser from parsers.get_satellite_parser
+        config: dictionary with configuration settings
+        cache: optional parsers.ModelCache used to read the model files
+
+    Returns:
+        Saves the model columns (and satellite data) to
+        <SAVE_DIR>/<name>_operator.nc. If the run is interrupted, rerunning
+        resumes from the last completed chunk. The inputs are recorded in 
+        <SAVE_DIR>/manifest/<name>.json once the output is complete.
+    """
+    short_name = sf.split("/")[-1]
+
+    print(f"Processing {short_name}")
+    instrumentation.set_context(file=short_name, chunk=None)
+    with instrumentation.stage("satellite_parse") as record:
         satellite = read_satellite(sf) # Read the first file
+        record["n_obs"] = satellite.sizes["N_OBS"]
 
-        satellite_dates = [
-            date for date 
-            in np.unique(satellite["TIME"].dt.strftime("%Y-%m-%d"))
-            if date in model_dates
-        ]
+    # Record the inputs so that the file is only reprocessed if they change
+    all_dates = list(np.unique(satellite["TIME"].dt.strftime("%Y-%m-%d")))
+    input_record = util.get_input_record(sf, all_dates, edge_catalog, 
+                                         conc_catalogs, 
+                                         util.get_config_fingerprint(config))
 
-        if len(satellite_dates) == 0:
-            print(f"  There are no temporally overlapping model "
-                  f"data for {short_name}")
-            continue
+    satellite_dates = [date for date in all_dates if date in model_dates]
+
+    if len(satellite_dates) == 0:
+        print(f"  There are no temporally overlapping model "
+              f"data for {short_name}")
+        util.write_manifest(sf, config["LOCAL_SETTINGS"]["SAVE_DIR"], 
+                            input_record)
+        return
+
+    satellite = satellite.where(
+        satellite["TIME"].dt.strftime("%Y-%m-%d").isin(
+            satellite_dates).compute(), 
+        drop=True)
 
-        satellite = satellite.where(
-            satellite["TIME"].dt.strftime("%Y-%m-%d").isin(satellite_dates), 
-            drop=True)
+    output_file = (f'{config["LOCAL_SETTINGS"]["SAVE_DIR"]}/'
+                   f'{short_name.split(".")[0]}_operator.nc')
+
+    # With EXECUTION: 'dask', the satellite data stay lazy and the whole 
+    # file is computed and written in one pass.
+    if util.is_lazy(config["LOCAL_SETTINGS"]):
+        with instrumentation.stage("operator_apply", 
+                                   satellite.sizes["N_OBS"]):
+            output_file = apply_operator_lazily(
+                conc_catalogs, edge_catalog, satellite, config, 
+                output_file)
+        util.write_manifest(sf, config["LOCAL_SETTINGS"]["SAVE_DIR"], 
+                            input_record, output_file)
+        return
+
+    with instrumentation.stage("satellite_parse") as record:
         satellite = satellite.compute()
+        record["n_obs"] = satellite.sizes["N_OBS"]
+        record["bytes_read"] = satellite.nbytes
 
-        model_columns = apply_operator_to_chunks(
-            model_conc_files, model_edge_files, satellite, config)
-        
-        if model_columns is not None:
-            short_name = short_name.split('.')[0] + '_operator.nc'
-            model_columns.to_netcdf(
-                f'{config["LOCAL_SETTINGS"]["SAVE_DIR"]}/{short_name}')
+    # Each chunk is written to <name>_operator_parts as soon as it is done,
+    # and the parts are combined into the output file at the end.
+    parts_dir = output_file.replace("_operator.nc", "_operator_parts")
+
+    # The operator components for the whole file are kept in one store in
+    # <OBS_DIR>/operator_components/<name> if needed.
+    store_dir = None
+    if config["LOCAL_SETTINGS"]["SAVE_INTERPOLATION"].lower() == "true":
+        store_dir = (f'{config["LOCAL_SETTINGS"]["OBS_DIR"]}/'
+                     f'operator_components/{short_name.split(".")[0]}')
+
+    completed = apply_operator_to_chunks(
+        conc_catalogs, edge_catalog, satellite, config, parts_dir, 
+        cache, store_dir)
+
+    instrumentation.set_context(chunk=None)
+    with instrumentation.stage("output_write"):
+        output_file = util.combine_chunks(parts_dir, completed, output_file)
+    util.write_manifest(sf, config["LOCAL_SETTINGS"]["SAVE_DIR"], 
+                        input_record, output_file)
+
+
+def apply_operator_in_pool(satellite_files, 
+                           conc_catalogs, 
+                           edge_catalog, 
+                           model_dates, 
+                           config):
+    """ Process the satellite files concurrently with N_WORKERS worker 
+    processes. Each worker writes its output to a log file in 
+    <SAVE_DIR>/logs, and a file that fails is reported without stopping 
+    the other files. If a worker crashes (e.g., because it exceeded 
+    WORKER_MEMORY_LIMIT), the files that were running at the time are 
+    retried one at a time so that only the file that caused the crash 
+    fails.
+
+    Inputs:
+        satellite_files: list of satellite filepaths
+        conc_catalogs: list with a util.ModelCatalog of the model 
+                       concentration files for each model run
+        edge_catalog: util.ModelCatalog of the model edge files
+        model_dates: dates for which we have model files
+        config: dictionary with configuration settings
+    """
+    log_dir = f'{config["LOCAL_SETTINGS"]["SAVE_DIR"]}/logs'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
 
+    n_workers = int(config["LOCAL_SETTINGS"]["N_WORKERS"])
+    print(f"Processing {len(satellite_files)} files with {n_workers} workers "
+          f"and {os.environ['OMP_NUM_THREADS']} threads per worker.")
+    args = (conc_catalogs, edge_catalog, model_dates, config)
+    failed = {}
+    crashed = _run_pool(satellite_files, args, n_workers, failed)
+    for sf in crashed:
+        _run_pool([sf], args, 1, failed)
 
-def apply_operator_to_chunks(model_conc_files,
-                             model_edge_files,
+    print(f"Processed {len(satellite_files) - len(failed)} of "
+          f"{len(satellite_files)} files.")
+    for short_name, error in failed.items():
+        print(f"  {short_name} failed (see {log_dir}/{short_name}.log):")
+        print(f"    {error}")
+
+
+def _run_pool(satellite_files, args, max_workers, failed):
+    """ Runs _process_satellite_file_in_worker over satellite_files. Errors 
+    are added to failed, and the files that were lost because a worker 
+    crashed are returned. """
+    crashed = []
+    context = multiprocessing.get_context("spawn")
+    memory_limit = float(args[-1]["LOCAL_SETTINGS"].get(
+        "WORKER_MEMORY_LIMIT", 0))
+    with ProcessPoolExecutor(max_workers=max_workers, 
+                             mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(memory_limit, args[-1])) as pool:
+        futures = {pool.submit(_process_satellite_file_in_worker, sf, *args) 
+                   : sf for sf in satellite_files}
+        for future in as_completed(futures):
+            short_name = futures[future].split("/")[-1]
+            try:
+                error, records = future.result()
+                instrumentation.add_records(records)
+            except BrokenProcessPool:
+                if max_workers > 1:
+                    crashed.append(futures[future])
+                    continue
+                error = "The worker process crashed."
+            if error is None:
+                print(f"  Finished {short_name}")
+            else:
+                failed[short_name] = error
+    return crashed
+
+
+# The satellite parser and model cache used by each worker process
+_worker_state = {}
+
+
+def _init_worker(memory_limit, config):
+    """ Sets the address space limit of a worker process (if 
+    WORKER_MEMORY_LIMIT is set) and creates its satellite parser and model
+    cache. """
+    if memory_limit > 0:
+        resource.setrlimit(resource.RLIMIT_AS, 
+                           (int(memory_limit), int(memory_limit)))
+    with contextlib.redirect_stdout(None):
+        _worker_state["read_satellite"] = parsers.get_satellite_parser(config)
+    _worker_state["cache"] = get_model_cache(config)
+
+
+def _process_satellite_file_in_worker(sf, 
+                                      conc_catalogs, 
+                                      edge_catalog, 
+                                      model_dates, 
+                                      config):
+    """ Runs process_satellite_file in a worker process with the output 
+    written to <SAVE_DIR>/logs/<name>.log. Returns None on success or the
+    error message, and the instrumentation records of the file. """
+    short_name = sf.split("/")[-1]
+    log_file = f'{config["LOCAL_SETTINGS"]["SAVE_DIR"]}/logs/{short_name}.log'
+    with open(log_file, "w") as log, \
+         contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            process_satellite_file(
+                sf, conc_catalogs, edge_catalog, model_dates, 
+                _worker_state["read_satellite"], config, 
+                _worker_state["cache"])
+            if _worker_state["cache"] is not None:
+                print(_worker_state["cache"])
+        except Exception as e:
+            traceback.print_exc()
+            return (f"{type(e).__name__}: {e}", 
+                    instrumentation.get_records(clear=True))
+    return None, instrumentation.get_records(clear=True)
+
+
+def apply_operator_to_chunks(conc_catalogs,
+                             edge_catalog,
                              satellite, 
-                             config):
+                             config,
+                             parts_dir,
+                             cache=None,
+                             store_dir=None):
     """ 
-    Applies the operator in chunks of file_length_threshold to balance 
-    memory constraints with the benefits of vectorization.
+    Applies the operator in chunks to balance memory constraints with the 
+    benefits of vectorization. Chunks are planned by date so that the model
+    data for each date are read once, and are sized from 
+    CHUNK_MEMORY_BUDGET (or FILE_LENGTH_THRESHOLD) by 
+    util.get_chunk_size.
+
+    The observation operator for each chunk is built once and is then 
+    applied to the concentrations of every model run, and each chunk is 
+    written out as soon as it is done. In batch mode 
+    (MODEL_CONCENTRATION_DIRS), the model runs are read one at a time for 
+    each chunk and the model columns have dimensions (N_OBS, N_RUNS). The tracers are 
+    colocated in blocks sized from TRACER_MEMORY_BUDGET, and the model 
+    columns of every tracer and run are written to one preallocated array 
+    per chunk, so the chunk size does not need to shrink with the number of
+    tracers.
 
     Inputs:
-        model_conc_files: list of model concentration filepaths
-        model_edge_files: list of model edge filepaths.
+        conc_catalogs: list with a util.ModelCatalog of the model 
+                       concentration files for each model run
+        edge_catalog: util.ModelCatalog of the model edge files
         satellite: xarray dataset with satellite data, 
                    output from satellite parser in parsers.py
         config: dictionary with configuration settings
+        parts_dir: directory that each chunk is written to as soon as it 
+                   is finished (see util.write_chunk)
+        cache: optional parsers.ModelCache used to read the model files
+        store_dir: optional directory of an operators.OperatorStore used to
+                   save and reuse the observation operator
     
     Returns:
-        xarray dataset with model columns and satellite columns.
+        list of the completed chunks, including chunks completed by a 
+        previous run with the same satellite data, chunk plan, and config.
     """
+    time_settings = util.get_time_matching_settings(config["LOCAL_SETTINGS"])
+    subset_domain = config["LOCAL_SETTINGS"].get(
+        "SUBSET_MODEL_DOMAIN", "False").lower() == "true"
+    runs = None
+    if util.is_batch_mode(config["LOCAL_SETTINGS"]):
+        runs = util.get_model_concentration_dirs(config["LOCAL_SETTINGS"])
+    precision = util.get_precision(config["LOCAL_SETTINGS"])
+    dtype, _ = util.PRECISIONS[precision]
+    footprint = (util.get_horizontal_sampling(config["LOCAL_SETTINGS"]) 
+                 == "footprint")
+
+    # Number the observations so that the chunks, which are grouped by date,
+    # can be put back in file order when they are combined
+    satellite = satellite.assign_coords(
+        N_OBS=np.arange(satellite.sizes["N_OBS"]))
+
+    # Plan the chunks
+    n_model_levels, n_tracers = parsers.get_geoschem_sizes(
+        conc_catalogs[0].files[0], config["MODEL"]["DATA_FIELDS"])
+    n_cells = _get_footprint_cells(satellite, edge_catalog, config)
+    chunk_size = util.get_chunk_size(
+        config["LOCAL_SETTINGS"], n_model_levels, 
+        satellite.sizes["N_EDGES"], n_tracers, len(conc_catalogs),
+        n_cells.mean() if len(n_cells) > 0 else 1)
+    plan = util.plan_chunks(satellite["TIME"].values, chunk_size)
+
+    # Check for chunks that were completed by a previous run
+    fingerprint = util.get_fingerprint(
+        satellite["TIME"].values, chunk_size, 
+        util.get_config_fingerprint(config))
+    completed = util.get_completed_chunks(parts_dir, fingerprint)
+
+    # Open (or create) the operator component store. With footprint 
+    # sampling, it has room for the model grid cells that each footprint 
+    # can overlap.
+    store = None
+    if store_dir is not None:
+        model_lats, model_lons = parsers.get_geoschem_grid(
+            edge_catalog.files[0], config["MODEL"]["DATA_FIELDS"])
+        store = operators.OperatorStore(
+            store_dir, satellite.sizes["N_OBS"], n_model_levels,
+            util.get_geometry_fingerprint(satellite, model_lats, model_lons,
+                                          config),
+            precision, n_cells if footprint else None,
+            util.HORIZONTAL_DIMS[model_lats.ndim])
+
     i = 0
-    model_columns = []
-    satellite_columns = []
-    while i < satellite.sizes["N_OBS"]:
-        # Subset the satellite data
-        sat_i = satellite.isel(
-            N_OBS=slice(
-                int(i), 
-                int(i + config["LOCAL_SETTINGS"]["FILE_LENGTH_THRESHOLD"])
-            )
-        )
-
-        # Get the dates that need to be processed
-        process_dates = np.unique(sat_i["TIME"].dt.strftime("%Y-%m-%d"))
-
-        mod_i = parsers.read_geoschem_file(
-            util.get_gc_files_for_dates(model_conc_files, process_dates),
-            util.get_gc_files_for_dates(model_edge_files, process_dates),
-            config["MODEL"]["DATA_FIELDS"])
-        mod_i = mod_i.compute()
-
-        # Check for times that are missing in the satellite data and continue
-        # if there are no overlapping times.
-        missing_times = util.get_missing_times(sat_i["TIME"], mod_i["TIME"])
-        if (~missing_times).sum() == 0:
-            print("  There are no overlapping satellite and model data in"
-                  " this chunk.")
-            i += config["LOCAL_SETTINGS"]["FILE_LENGTH_THRESHOLD"]
+    for date, chunks in plan:
+        # Skip dates that were completed by a previous run
+        if all(j in completed for j in range(i, i + len(chunks))):
+            i += len(chunks)
             continue
-        sat_i = sat_i.where(~missing_times, drop=True)
-
-        # Run the column operator
-        save_dir = (
-            f'{config["LOCAL_SETTINGS"]["OBS_DIR"]}/operator_components/'
-            f'{process_dates.min()}_{process_dates.max()}_{int(i):04d}'
-        )
-        model_columns.append(
-            operators.get_model_columns(mod_i, sat_i, config, save_dir)
-        )
-        if config["LOCAL_SETTINGS"]["SAVE_SATELLITE_DATA"].lower() == "true":
-            drop_vars = ["PRESSURE_EDGES", "PRESSURE_WEIGHT",
-                         "AVERAGING_KERNEL", "PRIOR_PROFILE",
-                         "N_EDGES", "N_LAYERS"]
-            drop_vars = [v for v in drop_vars if v in sat_i.data_vars]
-            satellite_columns.append(sat_i.drop_vars(drop_vars))
-
-        i += config["LOCAL_SETTINGS"]["FILE_LENGTH_THRESHOLD"]
-
-    # Concatenate together, combine, and return
-    if len(model_columns) > 0:
-        model_columns = xr.concat(model_columns, dim="N_OBS")
-        rename = {v : v.replace('CONC_AT_PRESSURE_CENTERS', 'MODEL_COLUMN')
-                  for v in model_columns.data_vars}
-        model_columns = model_columns.rename(rename)
-        if config["LOCAL_SETTINGS"]["SAVE_SATELLITE_DATA"].lower() == "true":
-            satellite_columns = xr.concat(satellite_columns, dim="N_OBS")
-            model_columns = xr.merge([model_columns, satellite_columns])
-        return model_columns
-    else:
+
+        # Read only the model time steps (and, optionally, the grid cells)
+        # that contain the observations on this date
+        sat_date = satellite.isel(N_OBS=np.concatenate(chunks))
+        obs_lats, obs_lons = _get_observation_extent(sat_date)
+        subset = {
+            "obs_times" : sat_date["TIME"].values,
+            "obs_lats" : obs_lats if subset_domain else None,
+            "obs_lons" : obs_lons if subset_domain else None,
+            "time_settings" : time_settings,
+            "cache" : cache,
+            "dtype" : None if precision == "float64" else dtype}
+        conc_files = conc_catalogs[0].get_files(subset["obs_times"], 
+                                                **time_settings)
+        edge_files = edge_catalog.get_files(subset["obs_times"], 
+                                            **time_settings)
+        if len(conc_files) == 0 or len(edge_files) == 0:
+            print(f"  There are no overlapping satellite and model data on "
+                  f"{date}.")
+            for _ in chunks:
+                if i not in completed:
+                    util.write_chunk(None, parts_dir, i, fingerprint, 
+                                     completed)
+                i += 1
+            continue
+        instrumentation.set_context(chunk=None)
+        with instrumentation.stage("model_read") as record:
+            mod_date = parsers.read_geoschem_file(
+                conc_files, edge_files, config["MODEL"]["DATA_FIELDS"], 
+                **subset)
+            record["bytes_read"] = mod_date.nbytes
+        conc_vars = operators.get_conc_vars(mod_date)
+
+        # Build the observation operator for each chunk that still needs to
+        # be done, apply it to every model run, and write the chunk out as 
+        # soon as it is finished
+        for chunk in chunks:
+            if i in completed:
+                i += 1
+                continue
+
+            # Subset the satellite data
+            instrumentation.set_context(chunk=i)
+            sat_i = satellite.isel(N_OBS=chunk)
+
+            # Check for times that are missing in the satellite data and 
+            # continue if there are no overlapping times.
+            missing_times = util.get_missing_times(
+                sat_i["TIME"], mod_date["TIME"], **time_settings)
+            if (~missing_times).sum() == 0:
+                print("  There are no overlapping satellite and model data in"
+                      " this chunk.")
+                util.write_chunk(None, parts_dir, i, fingerprint, completed)
+                i += 1
+                continue
+            sat_i = sat_i.where(~missing_times, drop=True)
+
+            operator = operators.get_observation_operator(
+                mod_date, sat_i, config, store, chunk[~missing_times.values])
+
+            # Apply the operator to each model run. The model columns of 
+            # every run are written to one array.
+            model_columns = np.empty(
+                (operator.n_obs, len(conc_vars), len(conc_catalogs)),
+                dtype=dtype)
+            for r in range(len(conc_catalogs)):
+                # The first run was read with the pressure edges. The others
+                # share the same edges and are read one at a time for each 
+                # chunk, with the same subset as the first run so that the 
+                # operator's indices apply (repeated reads come from the 
+                # model cache if MODEL_CACHE_SIZE is set).
+                mod_run = mod_date
+                if r > 0:
+                    with instrumentation.stage("model_read") as record:
+                        mod_run = parsers.read_geoschem_conc_file(
+                            conc_catalogs[r].get_files(subset["obs_times"], 
+                                                       **time_settings),
+                            config["MODEL"]["DATA_FIELDS"], **subset)
+                        record["bytes_read"] = mod_run.nbytes
+
+                # Apply the operator to the tracers in blocks that fit in 
+                # TRACER_MEMORY_BUDGET. Only count the observations once in
+                # batch mode.
+                block_size = util.get_tracer_block_size(
+                    config["LOCAL_SETTINGS"], 
+                    operator.n_profiles, 
+                    n_model_levels, len(conc_vars))
+                with instrumentation.stage(
+                        "operator_apply", operator.n_obs if r == 0 else None):
+                    operator.apply_to_model(mod_run, conc_vars, block_size,
+                                            out=model_columns[:, :, r])
+                del mod_run
+
+            if runs is None:
+                model_columns = model_columns[:, :, 0]
+            model_columns = operators.get_model_column_dataset(
+                model_columns, conc_vars, sat_i, runs)
+            model_columns = model_columns.rename(
+                _get_model_column_names(model_columns))
+            if config["LOCAL_SETTINGS"]["SAVE_SATELLITE_DATA"].lower() == "true":
+                model_columns = xr.merge([model_columns, 
+                                          _drop_operator_inputs(sat_i)])
+
+            # Record how many observations were filtered out of the file
+            model_columns.attrs.update(parsers.get_filter_attrs(satellite))
+
+            # Write the chunk out
+            with instrumentation.stage("output_write"):
+                util.write_chunk(model_columns, parts_dir, i, fingerprint, 
+                                 completed)
+            i += 1
+        del mod_date
+
+    return completed
+
+
+def apply_operator_lazily(conc_catalogs,
+                          edge_catalog,
+                          satellite,
+                          config,
+                          output_file):
+    """ 
+    Applies the operator to the whole satellite file with dask instead of 
+    an explicit loop over chunks (EXECUTION: 'dask'). The satellite data 
+    stay lazy and are split into blocks of observations along N_OBS (sized 
+    like the chunks of apply_operator_to_chunks). The colocation, vertical
+    interpolation, and averaging kernel of each block run as one task, 
+    which reads only the model time steps that the block needs, and the 
+    blocks are computed by the DASK_SCHEDULER scheduler ('threads' by 
+    default, 'processes', or 'synchronous') as they are written to the 
+    output file. This lets files that are larger than memory be processed 
+    with N_THREADS // N_WORKERS workers.
+
+    Unlike apply_operator_to_chunks, the observations keep their order in
+    the satellite file, an interrupted file is restarted from scratch, and
+    the model cache and operator store are not used.
+
+    Inputs:
+        conc_catalogs: list with a util.ModelCatalog of the model 
+                       concentration files for each model run
+        edge_catalog: util.ModelCatalog of the model edge files
+        satellite: xarray dataset with (dask-backed) satellite data, 
+                   output from satellite parser in parsers.py
+        config: dictionary with configuration settings
+        output_file: file to write the model columns to
+
+    Returns:
+        output_file, or None if none of the observations overlap the model 
+        times.
+    """
+    local_config = config["LOCAL_SETTINGS"]
+    data_fields = config["MODEL"]["DATA_FIELDS"]
+    time_settings = util.get_time_matching_settings(local_config)
+    runs = None
+    if util.is_batch_mode(local_config):
+        runs = util.get_model_concentration_dirs(local_config)
+    dtype, _ = util.PRECISIONS[util.get_precision(local_config)]
+
+    # Number the observations so that each block keeps its place in the 
+    # output. Then, drop the observations without a model time step up 
+    # front (only the times are read) so that every block keeps its size.
+    satellite = satellite.assign_coords(
+        N_OBS=np.arange(satellite.sizes["N_OBS"]))
+    # The times are in the catalog, unless it was built from the file names
+    model_times = edge_catalog.times
+    if edge_catalog.from_names:
+        model_times = parsers.get_geoschem_times(
+            edge_catalog.get_files(satellite["TIME"].values, **time_settings),
+            data_fields)
+    missing_times = util.get_missing_times(
+        satellite["TIME"], xr.DataArray(model_times, dims="TIME"), 
+        **time_settings)
+    satellite = satellite.isel(N_OBS=np.where(~missing_times.values)[0])
+    if satellite.sizes["N_OBS"] == 0:
+        print("  There are no overlapping satellite and model data.")
         return None
 
+    # Split the observations into blocks
+    n_model_levels, n_tracers = parsers.get_geoschem_sizes(
+        conc_catalogs[0].files[0], data_fields)
+    n_cells = _get_footprint_cells(satellite, edge_catalog, config)
+    chunk_size = util.get_chunk_size(
+        local_config, n_model_levels, satellite.sizes["N_EDGES"], n_tracers,
+        len(conc_catalogs), n_cells.mean() if len(n_cells) > 0 else 1)
+    satellite = satellite.chunk({"N_OBS" : chunk_size})
+    print(f"  Processing {satellite.sizes['N_OBS']} observations in "
+          f"{len(satellite.chunks['N_OBS'])} blocks.")
+
+    # Describe the output of each block
+    conc_vars = parsers.get_geoschem_conc_vars(conc_catalogs[0].files[0], 
+                                               data_fields)
+    shape = (satellite.sizes["N_OBS"], len(conc_vars), len(conc_catalogs))
+    chunks = (satellite.chunks["N_OBS"], -1, -1)
+    template = da.empty(shape, chunks=chunks, dtype=dtype)
+    if runs is None:
+        template = template[:, :, 0]
+    template = operators.get_model_column_dataset(template, conc_vars, 
+                                                  satellite, runs)
+    template = template.rename(_get_model_column_names(template))
+
+    operator_vars = ["TIME", "LATITUDE", "LONGITUDE", "PRESSURE_EDGES", 
+                     "PRESSURE_WEIGHT", "AVERAGING_KERNEL", "PRIOR_PROFILE",
+                     "LATITUDE_BOUNDS", "LONGITUDE_BOUNDS"]
+    operator_vars = [v for v in operator_vars if v in satellite]
+    model_columns = xr.map_blocks(
+        _apply_operator_to_block, satellite[operator_vars], 
+        args=[conc_catalogs, edge_catalog, config, conc_vars, runs],
+        template=template)
+
+    # Add the satellite data and write the output, which computes the blocks
+    # as they are written. The netCDF writer can only be shared between 
+    # threads, so with the 'processes' scheduler the model columns (but not
+    # the satellite data) are computed first.
+    scheduler = str(local_config.get("DASK_SCHEDULER", "threads")).lower()
+    if scheduler not in ["threads", "processes", "synchronous"]:
+        raise ValueError(f"DASK_SCHEDULER must be 'threads', 'processes', "
+                         f"or 'synchronous', not {scheduler}")
+    n_workers = int(os.environ["OMP_NUM_THREADS"])
+    if scheduler == "processes":
+        model_columns = model_columns.compute(scheduler="processes", 
+                                              num_workers=n_workers)
+        scheduler = "threads"
+    if local_config["SAVE_SATELLITE_DATA"].lower() == "true":
+        model_columns = xr.merge([model_columns, 
+                                  _drop_operator_inputs(satellite)])
+    model_columns.attrs.update(parsers.get_filter_attrs(satellite))
+    with dask.config.set(scheduler=scheduler, num_workers=n_workers):
+        model_columns.to_netcdf(f"{output_file}.tmp", format="NETCDF4")
+    os.replace(f"{output_file}.tmp", output_file)
+    return output_file
+
+
+def _apply_operator_to_block(satellite, 
+                             conc_catalogs, 
+                             edge_catalog, 
+                             config, 
+                             conc_vars, 
+                             runs):
+    """ Applies the operator to one block of observations (see 
+    apply_operator_lazily). """
+    local_config = config["LOCAL_SETTINGS"]
+    dtype, _ = util.PRECISIONS[util.get_precision(local_config)]
+    time_settings = util.get_time_matching_settings(local_config)
+    subset = {"obs_times" : satellite["TIME"].values,
+              "time_settings" : time_settings,
+              "dtype" : None if dtype == np.float64 else dtype}
+    if local_config.get("SUBSET_MODEL_DOMAIN", "False").lower() == "true":
+        subset["obs_lats"], subset["obs_lons"] = _get_observation_extent(
+            satellite)
+
+    model_columns = np.empty(
+        (satellite.sizes["N_OBS"], len(conc_vars), len(conc_catalogs)), 
+        dtype=dtype)
+    for r in range(len(conc_catalogs)):
+        if r == 0:
+            model = parsers.read_geoschem_file(
+                conc_catalogs[0].get_files(subset["obs_times"], 
+                                           **time_settings),
+                edge_catalog.get_files(subset["obs_times"], **time_settings),
+                config["MODEL"]["DATA_FIELDS"], **subset)
+            operator = operators.get_observation_operator(model, satellite, 
+                                                          config)
+        else:
+            model = parsers.read_geoschem_conc_file(
+                conc_catalogs[r].get_files(subset["obs_times"], 
+                                           **time_settings),
+                config["MODEL"]["DATA_FIELDS"], **subset)
+        block_size = util.get_tracer_block_size(
+            local_config, operator.n_profiles, 
+            operator.n_model_levels, len(conc_vars))
+        operator.apply_to_model(model, conc_vars, block_size, 
+                                out=model_columns[:, :, r])
+        del model
+
+    if runs is None:
+        model_columns = model_columns[:, :, 0]
+    model_columns = operators.get_model_column_dataset(
+        model_columns, conc_vars, satellite, runs)
+    return model_columns.rename(_get_model_column_names(model_columns))
+
+
+def _get_footprint_cells(satellite, edge_catalog, config):
+    """ Gets the number of model grid cells that each footprint may overlap
+    (see util.get_footprint_cells), or an empty array without footprint 
+    sampling. """
+    if util.get_horizontal_sampling(config["LOCAL_SETTINGS"]) != "footprint":
+        return np.ones(0, dtype=int)
+    model_lats, model_lons = parsers.get_geoschem_grid(
+        edge_catalog.files[0], config["MODEL"]["DATA_FIELDS"])
+    return util.get_footprint_cells(
+        model_lats, model_lons, satellite["LATITUDE_BOUNDS"].values,
+        satellite["LONGITUDE_BOUNDS"].values)
+
+
+def _get_observation_extent(satellite):
+    """ Gets the latitudes and longitudes that the model domain needs to 
+    cover (with SUBSET_MODEL_DOMAIN): the observation centers and, with 
+    footprint sampling, the corners of their footprints. """
+    lats = [satellite["LATITUDE"].values]
+    lons = [satellite["LONGITUDE"].values]
+    if "LATITUDE_BOUNDS" in satellite:
+        lats.append(satellite["LATITUDE_BOUNDS"].values.ravel())
+        lons.append(satellite["LONGITUDE_BOUNDS"].values.ravel())
+    return np.concatenate(lats), np.concatenate(lons)
+
+
+def _get_model_column_names(model_columns):
+    """ Renames the CONC_AT_PRESSURE_CENTERS variables to MODEL_COLUMN. """
+    return {v : v.replace('CONC_AT_PRESSURE_CENTERS', 'MODEL_COLUMN')
+            for v in model_columns.data_vars}
+
+
+def _drop_operator_inputs(satellite):
+    """ Drops the satellite variables that are only needed to build the 
+    operator (they are not saved with SAVE_SATELLITE_DATA). """
+    drop_vars = ["PRESSURE_EDGES", "PRESSURE_WEIGHT",
+                 "AVERAGING_KERNEL", "PRIOR_PROFILE",
+                 "LATITUDE_BOUNDS", "LONGITUDE_BOUNDS",
+                 "N_EDGES", "N_LAYERS"]
+    drop_vars = [v for v in drop_vars if v in satellite.data_vars]
+    return satellite.drop_vars(drop_vars)
+
 
 if __name__ == "__main__":
     # Run the operator
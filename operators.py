@@ -1,63 +1,474 @@
+import os
+import json
+import shutil
 import numpy as np
 import xarray as xr
 from interpolation import VerticalGrid
 import utilities as util
+import instrumentation
+import kernels
 
-def apply_averaging_kernel(model_on_satellite_levels, satellite):
-    model_column = np.sum(satellite["PRESSURE_WEIGHT"].values[:, :, None]
-                          * (satellite["PRIOR_PROFILE"].values[:, :, None] 
-                             + satellite["AVERAGING_KERNEL"].values[:, :, None]
-                             * (model_on_satellite_levels 
-                                - satellite["PRIOR_PROFILE"].values[:, :, None])),
-                                axis=1)
-    return  model_column
+class ObservationOperator:
+    """
+    For a fixed satellite geometry, the vertical interpolation and the 
+    averaging kernel are both linear in the model profile, so the model 
+    column for each observation is 
+
+        column = c + h . x
+
+    where x is the colocated model profile (nobs x n_model_levels), h is 
+    an n_model_levels vector per observation, and c is the prior term. The
+    operator is built once per chunk and can then be applied to any number 
+    of tracers or model runs with a single batched dot product.
+
+    h:   nobs x n_model_levels
+    c:   nobs
+    idx: xarray dataset with the time, lat, and lon indices (N_OBS) linking 
+         each observation to the model grid (see util.get_colocation_indices;
+         there is one index per grid dimension on curvilinear grids)
+    precision: PRECISION used to store h and c and to accumulate the model 
+               columns (see util.PRECISIONS)
 
+    With footprint sampling, each observation is linked to the model grid 
+    cells that its footprint overlaps, with one entry in idx per pair of an
+    observation and a cell (N_PAIRS, sorted by observation, see 
+    util.get_footprint_indices). h (npairs x n_model_levels) includes the 
+    weight of each cell, and the pairs are summed for each observation, so
+    that
 
-def get_model_columns(model, satellite, config, save_dir):
+        column = c + sum over cells of h[cell] . x[cell]
     """
-    generic function to apply an operator to a satellite
-    takes:
-        - GEOS-Chem dataframe (not a problem b/c this is standard)
-        - all required satellite inputs as np arrays
+
+    def __init__(self, h, c, idx, precision="float64"):
+        self.h = h
+        self.c = c
+        self.idx = idx
+        self.precision = precision
+        self.n_obs = len(self.c)
+        self.n_profiles = self.h.shape[0]
+        self.n_model_levels = self.h.shape[-1]
+
+        # The first pair of each observation with footprint sampling
+        self.starts = None
+        if "obs" in idx:
+            self.starts = np.searchsorted(idx["obs"].values, 
+                                          np.arange(self.n_obs))
+
+    @classmethod
+    def build(cls, model, satellite, avker_center_or_edges, save_dir=None,
+              time_matching="floor", time_step=None, backend="numpy",
+              precision="float64", footprint=False, spatial_index_dir=None):
+        """
+        Builds the operator from the model pressure edges and the satellite
+        pressure edges, pressure weights, prior, and averaging kernel. 
+        time_matching and time_step are passed to util.get_time_index. With
+        the 'numba' backend, h and c are computed by a compiled kernel 
+        without the intermediate interpolation map (see kernels.py). With 
+        the 'float32' or 'mixed' precision, the interpolation map, h, and c
+        are float32, and 'mixed' sums the averaging kernel terms in float64.
+
+        If footprint is True, the operator is built for every pair of an 
+        observation and a model grid cell that its footprint overlaps, with
+        that cell's pressure edges, and the pairs are weighted by the 
+        fraction of the footprint in the cell (see 
+        util.get_footprint_indices). The model column is then the 
+        area-weighted mean of the columns in each cell, as in the IMI.
+
+        spatial_index_dir is where the spatial index of a curvilinear model
+        grid is saved (see util.SpatialIndex).
+        """
+        n_obs = satellite.sizes["N_OBS"]
+        dtype, _ = util.PRECISIONS[precision]
+        with instrumentation.stage("colocation", n_obs):
+            idx = util.get_colocation_indices(model, satellite, save_dir,
+                                              time_matching, time_step,
+                                              footprint, spatial_index_dir)
+            model_edges = model["PRESSURE_EDGES"].isel(
+                util.get_model_indexers(model, idx))
+            model_edges = model_edges.transpose(
+                *util.get_colocated_dims(idx), ...).values
+
+        if not footprint:
+            h, c = cls._build_components(model_edges, satellite, 
+                                         avker_center_or_edges, backend,
+                                         precision)
+            return cls(h, c, idx, precision)
+
+        # Build the operator for each observation and cell pair, and weight
+        # h and c by the fraction of the footprint in each cell
+        obs = idx["obs"].values
+        weight = idx["weight"].values
+        h, c_pairs = cls._build_components(
+            model_edges, satellite.isel(N_OBS=obs), avker_center_or_edges,
+            backend, precision)
+        h = (weight[:, None] * h).astype(dtype, copy=False)
+        c = np.bincount(obs, weights=weight * c_pairs, 
+                        minlength=n_obs).astype(dtype, copy=False)
+        return cls(h, c, idx, precision)
+
+    @staticmethod
+    def _build_components(model_edges, satellite, avker_center_or_edges,
+                          backend="numpy", precision="float64"):
+        """
+        Gets h and c (see build) for colocated model pressure edges 
+        (nobs x n_model_edges).
+        """
+        n_obs = satellite.sizes["N_OBS"]
+        dtype, accumulate_dtype = util.PRECISIONS[precision]
+        if backend == "numba":
+            with instrumentation.stage("fused_kernel", n_obs):
+                h, c = kernels.build_operator(
+                    model_edges,
+                    satellite["PRESSURE_EDGES"].values,
+                    satellite["PRESSURE_WEIGHT"].values,
+                    satellite["AVERAGING_KERNEL"].values,
+                    satellite["PRIOR_PROFILE"].values,
+                    avker_center_or_edges)
+            return h.astype(dtype, copy=False), c.astype(dtype, copy=False)
+
+        # Get the interpolation map from model layers to satellite partial
+        # columns and the conversion from partial columns to concentrations
+        with instrumentation.stage("interpolation_map", n_obs):
+            interpolation_map, partial_column_to_conc = VerticalGrid(
+                None,
+                model_edges,
+                satellite["PRESSURE_EDGES"].values,
+                avker_center_or_edges,
+                "False",
+                None,
+                dtype=None if precision == "float64" else dtype
+            ).get_interpolation_components()
+
+        # Expand the averaging kernel equation:
+        # sum(w * (prior + A * (x_sat - prior))) 
+        #   = sum(w * (1 - A) * prior) + sum(w * A * x_sat)
+        # and x_sat = M_out* W M_in x, so that we can collapse everything 
+        # that multiplies x onto the model levels.
+        with instrumentation.stage("averaging_kernel", n_obs):
+            pressure_weight = satellite["PRESSURE_WEIGHT"].values
+            averaging_kernel = satellite["AVERAGING_KERNEL"].values
+            prior_profile = satellite["PRIOR_PROFILE"].values
+            satellite_weight = (pressure_weight * averaging_kernel 
+                                * partial_column_to_conc)
+            c = np.sum(
+                pressure_weight * (1 - averaging_kernel) * prior_profile, 
+                axis=1, dtype=accumulate_dtype).astype(dtype, copy=False)
+
+            n_model_levels = model_edges.shape[1] - 1
+            if interpolation_map.dtype.names is None:
+                h = np.einsum("oms,os->om", interpolation_map, 
+                              satellite_weight, dtype=accumulate_dtype,
+                              casting="same_kind")
+            else:
+                # Sum the weight of every overlapping segment onto its model
+                # level
+                segment_weight = (
+                    interpolation_map["weight"] 
+                    * np.take_along_axis(satellite_weight, 
+                                         interpolation_map["satellite_index"],
+                                         axis=1))
+                target = (np.arange(n_obs)[:, None] * n_model_levels 
+                          + interpolation_map["model_index"])
+                h = np.bincount(target.ravel(), 
+                                weights=segment_weight.ravel(),
+                                minlength=n_obs * n_model_levels)
+                h = h.reshape((n_obs, n_model_levels))
+            h = h.astype(dtype, copy=False)
+
+        return h, c
+
+    def apply(self, model_conc_at_layers):
+        """
+        Applies the operator to colocated model concentrations with 
+        dimension (nobs x n_model_levels x ...), or 
+        (npairs x n_model_levels x ...) with footprint sampling, where the 
+        trailing dimensions can be any number of tracers or model runs. 
+        Returns the model columns (nobs x ...). The sum over the model 
+        levels (and the cells of each footprint) is done in the accumulation
+        dtype of the precision, without copying the inputs.
+        """
+        _, accumulate_dtype = util.PRECISIONS[self.precision]
+        model_columns = np.einsum("pl,pl...->p...", 
+                                  self.h, model_conc_at_layers,
+                                  dtype=accumulate_dtype, casting="same_kind")
+        if self.starts is not None and self.n_obs > 0:
+            model_columns = np.add.reduceat(model_columns, self.starts, 
+                                            axis=0)
+        c = self.c.reshape(self.c.shape + (1,)*(model_columns.ndim - 1))
+        return c.astype(accumulate_dtype, copy=False) + model_columns
+
+    def apply_to_model(self, model, conc_vars, block_size=None, out=None):
+        """
+        Colocates the model concentration variables conc_vars with the 
+        observations and applies the operator. Returns the model columns
+        (nobs x len(conc_vars)).
+
+        The tracers are colocated block_size at a time (all at once by 
+        default, see util.get_tracer_block_size), so the colocated profiles
+        never take more than n_profiles x n_model_levels x block_size. 
+        The model columns are written to out if it is given (e.g., a slice 
+        of a preallocated nobs x len(conc_vars) x n_runs array). The colocated
+        profiles and the model columns are stored in the precision's storage
+        dtype.
+        """
+        dtype, _ = util.PRECISIONS[self.precision]
+        n_tracers = len(conc_vars)
+        if block_size is None:
+            block_size = n_tracers
+        block_size = max(min(block_size, n_tracers), 1)
+        if out is None:
+            out = np.empty((self.n_obs, n_tracers), dtype=dtype)
+
+        # The colocated profiles of each block are copied into the same 
+        # buffer
+        block = np.empty(self.h.shape + (block_size,), dtype=dtype)
+        for start in range(0, n_tracers, block_size):
+            block_vars = conc_vars[start:start + block_size]
+            colocated = model[block_vars].isel(
+                util.get_model_indexers(model, self.idx))
+            for k, v in enumerate(block_vars):
+                block[..., k] = colocated[v].transpose(
+                    *util.get_colocated_dims(self.idx), ...).values
+            del colocated
+            out[:, start:start + len(block_vars)] = self.apply(
+                block[..., :len(block_vars)])
+        return out
+
+
+class OperatorStore:
+    """
+    Stores the observation operator for every observation in a satellite 
+    file in one directory (one .npy file per component), so that it can be
+    reused by Jacobian simulations. The components are keyed by the 
+    observation index in the satellite file rather than by chunk, so the 
+    store can be used with any chunking, and they are memory-mapped so that
+    each chunk only reads its own rows. 
+
+    h:     N_OBS x n_model_levels
+    c:     N_OBS
+    time, lat, lon: the model time and grid cell centers matched to each 
+                    observation. These are stored as values rather than
+                    indices because the indices depend on which part of 
+                    the model grid was read. On curvilinear grids, lat and 
+                    lon are replaced by the position of the grid cell 
+                    along each of the grid dimensions named in horizontal
+                    (e.g., face, y, and x, see util.HORIZONTAL_DIMS).
+    valid: N_OBS, whether each observation has been computed
+
+    With footprint sampling, n_cells (N_OBS) is the number of model grid 
+    cells that each footprint can overlap (see util.get_footprint_cells). 
+    The observation and cell pairs of each observation (see 
+    util.get_footprint_indices) are stored in the n_cells rows that start 
+    at offset[obs], so h is sum(n_cells) x n_model_levels, and time, lat, 
+    lon, and the footprint weights (weight) are sum(n_cells). n_pairs 
+    (N_OBS) is the number of rows that each observation uses.
+
+    A fingerprint of the satellite geometry, the model grid, and the 
+    settings used to build the operator is kept in meta.json. If it does not
+    match, the store is stale and is rebuilt. h and c are stored in the 
+    storage dtype of precision (see util.PRECISIONS).
+    """
+
+    def __init__(self, store_dir, n_obs, n_model_levels, fingerprint,
+                 precision="float64", n_cells=None, 
+                 horizontal=("lat", "lon")):
+        self.store_dir = store_dir
+        self.precision = precision
+        self.n_cells = n_cells
+        self.horizontal = list(horizontal)
+        dtype, _ = util.PRECISIONS[precision]
+        meta_file = f"{store_dir}/meta.json"
+        meta = {"fingerprint" : fingerprint, "n_obs" : int(n_obs), 
+                "n_model_levels" : int(n_model_levels), 
+                "dtype" : np.dtype(dtype).name}
+        n_rows = n_obs
+        if n_cells is not None:
+            self.offset = np.concatenate([[0], np.cumsum(n_cells)])
+            n_rows = int(self.offset[-1])
+            meta["n_rows"] = n_rows
+        shapes = {"h" : ((n_rows, n_model_levels), dtype),
+                  "c" : ((n_obs,), dtype),
+                  "time" : ((n_rows,), "datetime64[ns]"),
+                  **{name : ((n_rows,), np.float64) 
+                     for name in self.horizontal},
+                  "valid" : ((n_obs,), bool)}
+        if n_cells is not None:
+            shapes["weight"] = ((n_rows,), np.float64)
+            shapes["n_pairs"] = ((n_obs,), np.int64)
+
+        stored_meta = None
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                stored_meta = json.load(f)
+
+        self.components = {}
+        if stored_meta == meta:
+            for name in shapes:
+                self.components[name] = np.load(
+                    f"{store_dir}/{name}.npy", mmap_mode="r+")
+            print(f"  Using operator components in {store_dir} "
+                  f"({self.components['valid'].sum()} of {n_obs} "
+                  f"observations).")
+        else:
+            if stored_meta is not None:
+                print(f"  Operator components in {store_dir} are stale. "
+                      f"Rebuilding.")
+            shutil.rmtree(store_dir, ignore_errors=True)
+            os.makedirs(store_dir)
+            for name, (shape, dtype) in shapes.items():
+                self.components[name] = np.lib.format.open_memmap(
+                    f"{store_dir}/{name}.npy", mode="w+", dtype=dtype, 
+                    shape=shape)
+            self.components["valid"][:] = False
+            self.components["valid"].flush()
+            with open(meta_file, "w") as f:
+                json.dump(meta, f, indent=1)
+
+    def get(self, obs_idx, model):
+        """
+        Gets the ObservationOperator for the observations obs_idx, with the 
+        colocation indices into model. Returns None if any of the 
+        observations have not been stored or their model grid cells are not
+        in model.
+        """
+        if not np.all(self.components["valid"][obs_idx]):
+            return None
+        rows = obs_idx
+        values = {}
+        if self.n_cells is not None:
+            n_pairs = self.components["n_pairs"][obs_idx]
+            rows = self._get_rows(obs_idx, n_pairs)
+            values["obs"] = np.repeat(np.arange(len(n_pairs)), n_pairs)
+        for name in ["time", *self.horizontal, "weight"]:
+            if name in self.components:
+                values[name] = self.components[name][rows]
+        idx = util.get_colocation_indices_from_values(model, values)
+        if idx is None:
+            return None
+        return ObservationOperator(np.asarray(self.components["h"][rows]),
+                                   np.asarray(self.components["c"][obs_idx]),
+                                   idx, self.precision)
+
+    def put(self, obs_idx, operator, model):
+        """
+        Stores the ObservationOperator for the observations obs_idx. The 
+        valid flags are written last so that an interrupted write is never
+        used.
+        """
+        values = util.get_colocation_values(model, operator.idx)
+        values["h"] = operator.h
+        rows = obs_idx
+        if self.n_cells is not None:
+            n_pairs = np.bincount(values.pop("obs"), minlength=len(obs_idx))
+            if np.any(n_pairs > self.n_cells[obs_idx]):
+                raise ValueError("The operator has more cells per "
+                                 "observation than the store.")
+            rows = self._get_rows(obs_idx, n_pairs)
+            self.components["n_pairs"][obs_idx] = n_pairs
+            self.components["n_pairs"].flush()
+        for name, value in values.items():
+            self.components[name][rows] = value
+            self.components[name].flush()
+        self.components["c"][obs_idx] = operator.c
+        self.components["c"].flush()
+        self.components["valid"][obs_idx] = True
+        self.components["valid"].flush()
+
+    def _get_rows(self, obs_idx, n_pairs):
+        """
+        Gets the rows of the first n_pairs pairs of each of the observations
+        obs_idx (footprint sampling only).
+        """
+        first = np.cumsum(n_pairs) - n_pairs
+        return (np.repeat(self.offset[obs_idx] - first, n_pairs) 
+                + np.arange(n_pairs.sum()))
+
+
+def get_observation_operator(model, satellite, config, store=None, 
+                             obs_idx=None):
+    """
+    Gets the ObservationOperator for a chunk of satellite observations. If
+    an OperatorStore is given (SAVE_INTERPOLATION), the operator for the 
+    observations obs_idx (their indices in the satellite file) is loaded 
+    from the store if it is there, and is otherwise built and stored.
     """
     satellite_name = config["LOCAL_SETTINGS"]["SATELLITE_NAME"]
     avker_center_or_edges = config[satellite_name][
         "AVERAGING_KERNEL_USES_CENTERS_OR_EDGES"
     ]
-    save_interpolation = config["LOCAL_SETTINGS"]["SAVE_INTERPOLATION"]
-
-    # Get the spatial and temporal indices linking each satellite observation
-    # back to the model grid and apply them to the model data
-    if save_interpolation.lower() == "true":
-        model = util.colocate_obs(model, satellite, save_dir)
-    else:
-        model = util.colocate_obs(model, satellite)
-
-    # Create an instance of the VerticalGrid class and interpolate the model
-    # onto satellite levels
-    conc_vars = [
+    time_settings = util.get_time_matching_settings(config["LOCAL_SETTINGS"])
+    backend = kernels.get_backend(config["LOCAL_SETTINGS"])
+    precision = util.get_precision(config["LOCAL_SETTINGS"])
+    footprint = (util.get_horizontal_sampling(config["LOCAL_SETTINGS"]) 
+                 == "footprint")
+    spatial_index_dir = util.get_spatial_index_dir(config["LOCAL_SETTINGS"])
+
+    # Load the observation operator if it was stored (e.g., for Jacobian 
+    # simulations). Otherwise, get the spatial and temporal indices linking
+    # each satellite observation back to the model grid and combine the 
+    # vertical interpolation and the averaging kernel into one operator.
+    if store is not None:
+        with instrumentation.stage("operator_load", len(obs_idx)):
+            operator = store.get(obs_idx, model)
+        if operator is not None:
+            print("  Using pre-computed observation operator.")
+            return operator
+
+    operator = ObservationOperator.build(
+        model, satellite, avker_center_or_edges, backend=backend, 
+        precision=precision, footprint=footprint, 
+        spatial_index_dir=spatial_index_dir, **time_settings)
+    if store is not None:
+        with instrumentation.stage("operator_save", len(obs_idx)):
+            store.put(obs_idx, operator, model)
+    return operator
+
+
+def get_conc_vars(model):
+    """
+    Gets the names of the model concentration variables (one per tracer).
+    """
+    return [
         v for v in model.variables 
         if v[:len("CONC_AT_PRESSURE_CENTERS")] == "CONC_AT_PRESSURE_CENTERS"]
-    # all_model_columns = xr.Dataset(coords={"N_OBS" : satellite["N_OBS"]})
-    model_on_satellite_levels = VerticalGrid(
-        np.stack([model[v].values for v in conc_vars], axis=-1),
-        model["PRESSURE_EDGES"].values,
-        satellite["PRESSURE_EDGES"].values,
-        avker_center_or_edges,
-        save_interpolation,
-        save_dir)
-    model_on_satellite_levels = model_on_satellite_levels.interpolate()
-
-    # Apply the averaging kernel
-    model_columns = apply_averaging_kernel(model_on_satellite_levels, satellite)
-    model_columns = xr.Dataset(
-        {v: (['N_OBS'], model_columns[:, i]) for i, v in enumerate(conc_vars)},
-        coords={'N_OBS': satellite["N_OBS"]})
-    return model_columns
-
-
-def regrid_gc_to_sat_pixels(sat_lat, sat_lon, gc_lat, gc_lon):
-    pass
-    # calculate pixels which overlap each satellite observation
-    # this is what the IMI does
-    # assumes model pixel size is close to satellite pixel size
+
+
+def get_model_column_dataset(model_columns, conc_vars, satellite, runs=None):
+    """
+    Builds an xarray dataset from the model columns returned by 
+    ObservationOperator.apply_to_model (nobs x len(conc_vars)). In batch
+    mode, the columns for each model run are stacked along the last 
+    dimension (nobs x len(conc_vars) x len(runs)) and each variable has 
+    dimensions (N_OBS, N_RUNS).
+    """
+    coords = {'N_OBS': satellite["N_OBS"]}
+    if runs is None:
+        return xr.Dataset(
+            {v: (['N_OBS'], model_columns[:, i]) 
+             for i, v in enumerate(conc_vars)},
+            coords=coords)
+    coords["N_RUNS"] = runs
+    return xr.Dataset(
+        {v: (['N_OBS', 'N_RUNS'], model_columns[:, i, :]) 
+         for i, v in enumerate(conc_vars)},
+        coords=coords)
+
+
+def get_model_columns(model, satellite, config, store=None, obs_idx=None):
+    """
+    generic function to apply an operator to a satellite
+    takes:
+        - GEOS-Chem dataframe (not a problem b/c this is standard)
+        - all required satellite inputs as np arrays
+    """
+    operator = get_observation_operator(model, satellite, config, store, 
+                                        obs_idx)
+
+    # Apply the operator to the tracers in blocks that fit in 
+    # TRACER_MEMORY_BUDGET
+    conc_vars = get_conc_vars(model)
+    block_size = util.get_tracer_block_size(
+        config["LOCAL_SETTINGS"], operator.n_profiles, 
+        operator.n_model_levels, len(conc_vars))
+    model_columns = operator.apply_to_model(model, conc_vars, block_size)
+    return get_model_column_dataset(model_columns, conc_vars, satellite)
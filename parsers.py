@@ -3,65 +3,341 @@ import numpy as np
 import pandas as pd
 import re
 import inspect
+from collections import OrderedDict
 from interpolation import VerticalGrid
+import utilities as util
 
-def _open_geoschem(file_path, variables):
-    # Open the dataset
-    # data = xr.open_mfdataset(file_path, parallel=True)
-    data = []
-    for f in file_path:
-        data.append(xr.open_dataset(f).compute())
-    data = xr.concat(data, dim="time", data_vars="all")
-
-    # Now we get the variables we want, accounting for regex options. We also 
-    # save out a dictionary that will rename the variables as needed to the 
-    # standard names.
+def _get_geoschem_variables(model_variables, variables):
+    '''
+    Gets a dictionary that renames the GEOS-Chem variables we want to the 
+    standard names, accounting for regex options.
+    '''
     save_vars = {}
     for default_name, var_pattern in variables.items():
         # If the item looks like a regex (contains special characters like "*"), 
         # treat it as regex
         if re.search(r"[\*]", var_pattern):
+            prefix = var_pattern.split(".*")[0]
             save_vars.update(
-                {var : 
-                 f"{default_name}_{var.split(var_pattern.split(".*")[0])[-1]}" 
-                 for var in data.variables if re.match(var_pattern, var)})
+                {var : f"{default_name}_{var.split(prefix)[-1]}" 
+                 for var in model_variables if re.match(var_pattern, var)})
         else:
             # If it"s an exact match, check if it"s in the dataset
-            if var_pattern in data.variables:
+            if var_pattern in model_variables:
                 save_vars.update({var_pattern : default_name})
+    return save_vars
+
+
+class ModelCache:
+    '''
+    In-process cache of GEOS-Chem files keyed by file path, the variables
+    read from them, and the box of grid cells that was read (the whole grid 
+    unless SUBSET_MODEL_DOMAIN is set). The same day of model output is 
+    needed by every satellite file (e.g., ~14 TROPOMI orbits per day) and 
+    every chunk that falls on that day, so we keep the needed variables of 
+    recently used files in memory. When the cache is larger than max_bytes,
+    the least recently used files are evicted.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        # Files that are larger than the whole cache are not stored
+        if data.nbytes > self.max_bytes:
+            return
+        while self.n_bytes + data.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+            self.evictions += 1
+        self.entries[key] = data
+        self.n_bytes += data.nbytes
+
+    def stats(self):
+        return {"hits" : self.hits, "misses" : self.misses, 
+                "evictions" : self.evictions, "entries" : len(self.entries),
+                "bytes" : self.n_bytes}
+
+    def __str__(self):
+        return (f"Model cache: {self.hits} hits, {self.misses} misses, "
+                f"{self.evictions} evictions, {len(self.entries)} files "
+                f"({self.n_bytes/1e9:.2f} of {self.max_bytes/1e9:.2f} GB)")
+
+
+def _get_dtype(variable, dtype=None):
+    '''
+    Gets the dtype to store a variable in: dtype for floating point 
+    variables if it is given and the variable's own dtype otherwise.
+    '''
+    if dtype is not None and variable.dtype.kind == "f":
+        return dtype
+    return variable.dtype
+
 
-    # Return the subsetted data
-    return data[save_vars.keys()].rename(save_vars)
+def _read_geoschem_box(ds, file_path, names, box, cache=None):
+    '''
+    Gets the variables names in the box of grid cells box (a slice per 
+    grid dimension) from the lazily opened GEOS-Chem file ds. If a 
+    ModelCache is given, every time step of the box is loaded into the 
+    cache, keyed by the file, the variables, and the box, so that the 
+    cache holds no more of the grid than SUBSET_MODEL_DOMAIN reads. The 
+    time steps are not part of the key because each satellite file and 
+    chunk needs different time steps of the same file.
+    '''
+    if cache is None:
+        return ds[names].isel(box)
+
+    key = (file_path, tuple(names), 
+           tuple((d, s.start, s.stop) for d, s in sorted(box.items())))
+    data = cache.get(key)
+    if data is None:
+        data = ds[names].isel(box).load()
+        cache.put(key, data)
+    return data
+
+
+def _open_geoschem(file_path, variables, obs_times=None, 
+                   obs_lats=None, obs_lons=None, time_settings=None,
+                   cache=None, dtype=None):
+    '''
+    Reads the GEOS-Chem variables in `variables` from the files in 
+    file_path. The files are opened lazily and the variables we need are 
+    worked out from the regex before anything is loaded. 
+    
+    If obs_times is given, only the model time steps that contain an 
+    observation are read (see util.get_time_index, which uses 
+    time_settings). If obs_lats and obs_lons are given, only the box of 
+    model grid cells that contains the observations is read (except on 
+    curvilinear grids, see below). The data are written into one 
+    preallocated array per variable. If a ModelCache is given, the box of 
+    each file is read through the cache. If dtype is given (e.g., np.float32, see 
+    util.PRECISIONS), the floating point variables are read into arrays of
+    that dtype.
+
+    On curvilinear grids, such as the GCHP cubed-sphere grid, LATITUDE and
+    LONGITUDE are 2D or 3D. The grid dimensions are renamed to the standard
+    names in util.HORIZONTAL_DIMS (e.g., nf, Ydim, and Xdim to FACE, Y, and
+    X), with the position of each cell as the coordinate, and LATITUDE and
+    LONGITUDE are coordinates on those dimensions. The observations are 
+    colocated with a spatial index of the whole grid (see util.SpatialIndex),
+    so the whole grid is read.
+    '''
+    if time_settings is None:
+        time_settings = {}
+    time_name = variables["TIME"]
+    lat_name = variables["LATITUDE"]
+    lon_name = variables["LONGITUDE"]
+
+    # Open the files lazily and get the variables we want
+    datasets = [xr.open_dataset(f) for f in file_path]
+    save_vars = _get_geoschem_variables(datasets[0].variables, variables)
+    curvilinear = datasets[0][lat_name].ndim > 1
+
+    # Work out which time steps we need from each file
+    file_times = [ds[time_name].values for ds in datasets]
+    all_times = np.concatenate(file_times)
+    time_step = util.get_model_time_step(all_times, 
+                                         time_settings.get("time_step"))
+    keep_times = np.ones(len(all_times), dtype=bool)
+    if obs_times is not None:
+        time_idx = util.get_time_index(
+            obs_times, all_times, 
+            time_settings.get("time_matching", "floor"), time_step)
+        keep_times[:] = False
+        keep_times[time_idx[time_idx >= 0]] = True
+
+    # Work out the box of grid cells that contains the observations. We keep
+    # a margin of two grid cells so that the grid spacing (and the 
+    # half-polar boxes) are still recognized when colocating on the subset.
+    # On a global grid, observations that may wrap around +/-180 need the 
+    # full longitude range.
+    spatial_subset = {}
+    if (obs_lats is not None and obs_lons is not None and len(obs_lats) > 0
+        and not curvilinear):
+        for name, obs in [(lat_name, obs_lats), (lon_name, obs_lons)]:
+            centers = datasets[0][name].values
+            periodic = (name == lon_name) and util.is_global_longitude(centers)
+            idx = util.get_grid_index(centers, obs, periodic=periodic, 
+                                      xarray=False)
+            start = max(idx.min() - 2, 0)
+            stop = min(idx.max() + 3, len(centers))
+            if periodic and np.any((obs < centers.min()) 
+                                   | (obs > centers.max())):
+                start, stop = 0, len(centers)
+            spatial_subset[name] = slice(start, stop)
+
+    # Preallocate the output. On curvilinear grids, the latitudes and 
+    # longitudes are variables, which we keep as coordinates.
+    first = datasets[0][list(save_vars)].isel(spatial_subset)
+    if curvilinear:
+        first = first.set_coords([lat_name, lon_name])
+    data = {}
+    for v in save_vars:
+        if (v in first.data_vars) and (time_name in first[v].dims):
+            shape = tuple(int(keep_times.sum()) if d == time_name else n
+                          for d, n in first[v].sizes.items())
+            data[v] = np.empty(shape, dtype=_get_dtype(first[v], dtype))
+
+    # Read the time steps that we need from each file
+    i = 0
+    n_read = 0
+    for f, ds, times in zip(file_path, datasets, file_times):
+        file_keep = np.where(keep_times[i:i + len(times)])[0]
+        i += len(times)
+        if len(file_keep) > 0:
+            subset = _read_geoschem_box(
+                ds, f, list(data), spatial_subset, 
+                cache).isel({time_name : file_keep})
+            for v in data:
+                axis = first[v].dims.index(time_name)
+                index = [slice(None)] * data[v].ndim
+                index[axis] = slice(n_read, n_read + len(file_keep))
+                data[v][tuple(index)] = subset[v].values
+            n_read += len(file_keep)
+        ds.close()
+
+    # Build the dataset
+    coords = {k : v.load() for k, v in first.coords.items() 
+              if time_name not in v.dims}
+    coords[time_name] = (time_name, all_times[keep_times], 
+                         first[time_name].attrs)
+    gc = xr.Dataset(
+        {v : (first[v].dims, data[v], first[v].attrs) for v in data},
+        coords=coords)
+    gc = gc.assign({v : first[v].load().astype(_get_dtype(first[v], dtype),
+                                               copy=False)
+                    for v in first.data_vars if v not in data})
+
+    # Return the subsetted data. We also keep track of the model time step
+    # because the time steps that we read may not be contiguous.
+    gc = gc[list(save_vars)].rename(save_vars)
+    gc["TIME"].attrs["time_step"] = str(pd.Timedelta(time_step))
+    if curvilinear:
+        dims = list(util.HORIZONTAL_DIMS[gc["LATITUDE"].ndim].values())
+        gc = gc.rename(dict(zip(gc["LATITUDE"].dims, dims)))
+        gc = gc.assign_coords({d : np.arange(gc.sizes[d]) for d in dims})
+    return gc
 
 
-def read_geoschem_file(file_path_conc, file_path_edges, data_fields):
+def get_geoschem_sizes(file_path, data_fields):
+    '''
+    Gets the number of model levels and the number of tracers matching
+    CONC_AT_PRESSURE_CENTERS in a GEOS-Chem concentration file without 
+    loading any data.
+    '''
+    with xr.open_dataset(file_path) as f:
+        conc_vars = _get_geoschem_variables(
+            f.variables, 
+            {"CONC_AT_PRESSURE_CENTERS" : 
+             data_fields["CONC_AT_PRESSURE_CENTERS"]})
+        return f.sizes[data_fields["LEV"]], len(conc_vars)
+
+
+def get_geoschem_conc_vars(file_path, data_fields):
+    '''
+    Gets the standard names of the tracers matching CONC_AT_PRESSURE_CENTERS
+    (e.g., CONC_AT_PRESSURE_CENTERS_CH4) in a GEOS-Chem concentration file,
+    in the order they are read, without loading any data.
+    '''
+    with xr.open_dataset(file_path) as f:
+        conc_vars = _get_geoschem_variables(
+            f.variables, 
+            {"CONC_AT_PRESSURE_CENTERS" : 
+             data_fields["CONC_AT_PRESSURE_CENTERS"]})
+        return list(conc_vars.values())
+
+
+def get_geoschem_times(file_paths, data_fields):
+    '''
+    Gets the model times in the GEOS-Chem files without loading any other
+    data.
+    '''
+    times = []
+    for file_path in file_paths:
+        with xr.open_dataset(file_path) as f:
+            times.append(f[data_fields["TIME"]].values)
+    return np.concatenate(times)
+
+
+def get_geoschem_grid(file_path, data_fields):
+    '''
+    Gets the model latitude and longitude centers from a GEOS-Chem file 
+    without loading any other data. These are 2D or 3D on curvilinear 
+    grids (e.g., nf x Ydim x Xdim for GCHP).
+    '''
+    with xr.open_dataset(file_path) as f:
+        return (f[data_fields["LATITUDE"]].values, 
+                f[data_fields["LONGITUDE"]].values)
+
+
+def read_geoschem_file(file_path_conc, file_path_edges, data_fields, 
+                       obs_times=None, obs_lats=None, obs_lons=None, 
+                       time_settings=None, cache=None, dtype=None):
     '''
     Eventually, this should be switched to a gcpy function. 
     From Elise:
         read_gc_file = read_geoschem_file 
         # use gcpy function for reading GEOS-Chem files, may need to wrap
+
+    obs_times, obs_lats, obs_lons, and time_settings are optional and are
+    used to read only the model data around the observations. cache is an 
+    optional ModelCache and dtype an optional floating point dtype (see 
+    _open_geoschem).
     '''
     # Define the variables that should be maintained when opening the files
-    ## For concentration files, keep everything except PRESSURE_EDGES. Also,
-    ## get rid of CONC_AT_PRESSURE_CENTERS for edge files.
-    conc_vars = dict(data_fields)
-    del conc_vars["PRESSURE_EDGES"]
-
+    ## Get rid of CONC_AT_PRESSURE_CENTERS for edge files.
     edge_vars = dict(data_fields)
     del edge_vars["CONC_AT_PRESSURE_CENTERS"]
 
     # Open and combine edge and concentration files
-    gc = xr.merge([_open_geoschem(file_path_conc, conc_vars),
-                   _open_geoschem(file_path_edges, edge_vars)])
+    subset = {"obs_times" : obs_times, "obs_lats" : obs_lats, 
+              "obs_lons" : obs_lons, "time_settings" : time_settings,
+              "cache" : cache, "dtype" : dtype}
+    gc = xr.merge([read_geoschem_conc_file(file_path_conc, data_fields, 
+                                           **subset),
+                   _open_geoschem(file_path_edges, edge_vars, **subset)],
+                  compat="override", join="exact")
 
     # Transpose
-    gc = gc.transpose("TIME", "LONGITUDE", "LATITUDE", "LEV", "ILEV")
+    gc = gc.transpose("TIME", *util.get_horizontal_dims(gc).values(), 
+                      "LEV", "ILEV")
 
     #  TO DO: Check if we need to fill the first hour of the data.
 
     return gc
 
 
+def read_geoschem_conc_file(file_path_conc, data_fields, 
+                            obs_times=None, obs_lats=None, obs_lons=None, 
+                            time_settings=None, cache=None, dtype=None):
+    '''
+    Reads only the GEOS-Chem concentrations (see read_geoschem_file). This
+    is used in batch mode, where the pressure edges are shared by all of 
+    the model runs.
+    '''
+    ## For concentration files, keep everything except PRESSURE_EDGES.
+    conc_vars = dict(data_fields)
+    del conc_vars["PRESSURE_EDGES"]
+
+    gc = _open_geoschem(file_path_conc, conc_vars, obs_times, obs_lats,
+                        obs_lons, time_settings, cache, dtype)
+    return gc.transpose("TIME", *util.get_horizontal_dims(gc).values(), 
+                        "LEV", ...)
+
+
 def read_satellite_file(file_path, data_fields):
     '''
     This generic parser assumes that the data is a netcdf with a single, 
@@ -86,13 +362,24 @@ def read_satellite_file(file_path, data_fields):
     return satellite
 
 
-def read_TCCON_MIP(file_path, data_fields):
+def read_TCCON_MIP(file_path, data_fields, filters=None):
     tccon = xr.open_dataset(file_path, group="CO2")
 
     rename_fields = {v : k for k, v in data_fields.items()
                      if v != "none"}
     tccon = tccon.rename(rename_fields)
 
+    # The profiles are processed eagerly below, so we apply the filters that
+    # we can (see split_filters) before anything is loaded. The others are 
+    # applied at the end. N_OBS keeps the position of each observation in
+    # the file (as it does without filters).
+    tccon = tccon.assign_coords(N_OBS=np.arange(tccon.sizes["N_OBS"]))
+    filters, late_filters = split_filters(
+        filters or {}, [name for name, var in tccon.variables.items()
+                        if var.dims == ("N_OBS",)])
+    tccon = apply_filters(tccon, filters)
+    filter_attrs = get_filter_attrs(tccon)
+
     # First, drop unneeded variables
     tccon = tccon.drop_vars(["prior_h2o",
                              "sza",
@@ -145,25 +432,29 @@ def read_TCCON_MIP(file_path, data_fields):
     pressure = xr.where(replace_mask, tccon["p_surf"], pressure)
     
     # Now, shift any variables that are on the N_OBS x N_EDGES grid so that
-    # the surface is the first 
-    shift_grid = lambda var, fill_zero : xr.apply_ufunc(
-        shift_tccon_pressure_grid,
-        var,
-        kwargs={"fill_zero": fill_zero},
-        input_core_dims=[["N_EDGES"]],
-        output_core_dims=[["N_EDGES"]],
-        vectorize=True
-    )
-    for name, var in tccon.data_vars.items():
-        if ("N_EDGES" in var.dims) & ("N_OBS" in var.dims):
-            # Truncate the dataset to only be above the TCCON surface
-            var = var.where(~pressure.isnull())
-
-            # Shift so that the first level is first
-            tccon[name] = shift_grid(var, True)
+    # the surface is the first. The variables are stacked so that they are 
+    # all shifted at once.
+    names = [name for name, var in tccon.data_vars.items()
+             if ("N_EDGES" in var.dims) & ("N_OBS" in var.dims)]
+    # Truncate the dataset to only be above the TCCON surface
+    shift_vars = [tccon[name].where(~pressure.isnull()).transpose(
+                      ..., "N_OBS", "N_EDGES") for name in names]
+    stack = [name for name, var in zip(names, shift_vars) if var.ndim == 2]
+    if len(stack) > 0:
+        shifted = shift_tccon_pressure_grid(
+            np.stack([var.values for name, var in zip(names, shift_vars)
+                      if name in stack]), fill_zero=True)
+    for name, var in zip(names, shift_vars):
+        if name in stack:
+            values = shifted[stack.index(name)]
+        else:
+            values = shift_tccon_pressure_grid(var.values, fill_zero=True)
+        tccon[name] = var.copy(data=values.astype(var.dtype))
     
     # And finally shift the pressure variable
-    pressure = shift_grid(pressure, False)
+    pressure = pressure.transpose("N_OBS", "N_EDGES")
+    pressure = pressure.copy(
+        data=shift_tccon_pressure_grid(pressure.values, fill_zero=False))
 
     # Save out the pressure edges in hPa
     tccon["PRESSURE_EDGES"] = pressure
@@ -225,34 +516,41 @@ def read_TCCON_MIP(file_path, data_fields):
     # Now, remove superfluous pressure information
     tccon = tccon.drop_vars(["p_levels_prior", "p_levels_ak"])
 
+    tccon.attrs.update(filter_attrs)
+    tccon = apply_filters(tccon, late_filters)
     return tccon
 
 
-def shift_tccon_pressure_grid(row, fill_zero=True):
-    # Count leading NaNs in reference
-    isnan = np.isnan(row)
+def shift_tccon_pressure_grid(data, fill_zero=True):
+    """
+    Shifts each profile along the last dimension of data (... x N_EDGES) 
+    to remove its leading NaNs, so that the first valid level comes first.
+    The end of each shifted profile is padded with zero (fill_zero) or with
+    its last non-NaN value. Profiles that are all NaN are left alone. All 
+    of the profiles are shifted at once with a single gather.
+    """
+    isnan = np.isnan(data)
+    n_edges = data.shape[-1]
+
+    # Count leading NaNs (argmax is 0 for profiles that are all NaN)
+    shift = np.argmax(~isnan, axis=-1)[..., None]
 
-    if np.all(isnan):
-        return row  # nothing sensible to shift
+    # Shift left
+    index = np.arange(n_edges) + shift
+    pad = index >= n_edges
+    shifted = np.take_along_axis(data, np.minimum(index, n_edges - 1), 
+                                 axis=-1)
 
-    # Get the fill value
+    # Get the fill value and pad the end
     if fill_zero:
         fill_value = 0
     else:
-        fill_value = row[~isnan][-1]  # last non-NaN value
-    
-    shift = max(np.argmax(~isnan), 0)
-
-    if shift == 0:
-        return row
+        last = n_edges - 1 - np.argmax(~isnan[..., ::-1], axis=-1)
+        fill_value = np.take_along_axis(data, last[..., None], axis=-1)
+    return np.where(pad, fill_value, shifted)
 
-    return np.concatenate([
-        row[shift:],                     # shift left
-        np.full(shift, fill_value)       # pad end
-    ])
 
-
-def read_TROPOMI(file_path, data_fields):
+def read_TROPOMI(file_path, data_fields, block_size=500, filters=None):
     # Define where each of the needed variables are found
     group_to_vars = {
         "PRODUCT/" : [
@@ -275,40 +573,104 @@ def read_TROPOMI(file_path, data_fields):
             "dry_air_subcolumns",
             "surface_classification",
         ],
-        # "PRODUCT/SUPPORT_DATA/GEOLOCATIONS" : [
-        #     "longitude_bounds",
-        #     "latitude_bounds",
-        # ] # HN: Not supported yet
     }
-
-    # Open the data
+    # The pixel corners are only read for footprint sampling
+    if data_fields.get("LATITUDE_BOUNDS", "none").lower() != "none":
+        group_to_vars["PRODUCT/SUPPORT_DATA/GEOLOCATIONS"] = [
+            data_fields["LONGITUDE_BOUNDS"],
+            data_fields["LATITUDE_BOUNDS"],
+        ]
+
+    # Most of a swath is empty, so we first find the valid pixels from the
+    # satellite column and quality flag and then read the other variables 
+    # only for those pixels. We also get rid of the time dimension.
+    mask_vars = [data_fields[v] for v in ["SATELLITE_COLUMN", "QUALITY_FLAG"]
+                 if data_fields[v].lower() != "none"]
+    with xr.open_dataset(file_path, group="PRODUCT/") as product:
+        valid = product[mask_vars].squeeze(drop=True).notnull()
+        valid = np.all([valid[v].transpose("scanline", "ground_pixel").values
+                        for v in mask_vars], axis=0)
+    scanline, ground_pixel = np.nonzero(valid)
+
+    # Apply the filters on the variables in the PRODUCT group (e.g., 
+    # QUALITY_FLAG, LATITUDE, LONGITUDE, and TIME) to the valid pixels, so 
+    # that the rest of the data are only read for the pixels that pass. The
+    # other filters are applied at the end.
+    filters, late_filters = split_filters(
+        filters or {}, [k for k in data_fields 
+                        if data_fields[k] in group_to_vars["PRODUCT/"]])
+    product_vars = {k : data_fields[k] for k in filters}
+    passed = xr.Dataset({"PIXEL" : ("N_OBS", np.arange(len(scanline)))})
+    if len(product_vars) > 0:
+        with xr.open_dataset(file_path, group="PRODUCT/") as product:
+            product = product[list(product_vars.values())].squeeze(drop=True)
+            product = product.load()
+        for name, var in product_vars.items():
+            values = product[var]
+            if var == data_fields["TIME"]:
+                values = decode_TROPOMI_times(values)
+            if name == "SATELLITE_COLUMN":
+                values = values * 1e-9 # ppb to mol/mol, as below
+            values = values.transpose("scanline", ...).values
+            passed[name] = ("N_OBS", values[scanline, ground_pixel] 
+                                     if values.ndim == 2 
+                                     else values[scanline])
+        passed = apply_filters(passed, filters)
+        scanline = scanline[passed["PIXEL"].values]
+        ground_pixel = ground_pixel[passed["PIXEL"].values]
+
+    # The data are read one block of at most block_size scanlines at a 
+    # time, and only the valid pixels of each block are kept, so that only 
+    # the scanlines with valid pixels are read and no more than one block 
+    # of the swath is in memory at once. The pixels are sorted by scanline,
+    # so each block is a contiguous range of pixels.
+    block = scanline // block_size
+    starts = np.flatnonzero(np.diff(block, prepend=-1))
+    ends = np.append(starts[1:], len(block)).astype(int)
+    if len(starts) == 0:
+        starts, ends = np.array([0]), np.array([0])
+    first = scanline[starts] if len(scanline) > 0 else np.array([0])
+
+    # Open the data for the valid pixels
     satellite = []
     for group, vars in group_to_vars.items():
-        satellite.append(xr.open_dataset(file_path, group=group)[vars])
-    satellite = xr.merge(satellite)
+        with xr.open_dataset(file_path, group=group) as data:
+            data = data[vars].squeeze(drop=True)
+            blocks = []
+            for i, j, k in zip(starts, ends, first):
+                rows = slice(k, scanline[j - 1] + 1 if j > i else k)
+                pixels = {
+                    "scanline" : xr.DataArray(scanline[i:j] - k, 
+                                              dims="N_OBS"),
+                    "ground_pixel" : xr.DataArray(ground_pixel[i:j], 
+                                                  dims="N_OBS")}
+                blocks.append(data.isel(scanline=rows).load().isel(pixels))
+        data = xr.concat(blocks, dim="N_OBS", data_vars="all", 
+                         coords="different", compat="equals", join="exact")
+        if data_fields["TIME"] in vars:
+            data[data_fields["TIME"]] = decode_TROPOMI_times(
+                data[data_fields["TIME"]])
+        satellite.append(data)
+    satellite = xr.merge(satellite, compat="override", join="exact")
+    satellite = satellite.drop_vars(["scanline", "ground_pixel"], 
+                                    errors="ignore")
 
     # Rename satellite dimension names to the standard from config.yaml)
     rename_fields = {v : k for k, v in data_fields.items()
                      if v.lower() != "none"}
     satellite = satellite.rename(rename_fields)
 
-    # Collapse the scanline x groundpixel dimensions into nobs. We also get rid
-    # of the time variable and move the latitude/longitude coordinates into 
-    # the variables. Finally, we drop nans.
-    satellite = satellite.squeeze(drop=True)
-    satellite = satellite.stack(N_OBS=("scanline", "ground_pixel"))
-    satellite = satellite.reset_index("N_OBS", drop=True)
+    # Move the latitude/longitude coordinates into the variables.
     satellite = satellite.reset_coords(["LATITUDE", "LONGITUDE"])
-    satellite = satellite.where(~satellite["SATELLITE_COLUMN"].isnull(),
-                                drop=True)
 
     # Convert the satellite column from ppb to mol/mol (GEOS-Chem base units)
     satellite["SATELLITE_COLUMN"] *= 1e-9 
 
     satellite = process_TROPOMI_variables(satellite)
-    # TODO: Handle QA masking? 
     # TODO: I'm also currently not handling the surface classification variable
 
+    satellite.attrs.update(get_filter_attrs(passed))
+    satellite = apply_filters(satellite, late_filters)
     return satellite
 
 
@@ -320,7 +682,6 @@ def read_blended_TROPOMI(file_path, data_fields):
     satellite["SATELLITE_COLUMN"] *= 1e-9 
 
     satellite = process_TROPOMI_variables(satellite)
-    # TODO: Handle QA masking? 
     # TODO: I'm also currently not handling the surface classification variable
 
     return satellite
@@ -347,12 +708,9 @@ def process_TROPOMI_variables(satellite):
     )
     satellite = satellite.drop_vars(["dry_air_subcolumns"])
 
-    # Process the time variable
-    satellite["TIME"] = xr.DataArray(
-        [t.replace("Z", "") for t in satellite["TIME"].values],
-        coords=satellite["TIME"].coords,
-        dims=satellite["TIME"].dims).astype("datetime64[ns]"
-    )
+    # Process the time variable (unless the parser already did)
+    if satellite["TIME"].dtype.kind != "M":
+        satellite["TIME"] = decode_TROPOMI_times(satellite["TIME"])
 
     # Define the blended albedo 
     satellite["blended_albedo"] = (
@@ -362,22 +720,39 @@ def process_TROPOMI_variables(satellite):
     return satellite
 
 
-def read_OCO2_v11_1_preprocessed(file_path, data_fields):
+def decode_TROPOMI_times(time_utc):
+    """
+    Converts the TROPOMI time_utc strings (e.g., 2020-01-01T12:00:00.123Z) 
+    to datetime64 in one vectorized step.
+    """
+    times = np.char.rstrip(np.asarray(time_utc.values).astype(str), "Z")
+    return time_utc.copy(data=times.astype("datetime64[ns]"))
+
+
+def read_OCO2_v11_1_preprocessed(file_path, data_fields, filters=None):
     # Use the standard parser first
     satellite = read_satellite_file(file_path, data_fields)
+
+    # The unit conversion loads the variables, so we first apply the filters
+    # on the other variables (see split_filters)
+    filters, late_filters = split_filters(
+        filters or {}, [name for name, var in satellite.variables.items()
+                        if var.dims == ("N_OBS",) and 
+                        name not in ["PRIOR_PROFILE", "SATELLITE_COLUMN"]])
+    satellite = apply_filters(satellite, filters)
     
     # Convert units from ppm to mol/mol
     satellite["PRIOR_PROFILE"] *= 1e-6
     satellite["SATELLITE_COLUMN"] *= 1e-6
 
     # Filter (we will comment this out for the final round of iterations)
-    satellite = satellite.compute()
     # satellite = satellite.where(satellite["type_flag"] < 2, drop=True)
 
+    satellite = apply_filters(satellite, late_filters)
     return satellite
 
 
-def read_OCO_10s(file_path, data_fields):
+def read_OCO_10s(file_path, data_fields, filters=None):
     # Use the standard parser first
     satellite = read_satellite_file(file_path, data_fields)
 
@@ -390,6 +765,14 @@ def read_OCO_10s(file_path, data_fields):
         "land_fraction", "operation_mode", "surface_type", "dp", 
     ]
     satellite = satellite[keep_vars]
+
+    # The calculations below load the variables, so we first apply the 
+    # filters on the other variables (see split_filters)
+    filters, late_filters = split_filters(
+        filters or {}, [name for name, var in satellite.variables.items()
+                        if var.dims == ("N_OBS",) and 
+                        name not in ["PRIOR_PROFILE", "SATELLITE_COLUMN"]])
+    satellite = apply_filters(satellite, filters)
     
     # Calculate the pressure levels
     satellite["PRESSURE_EDGES"] = satellite["sigma_levels"] * satellite["psurf"]
@@ -399,8 +782,7 @@ def read_OCO_10s(file_path, data_fields):
     satellite["PRIOR_PROFILE"] *= 1e-6
     satellite["SATELLITE_COLUMN"] *= 1e-6
 
-    satellite = satellite.compute()
-
+    satellite = apply_filters(satellite, late_filters)
     return satellite
 
 
@@ -412,8 +794,9 @@ def check_satellite_data(satellite):
     # Ensure that the satellite data has the correct ordering of dimensions
     satellite = satellite.transpose("N_OBS", ...)
 
-    # Ensure that satellite pressure levels are in descending order:
-    if np.all(satellite["PRESSURE_EDGES"].diff(dim="N_EDGES") >= 0):
+    # Ensure that satellite pressure levels are in descending order. This 
+    # is a reduction, so it does not load dask-backed data all at once.
+    if bool((satellite["PRESSURE_EDGES"].diff(dim="N_EDGES") >= 0).all()):
         print("  Switching direction of N_EDGES/N_CENTERS.")
         # Identify which flip dims actually exist in this dataset, then flip them
         dims_to_flip = {"N_CENTERS", "N_EDGES"}
@@ -425,6 +808,110 @@ def check_satellite_data(satellite):
     return satellite
 
 
+def set_precision(satellite, dtype):
+    """
+    Casts the floating point satellite variables with a vertical dimension
+    (the pressure edges, pressure weights, averaging kernel, and prior 
+    profile, which take up most of the memory) to dtype. The per-observation
+    variables, including the locations used for colocation, are not 
+    changed.
+    """
+    vertical_dims = {"N_EDGES", "N_CENTERS"}
+    return satellite.assign(
+        {v : satellite[v].astype(dtype) for v in satellite.data_vars
+         if satellite[v].dtype.kind == "f"
+         and vertical_dims & set(satellite[v].dims)})
+
+
+def get_filters(local_config):
+    """
+    Gets the observation filters from FILTERS in LOCAL_SETTINGS, which maps
+    a variable in the parsed satellite data (e.g., QUALITY_FLAG, LATITUDE,
+    LONGITUDE, TIME, or any other variable along N_OBS) to an inclusive 
+    [min, max] range. Either bound can be 'none'. TIME bounds are dates or
+    date times (e.g., '2020-01-01T12:00'). A LONGITUDE range with 
+    min > max crosses the dateline (e.g., [170, -170]).
+
+    Returns a dictionary of (min, max) with None for open bounds.
+    """
+    filters = {}
+    for name, bounds in (local_config.get("FILTERS") or {}).items():
+        bounds = [None if str(b).lower() == "none" else b for b in bounds]
+        if name == "TIME":
+            bounds = [None if b is None else np.datetime64(str(b), "ns") 
+                      for b in bounds]
+        filters[name] = tuple(bounds)
+    return filters
+
+
+def apply_filters(satellite, filters):
+    """
+    Drops the observations that are outside of the filter ranges from 
+    get_filters. Only the filter variables are loaded; the rest of a lazy
+    dataset is subset before it is read, so rejected observations are never
+    loaded or processed. Observations with missing (NaN) filter values are
+    dropped. The filters are applied in order, and the number of 
+    observations dropped by each filter is recorded in the attributes 
+    n_dropped_<name> (see get_filter_attrs).
+    """
+    if len(filters) == 0:
+        return satellite
+
+    keep = np.ones(satellite.sizes["N_OBS"], dtype=bool)
+    n_dropped = {}
+    for name, (lower, upper) in filters.items():
+        if satellite[name].dims != ("N_OBS",):
+            raise ValueError(f"Filter variable {name} must only have the "
+                             f"N_OBS dimension, not {satellite[name].dims}")
+        values = satellite[name].values
+        if name == "TIME":
+            passed = ~np.isnat(values)
+        else:
+            passed = ~np.isnan(values)
+        if (name == "LONGITUDE" and lower is not None and upper is not None
+            and lower > upper):
+            passed &= (values >= lower) | (values <= upper)
+        else:
+            if lower is not None:
+                passed &= values >= lower
+            if upper is not None:
+                passed &= values <= upper
+        n_dropped[name] = int((keep & ~passed).sum())
+        keep &= passed
+
+    satellite = satellite.isel(N_OBS=np.where(keep)[0])
+    for name, n in n_dropped.items():
+        satellite.attrs[f"n_dropped_{name}"] = n
+    print(f"  Filters kept {keep.sum()} of {len(keep)} observations "
+          f"(dropped: {n_dropped}).")
+    return satellite
+
+
+def get_filter_attrs(satellite):
+    """
+    Gets the filter counts recorded by apply_filters.
+    """
+    return {k : v for k, v in satellite.attrs.items() 
+            if k.startswith("n_dropped_")}
+
+
+def split_filters(filters, names):
+    """
+    Splits the filters from get_filters into the leading filters on the 
+    variables in names and the rest. Used by the parsers that load the data
+    themselves to filter before they do so. The filters are applied in 
+    order, so the split stops at the first filter that is not in names to
+    keep the n_dropped_<name> counts the same.
+    """
+    n_ready = 0
+    for name in filters:
+        if name not in names:
+            break
+        n_ready += 1
+    items = list(filters.items())
+    return dict(items[:n_ready]), dict(items[n_ready:])
+
+
 def get_satellite_parser(config):
     # Get the function that opens the satellite data. Check that the function
     # has a default value for satellite_name. If not, use satellite_name
@@ -436,10 +923,48 @@ def get_satellite_parser(config):
     print(f"satellite_name : {satellite_name}")
     print(f"parser : {config[satellite_name]['PARSER']}")
 
-    # Define the function
+    # Get the observation filters
+    filters = get_filters(config["LOCAL_SETTINGS"])
+    if len(filters) > 0:
+        print(f"filters : {filters}")
+    dtype, _ = util.PRECISIONS[util.get_precision(config["LOCAL_SETTINGS"])]
+
+    # With EXECUTION: 'dask', the data are read as dask arrays in chunks of
+    # FILE_LENGTH_THRESHOLD observations and stay lazy (see 
+    # main.apply_operator_lazily)
+    chunks = None
+    if util.is_lazy(config["LOCAL_SETTINGS"]):
+        chunks = {"N_OBS" : max(
+            int(config["LOCAL_SETTINGS"]["FILE_LENGTH_THRESHOLD"]), 1)}
+
+    # The footprint corners are only read for footprint sampling
+    data_fields = dict(config[satellite_name]["DATA_FIELDS"])
+    if util.get_horizontal_sampling(config["LOCAL_SETTINGS"]) == "footprint":
+        if any(data_fields.get(k, "none").lower() == "none" 
+               for k in util.FOOTPRINT_FIELDS):
+            raise ValueError(f"HORIZONTAL_SAMPLING: 'footprint' requires "
+                             f"{util.FOOTPRINT_FIELDS} in the "
+                             f"{satellite_name} DATA_FIELDS.")
+    else:
+        data_fields.update({k : "none" for k in util.FOOTPRINT_FIELDS})
+
+    # Define the function. The filters are applied before the rest of the 
+    # data are loaded: the parsers that load data themselves (e.g., 
+    # read_TROPOMI and read_TCCON_MIP) take the filters as an argument, and
+    # the others return lazy datasets that are filtered here.
+    parser_filters = "filters" in inspect.signature(read_sat).parameters
     def read_satellite(file_path):
-        dataset = read_sat(file_path, config[satellite_name]["DATA_FIELDS"])
+        if parser_filters:
+            dataset = read_sat(file_path, data_fields, filters=filters)
+        else:
+            dataset = read_sat(file_path, data_fields)
+        if chunks is not None:
+            dataset = dataset.chunk(chunks)
+        if not parser_filters:
+            dataset = apply_filters(dataset, filters)
         dataset = check_satellite_data(dataset)
+        if dtype != np.float64:
+            dataset = set_precision(dataset, dtype)
         return dataset
     
     return read_satellite
@@ -1,3 +1,1400 @@
 # test functions
+# Run with: python -m pytest test.py
+import contextlib
+import glob
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+import yaml
+import benchmark
+import kernels
+import operators
+from interpolation import VerticalGrid
+import parsers
+import utilities as util
 
 # test interpolation on different cases of satellite grids.
+
+def get_random_edges(rng, n_obs, n_edges, surface, top):
+    """
+    Gets random pressure edges (n_obs x n_edges) in descending order from
+    surface to top.
+    """
+    inner = np.sort(rng.uniform(top, surface, (n_obs, n_edges - 2)),
+                    axis=1)[:, ::-1]
+    return np.concatenate([np.full((n_obs, 1), surface), inner,
+                           np.full((n_obs, 1), top)], axis=1)
+
+
+def check_sparse_interpolation_map(model_edges, satellite_edges):
+    """
+    Checks that the sparse interpolation map sums to the dense map and that
+    both give the same satellite partial columns.
+    """
+    dense = VerticalGrid.get_interpolation_map(model_edges, satellite_edges)
+    sparse = VerticalGrid.get_sparse_interpolation_map(model_edges,
+                                                       satellite_edges)
+
+    # Sum the segments into the dense layout
+    n_obs, n_segments = sparse.shape
+    densified = np.zeros_like(dense)
+    np.add.at(densified,
+              (np.repeat(np.arange(n_obs), n_segments),
+               sparse["model_index"].ravel(),
+               sparse["satellite_index"].ravel()),
+              sparse["weight"].ravel())
+    np.testing.assert_allclose(densified, dense, rtol=1e-12, atol=1e-9)
+
+    model_conc = np.random.default_rng(1).uniform(
+        1, 2, (n_obs, model_edges.shape[1] - 1, 3))
+    n_satellite_layers = satellite_edges.shape[1] - 1
+    np.testing.assert_allclose(
+        VerticalGrid.apply_interpolation_map(sparse, model_conc,
+                                             n_satellite_layers),
+        VerticalGrid.apply_interpolation_map(dense, model_conc,
+                                             n_satellite_layers),
+        rtol=1e-12, atol=1e-9)
+
+
+def test_sparse_interpolation_map_random_edges():
+    rng = np.random.default_rng(0)
+    model_edges = get_random_edges(rng, 200, 48, 1000, 0.01)
+    # Satellite grids within the model range
+    check_sparse_interpolation_map(
+        model_edges, get_random_edges(rng, 200, 13, 990, 0.1))
+    # Satellite surface below the model surface and top above the model top
+    check_sparse_interpolation_map(
+        model_edges, get_random_edges(rng, 200, 13, 1050, 0.001))
+    # Satellite grids that only cover part of the model column
+    check_sparse_interpolation_map(
+        model_edges, get_random_edges(rng, 200, 5, 400, 200))
+
+
+def test_sparse_interpolation_map_edge_cases():
+    model_edges = np.array([[1000., 800., 500., 200., 10.]] * 4)
+    satellite_edges = np.array([
+        [790., 600.],     # one satellite layer inside one model layer
+        [800., 500.],     # one satellite layer equal to a model layer
+        [1100., 1050.],   # one satellite layer below the model surface
+        [5., 1.]])        # one satellite layer above the model top
+    check_sparse_interpolation_map(model_edges, satellite_edges)
+
+    # Satellite edges that coincide with the model edges
+    check_sparse_interpolation_map(model_edges[:1], model_edges[:1])
+
+
+# test the compiled kernels (BACKEND: 'numba') against the numpy path.
+
+def get_kernel_satellite(rng, satellite_edges, n_levels):
+    dims = ["N_OBS", "N_LEVELS"]
+    n_obs = satellite_edges.shape[0]
+    return xr.Dataset({
+        "PRESSURE_EDGES" : (["N_OBS", "N_EDGES"], satellite_edges),
+        "PRESSURE_WEIGHT" : (dims, rng.uniform(0, 1, (n_obs, n_levels))),
+        "AVERAGING_KERNEL" : (dims, rng.uniform(0.5, 1.5, (n_obs, n_levels))),
+        "PRIOR_PROFILE" : (dims, rng.uniform(1, 2, (n_obs, n_levels)))})
+
+
+def test_kernels_match_numpy():
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(0)
+    model_edges = get_random_edges(rng, 2000, 48, 1000, 0.01)
+    # Satellite grids that extend past the model surface and top, with 
+    # empty layers (repeated edges, as in TCCON)
+    satellite_edges = get_random_edges(rng, 2000, 13, 1050, 0.001)
+    satellite_edges[::7, 3] = satellite_edges[::7, 2]
+    satellite_edges[::11, -3:] = 0.001
+
+    for avker_center_or_edges, n_levels in [("centers", 12), ("edges", 13)]:
+        satellite = get_kernel_satellite(rng, satellite_edges, n_levels)
+        h, c = operators.ObservationOperator._build_components(
+            model_edges, satellite, avker_center_or_edges, "numpy")
+        h_numba, c_numba = operators.ObservationOperator._build_components(
+            model_edges, satellite, avker_center_or_edges, "numba")
+        assert np.allclose(h_numba, h, rtol=1e-6, atol=1e-12)
+        assert np.allclose(c_numba, c, rtol=1e-6, atol=1e-12)
+
+        model_conc = rng.uniform(1, 2, (2000, 47, 3))
+        satellite_conc = [
+            VerticalGrid(model_conc, model_edges, satellite_edges,
+                         avker_center_or_edges, "False", None,
+                         backend=backend).interpolate()
+            for backend in ["numpy", "numba"]]
+        assert np.allclose(satellite_conc[1], satellite_conc[0], 
+                           rtol=1e-6, atol=1e-12)
+
+
+def test_kernels_with_missing_edges():
+    # The numpy path (VerticalGrid) requires edges without NaNs, but the 
+    # dense interpolation map leaves out the layers with a missing edge. 
+    # The kernels used to stop moving on at a missing edge and never 
+    # finished. Without numba, they run as plain python, which is enough for
+    # a few observations.
+    rng = np.random.default_rng(0)
+    model_edges = get_random_edges(rng, 6, 12, 1000, 0.01)
+    satellite_edges = get_random_edges(rng, 6, 6, 990, 0.1)
+    satellite_edges[0, 2] = np.nan
+    satellite_edges[1, 0] = np.nan
+    satellite_edges[2] = np.nan
+    model_edges[3, 4] = np.nan
+    model_edges[4, -1] = np.nan
+    satellite = get_kernel_satellite(rng, satellite_edges, 5)
+    weight = satellite["PRESSURE_WEIGHT"].values
+    averaging_kernel = satellite["AVERAGING_KERNEL"].values
+    prior = satellite["PRIOR_PROFILE"].values
+
+    interpolation_map = VerticalGrid.get_interpolation_map(model_edges, 
+                                                           satellite_edges)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        partial_column_to_conc = np.nan_to_num(
+            1 / np.abs(np.diff(satellite_edges)), nan=0.0, posinf=0.0)
+    h, c = kernels.build_operator(model_edges, satellite_edges, weight,
+                                  averaging_kernel, prior, "centers")
+    np.testing.assert_allclose(
+        h, np.einsum("oms,os->om", interpolation_map, 
+                     weight * averaging_kernel * partial_column_to_conc),
+        rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(
+        c, np.sum(weight * (1 - averaging_kernel) * prior, axis=1),
+        rtol=1e-10)
+
+    model_conc = rng.uniform(1, 2, (6, 11, 3))
+    np.testing.assert_allclose(
+        kernels.interpolate(model_conc, model_edges, satellite_edges, 
+                            "centers"),
+        partial_column_to_conc[:, :, None] 
+        * np.einsum("oms,omk->osk", interpolation_map, model_conc),
+        rtol=1e-10, atol=1e-12)
+
+
+# test that the reduced PRECISION modes are within the documented bound.
+
+def read_config_fields():
+    """ Reads the DATA_FIELDS in config.yaml. """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                           "config.yaml")) as f:
+        return yaml.safe_load(f)
+
+
+def read_benchmark_data(directory, n_obs=2000, n_layers=20, n_tracers=3):
+    """
+    Writes one day of benchmark model and satellite data to directory and
+    reads it with the parsers.
+    """
+    dates = benchmark.get_dates(1)
+    benchmark.make_geoschem_files(f"{directory}/gc", dates, 
+                                  n_tracers=n_tracers)
+    benchmark.make_generic_file(
+        f"{directory}/generic_0.nc", 
+        benchmark.make_observations(n_obs, n_layers, dates))
+    fields = read_config_fields()
+    satellite = parsers.check_satellite_data(parsers.read_satellite_file(
+        f"{directory}/generic_0.nc", 
+        fields["GOSATv9_0"]["DATA_FIELDS"]).load())
+    date = dates[0].replace("-", "")
+    model = parsers.read_geoschem_file(
+        np.array([f"{directory}/gc/GEOSChem.SpeciesConc.{date}_0000z.nc4"]),
+        np.array([f"{directory}/gc/GEOSChem.LevelEdgeDiags.{date}_0000z.nc4"]),
+        fields["MODEL"]["DATA_FIELDS"])
+    return model, satellite
+
+
+def test_precision_error(tmp_path):
+    model, satellite = read_benchmark_data(tmp_path)
+    for precision in ["float32", "mixed"]:
+        error, _, _ = benchmark.get_precision_error(model, satellite, 
+                                                    precision)
+        assert error <= util.PRECISION_TOLERANCE[precision], (precision, error)
+
+    # The chunks are sized for the values of each precision
+    chunk_size = {
+        precision : util.get_chunk_size(
+            {"CHUNK_MEMORY_BUDGET" : 1e8, "PRECISION" : precision}, 
+            47, 20, 3)
+        for precision in util.PRECISIONS}
+    assert chunk_size["float32"] == chunk_size["mixed"]
+    assert abs(chunk_size["float32"] - 2 * chunk_size["float64"]) <= 1
+
+
+# test that the model cache evicts the least recently used files and only 
+# keeps the box of grid cells that is read.
+
+def test_model_cache_eviction():
+    data = {k : xr.Dataset({"x" : ("n", np.zeros(100))}) for k in "abcde"}
+    cache = parsers.ModelCache(3 * data["a"].nbytes)
+    for k in "abc":
+        cache.put(k, data[k])
+    assert cache.get("a") is data["a"]
+    cache.put("d", data["d"])
+    assert cache.get("b") is None
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.n_bytes == 3 * data["a"].nbytes
+    assert cache.stats() == {"hits" : 1, "misses" : 1, "evictions" : 1, 
+                             "entries" : 3, "bytes" : cache.n_bytes}
+
+    # Two entries are evicted to make room for a larger one
+    cache.put("e", xr.Dataset({"x" : ("n", np.zeros(150))}))
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.n_bytes == sum(v.nbytes for v in cache.entries.values())
+
+    # Entries larger than the whole cache are not stored
+    cache.put("f", xr.Dataset({"x" : ("n", np.zeros(400))}))
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.evictions == 3
+
+
+def test_model_cache_subset(tmp_path):
+    dates = benchmark.get_dates(1)
+    benchmark.make_geoschem_files(tmp_path, dates, n_levels=5)
+    fields = read_config_fields()["MODEL"]["DATA_FIELDS"]
+    date = dates[0].replace("-", "")
+    files = [np.array([f"{tmp_path}/GEOSChem.{kind}.{date}_0000z.nc4"]) 
+             for kind in ["SpeciesConc", "LevelEdgeDiags"]]
+    full_bytes = sum(xr.open_dataset(f[0]).nbytes for f in files)
+
+    cache = parsers.ModelCache(full_bytes)
+    for lats, lons in [([10.], [20.]), ([10.], [20.]), ([-60.], [100.])]:
+        subset = {"obs_times" : np.array(["2020-01-01T03:10"], 
+                                         dtype="datetime64[ns]"),
+                  "obs_lats" : np.array(lats), "obs_lons" : np.array(lons)}
+        model = parsers.read_geoschem_file(*files, fields, cache=cache, 
+                                           **subset)
+        xr.testing.assert_identical(
+            model, parsers.read_geoschem_file(*files, fields, **subset))
+    # The same box is read from the cache, and a new box is a new entry
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 0)
+    assert cache.n_bytes == sum(v.nbytes for v in cache.entries.values())
+    # Only the boxes of 5 x 5 grid cells are kept
+    for entry in cache.entries.values():
+        assert entry.sizes["lat"] == entry.sizes["lon"] == 5
+    assert cache.n_bytes < full_bytes / 10
+
+
+# test the model file catalog, with the times read from the files or parsed
+# from the file names, and saved between runs.
+
+def get_model_files(directory, kind="LevelEdgeDiags"):
+    return np.array(sorted(glob.glob(f"{directory}/GEOSChem.{kind}.*.nc4")))
+
+
+def test_model_catalog(tmp_path):
+    dates = benchmark.get_dates(3)
+    benchmark.make_geoschem_files(tmp_path, dates, n_levels=2, 
+                                  time_step="3h")
+    files = get_model_files(tmp_path)
+    catalog = util.get_model_catalog(files, {})
+    assert len(catalog.times) == 24
+
+    # Each time is mapped to its file and its index in that file
+    file_times = [xr.open_dataset(f)["time"].values for f in files]
+    assert np.all(np.diff(catalog.times) > np.timedelta64(0))
+    for t, k, i in zip(catalog.times, catalog.file_idx, catalog.time_idx):
+        assert file_times[k][i] == t
+    np.testing.assert_array_equal(catalog.get_dates(), dates)
+    np.testing.assert_array_equal(
+        catalog.get_files_for_dates(dates[1:2]), files[1:2])
+
+    # The files are those of the matched model times
+    rng = np.random.default_rng(0)
+    obs_times = np.datetime64(dates[0], "ns") + np.sort(rng.integers(
+        0, 3 * 86400, 50)).astype("timedelta64[s]")
+    for time_matching in ["floor", "nearest"]:
+        for times in [obs_times, obs_times[:5], obs_times[-5:]]:
+            idx = util.get_time_index(times, catalog.times, time_matching)
+            np.testing.assert_array_equal(
+                catalog.get_files(times, time_matching),
+                files[np.unique(catalog.file_idx[idx])])
+    # The time steps (centered at 01:30, 04:30, ...) start at midnight
+    for time, expected in [(f"{dates[0]}T23:50", files[:1]), 
+                           (f"{dates[1]}T00:10", files[1:2])]:
+        np.testing.assert_array_equal(
+            catalog.get_files(np.array([time], dtype="datetime64[ns]")),
+            expected)
+
+
+def test_model_catalog_from_names(tmp_path):
+    dates = benchmark.get_dates(3)
+    benchmark.make_geoschem_files(tmp_path, dates, n_levels=2, 
+                                  time_step="3h")
+    files = get_model_files(tmp_path)
+    local_config = {"MODEL_FILE_TIME_FORMAT" : "%Y%m%d_%H%Mz"}
+    catalog = util.get_model_catalog(files, local_config)
+    assert catalog.from_names
+    np.testing.assert_array_equal(
+        catalog.times, np.array(dates, dtype="datetime64[ns]"))
+    np.testing.assert_array_equal(catalog.get_dates(), dates)
+
+    # The files cover the files with the matched model times
+    from_times = util.get_model_catalog(files, {})
+    rng = np.random.default_rng(0)
+    obs_times = np.datetime64(dates[0], "ns") + np.sort(rng.integers(
+        0, 3 * 86400, 50)).astype("timedelta64[s]")
+    for times in [obs_times, obs_times[:5], obs_times[-5:]]:
+        for time_matching in ["floor", "nearest"]:
+            assert set(from_times.get_files(times, time_matching, "3h")) <= \
+                set(catalog.get_files(times, time_matching, "3h"))
+    # Observations within a time step of midnight need both files
+    for time, expected in [("T12:00", files[1:2]), ("T00:10", files[:2]), 
+                           ("T23:30", files[1:])]:
+        np.testing.assert_array_equal(
+            catalog.get_files(np.array([dates[1] + time], 
+                                       dtype="datetime64[ns]"), 
+                              time_step="3h"),
+            expected)
+
+    # The last file lasts as long as the one before it, and a single file
+    # lasts one day
+    np.testing.assert_array_equal(
+        util.get_model_catalog(files[::2], local_config).get_dates(), 
+        (np.datetime64(dates[0]) + np.arange(4)).astype(str))
+    np.testing.assert_array_equal(
+        util.get_model_catalog(files[1:2], local_config).get_dates(), 
+        dates[1:2])
+
+    assert util.get_time_from_file_name(
+        "GEOSChem.SpeciesConc.2020.032.nc4", "%Y.%j") == \
+        np.datetime64("2020-02-01")
+    with pytest.raises(ValueError, match="does not contain a time"):
+        util.get_model_catalog(files, {"MODEL_FILE_TIME_FORMAT" : "%Y-%m-%d"})
+
+
+def test_model_catalog_saved(tmp_path, monkeypatch):
+    dates = benchmark.get_dates(3)
+    model_dir = f"{tmp_path}/gc"
+    benchmark.make_geoschem_files(model_dir, dates[:2], n_levels=2, 
+                                  time_step="3h")
+    local_config = {"SAVE_MODEL_CATALOG" : "True", 
+                    "SAVE_DIR" : f"{tmp_path}/out"}
+    catalog_file = f"{tmp_path}/out/model_catalog.json"
+    assert not os.path.exists(catalog_file)
+
+    # Count the files whose times are read
+    read_files = []
+    open_dataset = xr.open_dataset
+    def open_counted(file_name, *args, **kwargs):
+        read_files.append(os.path.basename(file_name))
+        return open_dataset(file_name, *args, **kwargs)
+    monkeypatch.setattr(xr, "open_dataset", open_counted)
+
+    def get_catalog():
+        read_files.clear()
+        return util.get_model_catalog(get_model_files(model_dir), 
+                                      local_config)
+
+    expected = get_catalog()
+    assert len(read_files) == 2 and os.path.exists(catalog_file)
+    catalog = get_catalog()
+    assert read_files == []
+    np.testing.assert_array_equal(catalog.times, expected.times)
+    np.testing.assert_array_equal(catalog.time_idx, expected.time_idx)
+
+    # Changed and new files are read again
+    benchmark.make_geoschem_files(model_dir, dates[1:], n_levels=2, 
+                                  time_step="6h")
+    catalog = get_catalog()
+    assert read_files == [f"GEOSChem.LevelEdgeDiags."
+                          f"{date.replace('-', '')}_0000z.nc4"
+                          for date in dates[1:]]
+    assert len(catalog.times) == 8 + 4 + 4
+    np.testing.assert_array_equal(catalog.get_dates(), dates)
+    assert get_catalog() and read_files == []
+
+    # Files that no longer exist are dropped from the saved catalog
+    for kind in ["SpeciesConc", "LevelEdgeDiags"]:
+        os.remove(get_model_files(model_dir, kind)[0])
+    benchmark.make_geoschem_files(model_dir, dates[2:], n_levels=2, seed=1)
+    get_catalog()
+    with open(catalog_file) as f:
+        assert len(yaml.safe_load(f)) == 2
+
+    # Without SAVE_MODEL_CATALOG, every file is read
+    local_config["SAVE_MODEL_CATALOG"] = "False"
+    get_catalog()
+    assert len(read_files) == 2
+
+
+def test_model_catalog_main(tmp_path):
+    dates = benchmark.get_dates(2)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10)
+    os.makedirs(f"{tmp_path}/obs")
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_0.nc", 
+                                benchmark.make_observations(1000, 8, dates))
+
+    # The files found from the file names give the same output
+    outputs = []
+    for name, settings in [
+            ("times", {}), 
+            ("names", {"MODEL_FILE_TIME_FORMAT" : "%Y%m%d_%H%Mz"}),
+            ("saved", {"SAVE_MODEL_CATALOG" : "True"}),
+            ("saved", {"SAVE_MODEL_CATALOG" : "True"})]:
+        config = benchmark.make_config(
+            tmp_path, SAVE_DIR=f"{tmp_path}/{name}", **settings)
+        run_main(config, tmp_path)
+        outputs.append(xr.open_dataset(
+            f"{tmp_path}/{name}/generic_0_operator.nc").load())
+    assert outputs[0].sizes["N_OBS"] > 0
+    for output in outputs[1:]:
+        xr.testing.assert_identical(output, outputs[0])
+    assert os.path.exists(f"{tmp_path}/saved/model_catalog.json")
+
+
+# test the observation FILTERS on a small synthetic dataset.
+
+def get_filter_dataset():
+    return xr.Dataset({
+        "QUALITY_FLAG" : ("N_OBS", [0, 1, 0, 0, 2, 0, 0, np.nan]),
+        "LATITUDE" : ("N_OBS", [-60., -59.9, 0., 60., 60., 60.1, 10., 10.]),
+        "LONGITUDE" : ("N_OBS", [170., 180., -180., -170., -169.9, 0., 
+                                 169.9, 175.]),
+        "TIME" : ("N_OBS", np.array(
+            ["2020-01-01T00:00", "2020-01-01T11:59", "2020-01-01T12:00", 
+             "2020-01-02T00:00", "2020-01-02T00:00", "2020-01-02T00:01",
+             "NaT", "2020-01-01T06:00"], dtype="datetime64[ns]")),
+        "PRESSURE_EDGES" : (("N_OBS", "N_EDGES"), np.zeros((8, 3)))})
+
+
+def test_filters():
+    satellite = get_filter_dataset()
+    def get_kept(filters):
+        filters = parsers.get_filters({"FILTERS" : filters})
+        with contextlib.redirect_stdout(None):
+            filtered = parsers.apply_filters(satellite.assign_coords(
+                N_OBS=np.arange(8)), filters)
+        return filtered["N_OBS"].values.tolist(), filtered.attrs
+
+    # The bounds are inclusive, and missing values are dropped
+    assert get_kept({"QUALITY_FLAG" : [0, 0]})[0] == [0, 2, 3, 5, 6]
+    assert get_kept({"LATITUDE" : [-59.9, 60]})[0] == [1, 2, 3, 4, 6, 7]
+
+    # A LONGITUDE range with min > max crosses the dateline
+    assert get_kept({"LONGITUDE" : [170, -170]})[0] == [0, 1, 2, 3, 7]
+    assert get_kept({"LONGITUDE" : [-170, 170]})[0] == [0, 3, 4, 5, 6]
+
+    # Open bounds, also for the dateline check
+    assert get_kept({"LATITUDE" : ["none", 0]})[0] == [0, 1, 2]
+    assert get_kept({"LATITUDE" : [60, "none"]})[0] == [3, 4, 5]
+    assert get_kept({"LONGITUDE" : [170, "none"]})[0] == [0, 1, 7]
+    assert get_kept({"LATITUDE" : ["none", "none"]})[0] == list(range(8))
+
+    # TIME bounds are dates or date times
+    assert get_kept({"TIME" : ["2020-01-01T12:00", "2020-01-02"]})[0] == (
+        [2, 3, 4])
+    assert get_kept({"TIME" : ["none", "2020-01-01"]})[0] == [0]
+
+    # The observations dropped by each filter, in order, are counted
+    kept, attrs = get_kept({"QUALITY_FLAG" : [0, 0], 
+                            "LATITUDE" : [-60, 60],
+                            "TIME" : ["none", "2020-01-01T23:00"]})
+    assert kept == [0, 2]
+    assert attrs == {"n_dropped_QUALITY_FLAG" : 3, "n_dropped_LATITUDE" : 1,
+                     "n_dropped_TIME" : 2}
+    assert parsers.get_filter_attrs(xr.Dataset(attrs={
+        **attrs, "title" : "test"})) == attrs
+
+    # No filters return the dataset as is
+    assert parsers.apply_filters(satellite, {}) is satellite
+
+    # Filters on variables with other dimensions are not allowed
+    with pytest.raises(ValueError):
+        parsers.apply_filters(satellite, {"PRESSURE_EDGES" : (0, 1)})
+
+
+def test_split_filters():
+    filters = parsers.get_filters({"FILTERS" : {
+        "QUALITY_FLAG" : [0, 0], "TIME" : ["2020-01-01", "none"],
+        "blended_albedo" : [0, 1], "LATITUDE" : [-60, 60]}})
+    early, late = parsers.split_filters(filters, ["QUALITY_FLAG", "TIME", 
+                                                  "LATITUDE"])
+    # The split stops at the first filter that cannot be applied early, so
+    # that the filters are still applied in order
+    assert list(early) == ["QUALITY_FLAG", "TIME"]
+    assert list(late) == ["blended_albedo", "LATITUDE"]
+    assert early["TIME"] == (np.datetime64("2020-01-01", "ns"), None)
+    assert parsers.split_filters(filters, []) == ({}, filters)
+
+    # Applying the two parts one after the other is the same as applying 
+    # all of the filters, including the counts
+    satellite = get_filter_dataset().assign(
+        blended_albedo=("N_OBS", np.linspace(-0.5, 1.5, 8)))
+    filters = parsers.get_filters({"FILTERS" : {
+        "QUALITY_FLAG" : [0, 0], "blended_albedo" : [0, 1], 
+        "LATITUDE" : [-60, 60]}})
+    early, late = parsers.split_filters(filters, ["QUALITY_FLAG", 
+                                                  "LATITUDE"])
+    with contextlib.redirect_stdout(None):
+        expected = parsers.apply_filters(satellite, filters)
+        split = parsers.apply_filters(satellite, early)
+        split = parsers.apply_filters(split, late)
+    xr.testing.assert_identical(split, expected)
+
+
+# test that reading TROPOMI files in blocks of scanlines gives the same 
+# pixels as reading the whole swath.
+
+def read_TROPOMI_swath(file_path, data_fields):
+    """
+    Reads a TROPOMI file for parsers.read_TROPOMI by loading every group in
+    full and keeping the pixels with a satellite column and a quality flag,
+    as read_TROPOMI did before it read blocks of scanlines.
+    """
+    groups = {"PRODUCT/" : None, 
+              "PRODUCT/SUPPORT_DATA/DETAILED_RESULTS" : None,
+              "PRODUCT/SUPPORT_DATA/INPUT_DATA" : None,
+              "PRODUCT/SUPPORT_DATA/GEOLOCATIONS" : [
+                  data_fields["LATITUDE_BOUNDS"], 
+                  data_fields["LONGITUDE_BOUNDS"]]}
+    satellite = []
+    for group, names in groups.items():
+        with xr.open_dataset(file_path, group=group) as data:
+            satellite.append((data if names is None else data[names]).load())
+    satellite = xr.merge(satellite, compat="override", join="exact")
+    satellite = satellite.rename({v : k for k, v in data_fields.items()
+                                  if v.lower() != "none" and v in satellite})
+    satellite = satellite.squeeze(drop=True)
+    satellite = satellite.stack(N_OBS=("scanline", "ground_pixel"))
+    satellite = satellite.reset_index("N_OBS", drop=True)
+    satellite = satellite.drop_vars(["scanline", "ground_pixel"], 
+                                    errors="ignore")
+    satellite = satellite.reset_coords(["LATITUDE", "LONGITUDE"])
+    valid = (satellite["SATELLITE_COLUMN"].notnull() 
+             & satellite["QUALITY_FLAG"].notnull())
+    satellite = satellite.isel(N_OBS=np.flatnonzero(valid.values))
+    satellite["SATELLITE_COLUMN"] *= 1e-9 
+    satellite = parsers.process_TROPOMI_variables(satellite)
+    return satellite.transpose("N_OBS", ...)
+
+
+def test_read_TROPOMI_blocks(tmp_path):
+    file_path = f"{tmp_path}/S5P_OFFL_L2__CH4.nc"
+    benchmark.make_TROPOMI_file(file_path, 3000, 12, benchmark.get_dates(1))
+    data_fields = read_config_fields()["TROPOMI"]["DATA_FIELDS"]
+    expected = read_TROPOMI_swath(file_path, data_fields)
+    assert expected.sizes["N_OBS"] > 2000
+    # One block for the whole swath, blocks that split the swath unevenly, 
+    # and one scanline per block
+    for block_size in [100000, 7, 1]:
+        satellite = parsers.read_TROPOMI(file_path, data_fields, block_size)
+        assert set(satellite.data_vars) == set(expected.data_vars)
+        xr.testing.assert_identical(
+            satellite.transpose("N_OBS", ...)[list(expected.data_vars)], 
+            expected)
+
+
+
+def test_read_TROPOMI_filters(tmp_path):
+    file_path = f"{tmp_path}/S5P_OFFL_L2__CH4.nc"
+    benchmark.make_TROPOMI_file(file_path, 3000, 12, benchmark.get_dates(1))
+    data_fields = read_config_fields()["TROPOMI"]["DATA_FIELDS"]
+    # The QUALITY_FLAG and LATITUDE filters are applied before the data are
+    # read, and blended_albedo (computed by the parser) afterwards
+    filters = parsers.get_filters({"FILTERS" : {
+        "QUALITY_FLAG" : [0.5, "none"], "LATITUDE" : [-60, 60], 
+        "blended_albedo" : ["none", 0.8], "LONGITUDE" : [100, -100]}})
+    with contextlib.redirect_stdout(None):
+        expected = parsers.apply_filters(
+            read_TROPOMI_swath(file_path, data_fields), filters)
+        satellite = parsers.read_TROPOMI(file_path, data_fields, 7, filters)
+    assert 0 < expected.sizes["N_OBS"] < 1000
+    assert all(expected.attrs[f"n_dropped_{name}"] > 0 for name in filters)
+    xr.testing.assert_identical(
+        satellite.transpose("N_OBS", ...)[list(expected.data_vars)], 
+        expected)
+
+
+# test the TCCON pressure grid shift against the original loop over profiles.
+
+def shift_tccon_profile(row, fill_zero=True):
+    """
+    The original, one profile at a time version of 
+    parsers.shift_tccon_pressure_grid.
+    """
+    isnan = np.isnan(row)
+    if np.all(isnan):
+        return row
+    if fill_zero:
+        fill_value = 0
+    else:
+        fill_value = row[~isnan][-1]
+    shift = max(np.argmax(~isnan), 0)
+    if shift == 0:
+        return row
+    return np.concatenate([row[shift:], np.full(shift, fill_value)])
+
+
+def test_shift_tccon_pressure_grid():
+    rng = np.random.default_rng(0)
+    n_edges = 8
+    data = rng.uniform(100, 1000, (50, n_edges))
+    # Random numbers of leading NaNs (below the TCCON surface), including 
+    # profiles that need no shift
+    n_leading = rng.integers(0, n_edges // 2, 50)
+    data[np.arange(n_edges) < n_leading[:, None]] = np.nan
+    data[0] = rng.uniform(100, 1000, n_edges)   # no shift
+    data[1, :-1] = np.nan                       # only the top level is valid
+    data[2, :] = np.nan                         # all NaN
+    data[3, [0, 1, 4]] = np.nan                 # a NaN after the surface
+    data[4, -2:] = np.nan                       # trailing NaNs
+
+    for fill_zero in [True, False]:
+        expected = np.stack([shift_tccon_profile(row, fill_zero) 
+                             for row in data])
+        np.testing.assert_array_equal(
+            parsers.shift_tccon_pressure_grid(data, fill_zero), expected)
+
+        # Several variables stacked along a leading dimension
+        np.testing.assert_array_equal(
+            parsers.shift_tccon_pressure_grid(np.stack([data, data[::-1]]),
+                                              fill_zero),
+            np.stack([expected, expected[::-1]]))
+
+
+# test the model time matching against the original matching of formatted
+# time strings.
+
+def get_strftime_index(satellite_times, model_times, time_format):
+    """
+    Matches each observation to the first model time that formats the same
+    with time_format (e.g., the same hour), or -1, as the original code did
+    with strftime. time_format can also be a function of the time.
+    """
+    if not callable(time_format):
+        time_format = (lambda fmt : lambda t : t.strftime(fmt))(time_format)
+    model_keys = [time_format(t) for t in pd.DatetimeIndex(model_times)]
+    first = {}
+    for i, key in enumerate(model_keys):
+        first.setdefault(key, i)
+    return np.array([-1 if pd.isnull(t) else first.get(time_format(t), -1)
+                     for t in pd.DatetimeIndex(satellite_times)])
+
+
+def get_nearest_index(satellite_times, model_times, time_step):
+    """
+    Matches each observation to the closest model time (the earlier one on
+    a tie) if it is within half a time step, or -1.
+    """
+    idx = []
+    for t in satellite_times:
+        distance = np.abs(model_times - t)
+        i = np.lexsort((model_times, distance))[0]
+        idx.append(i if not np.isnat(t) and distance[i] <= time_step / 2 
+                   else -1)
+    return np.array(idx)
+
+
+@pytest.mark.parametrize("time_step, offset, time_format", [
+    ("1h", "30min", "%Y-%m-%d.%H"),
+    ("1h", "0min", "%Y-%m-%d.%H"),
+    ("3h", "90min", lambda t : f"{t:%Y-%m-%d}.{t.hour // 3}"),
+    ("1D", "12h", "%Y-%m-%d")])
+def test_time_index(time_step, offset, time_format):
+    rng = np.random.default_rng(0)
+    step = pd.Timedelta(time_step).to_timedelta64()
+    model_times = (pd.date_range("2020-01-01", "2020-01-05", freq=time_step,
+                                 inclusive="left") 
+                   + pd.Timedelta(offset)).values
+    # Random times from a day before to a day after the model times, the 
+    # edges of the model time steps, and a missing time
+    satellite_times = np.concatenate([
+        np.datetime64("2019-12-31", "ns") 
+        + rng.integers(0, 6*86400, 2000).astype("timedelta64[s]"),
+        model_times[[0, -1]], model_times[[0, -1]] - step, 
+        model_times[[0, -1]] + step // 2, 
+        np.array(["2020-01-01", "2020-01-05", "NaT"], dtype="datetime64[ns]")])
+    satellite_times = satellite_times.astype("datetime64[ns]")
+    # The model times are not sorted
+    order = rng.permutation(len(model_times))
+    model_times = model_times[order]
+
+    expected = get_strftime_index(satellite_times, model_times, time_format)
+    for given_step in [None, time_step]:
+        idx = util.get_time_index(satellite_times, model_times, "floor", 
+                                  given_step)
+        np.testing.assert_array_equal(idx, expected)
+        idx = util.get_time_index(satellite_times, model_times, "nearest",
+                                  given_step)
+        np.testing.assert_array_equal(
+            idx, get_nearest_index(satellite_times, model_times, step))
+    # Times outside of the model time steps (and NaT) are not matched
+    assert 0 < np.sum(expected < 0) < len(expected) // 2
+    assert expected[-1] == -1
+
+    # A missing model time step is not matched, and the time step is still
+    # inferred from the other model times
+    keep = model_times != np.sort(model_times)[len(model_times) // 2]
+    np.testing.assert_array_equal(
+        util.get_time_index(satellite_times, model_times[keep]),
+        get_strftime_index(satellite_times, model_times[keep], time_format))
+
+
+# test that observations are matched to the model grid cell that contains 
+# them.
+
+def get_grid_cells(model_centers, satellite_data, periodic=False):
+    model_centers = np.asarray(model_centers)
+    return model_centers[util.get_grid_index(
+        model_centers, np.asarray(satellite_data, dtype=float), periodic,
+        xarray=False)]
+
+
+def test_grid_index_wraps_longitude():
+    # The 4 x 5 grid, where the -180 cell spans 177.5 to -177.5
+    model_lons = np.arange(-180., 180., 5.)
+    assert util.is_global_longitude(model_lons)
+    np.testing.assert_array_equal(
+        get_grid_cells(model_lons, 
+                       [178, 179.9, 180, -178, -177.6, 177.4, 182.4, -182.4,
+                        -177.4, 537.5],
+                       periodic=True),
+        [-180, -180, -180, -180, -180, 175, -180, -180, -175, -180])
+
+    # The nearest center (get_closest_index) does not wrap around
+    assert model_lons[util.get_closest_index(
+        model_lons, np.array([178.]), xarray=False)][0] == 175
+
+    # Grids that start at 0 wrap the same way
+    model_lons = np.arange(0., 360., 2.5)
+    np.testing.assert_array_equal(
+        get_grid_cells(model_lons, [-1, 358.8, 1.2, 1.3, -180], 
+                       periodic=True),
+        [0, 0, 0, 2.5, 180])
+
+    # Nested domains clamp to the boundary cell instead of wrapping
+    model_lons = np.arange(-130., -59., 0.3125)
+    assert not util.is_global_longitude(model_lons)
+    np.testing.assert_array_equal(
+        get_grid_cells(model_lons, [170, -179, -50]),
+        [model_lons[-1], model_lons[0], model_lons[-1]])
+
+
+def test_grid_index_half_polar_boxes():
+    # The 4 x 5 grid: the half-polar boxes at +/-89 span 88 to 90
+    model_lats = np.concatenate([[-89.], np.arange(-86., 87., 4.), [89.]])
+    np.testing.assert_array_equal(
+        get_grid_cells(model_lats, 
+                       [87.7, 87.99, 88, 88.01, 90, -87.7, -88.01, -90, 84.1]),
+        [86, 86, 86, 89, 89, -86, -89, -89, 86])
+    # The nearest center puts 87.7 in the polar box, which does not contain
+    # it
+    assert model_lats[util.get_closest_index(
+        model_lats, np.array([87.7]), xarray=False)][0] == 89
+
+    # The 2 x 2.5 grid, in descending order
+    model_lats = np.concatenate([[89.5], np.arange(88., -89., -2.), [-89.5]])
+    np.testing.assert_array_equal(
+        get_grid_cells(model_lats, [88.8, 89.1, -88.8, -89.1, 0.9, 1.1]),
+        [88, 89.5, -88, -89.5, 0, 2])
+
+    # Away from the poles and the date line, the cell that contains each 
+    # observation has the nearest center
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-85, 85, 1000)
+    np.testing.assert_array_equal(
+        util.get_grid_index(model_lats, lats, xarray=False),
+        util.get_closest_index(model_lats, lats, xarray=False))
+
+
+# test that observations are matched to the closest cell of a cubed-sphere 
+# grid.
+
+def get_nearest_cells(model_lats, model_lons, lats, lons):
+    # The brute-force search over every cell, by great circle distance
+    model_vectors = util._get_unit_vectors(model_lats, model_lons)
+    cos_distance = (util._get_unit_vectors(lats, lons) 
+                    @ model_vectors.reshape(-1, 3).T)
+    return cos_distance, cos_distance.argmax(axis=1)
+
+
+def test_spatial_index():
+    pytest.importorskip("scipy")
+    model_lats, model_lons = benchmark.get_cubed_sphere_grid(12)
+    index = util.SpatialIndex(model_lats, model_lons)
+
+    # Random observations, the poles, the date line (in either convention),
+    # and the cube corners and edges
+    rng = np.random.default_rng(0)
+    lats = np.concatenate([
+        np.degrees(np.arcsin(rng.uniform(-1, 1, 5000))),
+        [90, -90, 89.99, -89.99, 0, 0, 0, 30, -30, 35.26, -35.26, 35.26, 45],
+    ])
+    lons = np.concatenate([
+        rng.uniform(-180, 180, 5000),
+        [0, 0, 123, -45, 180, -180, 179.99, -180, 540, 45, 135, -135, 0],
+    ])
+    cell = index.query(lats, lons)
+    assert len(cell) == 3
+    cos_distance, nearest = get_nearest_cells(model_lats, model_lons, 
+                                              lats, lons)
+    # Ties are resolved either way, so compare the distances
+    np.testing.assert_allclose(
+        cos_distance[np.arange(len(lats)), 
+                     np.ravel_multi_index(cell, model_lats.shape)],
+        cos_distance[np.arange(len(lats)), nearest], rtol=0, atol=1e-12)
+
+    # Longitudes that differ by 360 are in the same cell
+    cell = index.query([7, 7, 7], [183, -177, 543])
+    assert all(np.all(c == c[0]) for c in cell)
+
+    # Each cell center is matched to its own cell
+    np.testing.assert_array_equal(
+        np.ravel_multi_index(index.query(model_lats.ravel(), 
+                                         model_lons.ravel() - 360), 
+                             model_lats.shape),
+        np.arange(model_lats.size))
+
+
+def test_spatial_index_load(tmp_path, capsys):
+    pytest.importorskip("scipy")
+    model_lats, model_lons = benchmark.get_cubed_sphere_grid(8)
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-90, 90, 100)
+    lons = rng.uniform(-180, 180, 100)
+
+    util._spatial_indices.clear()
+    index = util.SpatialIndex.load(model_lats, model_lons, tmp_path)
+    assert "Building" in capsys.readouterr().out
+    assert len(glob.glob(f"{tmp_path}/spatial_index_*.pkl")) == 1
+    expected = index.query(lats, lons)
+
+    # The same grid is reused from memory, and then from the saved index
+    assert util.SpatialIndex.load(model_lats, model_lons, tmp_path) is index
+    util._spatial_indices.clear()
+    index = util.SpatialIndex.load(model_lats, model_lons, tmp_path)
+    assert "Building" not in capsys.readouterr().out
+    np.testing.assert_array_equal(index.query(lats, lons), expected)
+
+    # Another grid has its own index
+    util.SpatialIndex.load(*benchmark.get_cubed_sphere_grid(6), tmp_path)
+    assert "Building" in capsys.readouterr().out
+    assert len(glob.glob(f"{tmp_path}/spatial_index_*.pkl")) == 2
+    util._spatial_indices.clear()
+
+
+def test_colocate_cubed_sphere(tmp_path):
+    pytest.importorskip("scipy")
+    dates = benchmark.get_dates(1)
+    benchmark.make_GCHP_files(f"{tmp_path}/gchp", dates, n_levels=5, 
+                              cube_size=12)
+    model_files = [np.array([f"{tmp_path}/gchp/GCHP.{kind}."
+                             f"{dates[0].replace('-', '')}_0000z.nc4"])
+                   for kind in ["SpeciesConc", "LevelEdgeDiags"]]
+    fields = read_config_fields()["MODEL"]["DATA_FIELDS"]
+    model = parsers.read_geoschem_file(
+        *model_files, dict(fields, LATITUDE="lats", LONGITUDE="lons"))
+    assert model["LATITUDE"].dims == ("FACE", "Y", "X")
+
+    observations = benchmark.make_observations(1000, 5, dates)
+    satellite = xr.Dataset({
+        "TIME" : ("N_OBS", observations["time"]),
+        "LATITUDE" : ("N_OBS", observations["latitude"]),
+        "LONGITUDE" : ("N_OBS", observations["longitude"])})
+    util._spatial_indices.clear()
+    with contextlib.redirect_stdout(None):
+        idx = util.get_colocation_indices(model, satellite, 
+                                          spatial_index_dir=tmp_path)
+    assert set(idx) == {"face", "y", "x", "time"}
+
+    # The model values of each observation are those of the closest cell
+    _, nearest = get_nearest_cells(
+        model["LATITUDE"].values, model["LONGITUDE"].values, 
+        satellite["LATITUDE"].values, satellite["LONGITUDE"].values)
+    np.testing.assert_array_equal(
+        np.ravel_multi_index((idx["face"].values, idx["y"].values, 
+                              idx["x"].values), model["LATITUDE"].shape),
+        nearest)
+    colocated = util.colocate_obs(model, satellite)
+    np.testing.assert_array_equal(
+        colocated["LATITUDE"].values, 
+        model["LATITUDE"].values.ravel()[nearest])
+    util._spatial_indices.clear()
+
+
+# test footprint sampling with footprints that have known overlap fractions.
+
+def get_footprint_weights(model_lats, model_lons, lat_bounds, lon_bounds):
+    """
+    Gets the weights from util.get_footprint_weights as a list with a 
+    dictionary of {(model latitude, model longitude) : weight} for each
+    footprint.
+    """
+    obs, lat_idx, lon_idx, weight = util.get_footprint_weights(
+        model_lats, model_lons, np.array(lat_bounds), np.array(lon_bounds))
+    weights = [{} for _ in lat_bounds]
+    for o, i, j, w in zip(obs, lat_idx, lon_idx, weight):
+        weights[o][(model_lats[i], model_lons[j])] = w
+    return weights
+
+
+def get_latitude_fraction(south, edge, north):
+    """
+    Gets the fraction of the area of a band of constant width in longitude 
+    between the latitudes south and north that is south of edge.
+    """
+    sin = np.sin(np.radians([south, edge, north]))
+    return (sin[1] - sin[0]) / (sin[2] - sin[0])
+
+
+def check_footprint_weights(weights, expected):
+    assert set(weights) == set(expected), (weights, expected)
+    for cell, weight in expected.items():
+        np.testing.assert_allclose(weights[cell], weight, rtol=1e-10)
+
+
+def test_footprint_weights():
+    # The global 4 x 5 GEOS-Chem grid, with half-polar boxes
+    model_lats = np.concatenate([[-89.], np.arange(-86., 87., 4.), [89.]])
+    model_lons = np.arange(-180., 180., 5.)
+    weights = get_footprint_weights(
+        model_lats, model_lons,
+        [[10, 10, 14, 14],       # axis-aligned box across four cells
+         [-1, 0, 1, 0],          # diamond centered on a cell corner
+         [10.5, 10.5, 11.5, 11.5],  # box across the date line
+         [10.5, 10.5, 11.5, 11.5],  # box inside one cell
+         [87, 87, 91, 91],       # box across the pole
+         [-91, -91, -87, -87]],
+        [[1, 6, 6, 1],
+         [2.5, 1.5, 2.5, 3.5],
+         [176, -179, -179, 176],
+         [21, 22, 22, 21],
+         [0, 2, 2, 0],
+         [0, 2, 2, 0]])
+    # The areas shrink with cos(latitude), so the part of the box below 
+    # 12 degrees weighs more than the part above it
+    south = get_latitude_fraction(10, 12, 14)
+    assert south > 0.5
+    check_footprint_weights(weights[0], {(10., 0.) : south*0.3, 
+                                         (10., 5.) : south*0.7,
+                                         (14., 0.) : (1 - south)*0.3,
+                                         (14., 5.) : (1 - south)*0.7})
+    check_footprint_weights(weights[1], {(-2., 0.) : 0.25, (-2., 5.) : 0.25,
+                                         (2., 0.) : 0.25, (2., 5.) : 0.25})
+    check_footprint_weights(weights[2], {(10., 175.) : 0.3, 
+                                         (10., -180.) : 0.7})
+    check_footprint_weights(weights[3], {(10., 20.) : 1.0})
+    # Only the part of the footprint inside the grid (up to 90) counts
+    north = get_latitude_fraction(87, 88, 90)
+    check_footprint_weights(weights[4], {(86., 0.) : north, 
+                                         (89., 0.) : 1 - north})
+    check_footprint_weights(weights[5], {(-86., 0.) : north, 
+                                         (-89., 0.) : 1 - north})
+
+    # A regional grid (in descending order), with footprints that are 
+    # partly and entirely outside of the grid
+    model_lats = np.arange(30.5, 10., -1.)
+    model_lons = np.arange(0.5, 20., 1.)
+    weights = get_footprint_weights(
+        model_lats, model_lons,
+        [[20.25, 20.25, 20.75, 20.75],
+         [-40, -40, -39, -39]],
+        [[-0.5, 0.5, 0.5, -0.5],
+         [5, 6, 6, 5]])
+    check_footprint_weights(weights[0], {(20.5, 0.5) : 1.0})
+    assert weights[1] == {}
+
+    # The weights of random footprints (with random rotations) sum to 1
+    rng = np.random.default_rng(0)
+    n_obs = 1000
+    center_lats = rng.uniform(-80, 80, n_obs)
+    center_lons = rng.uniform(-180, 180, n_obs)
+    angles = (rng.uniform(0, 2*np.pi, n_obs)[:, None] 
+              + np.arange(4)*np.pi/2)
+    obs, _, _, weight = util.get_footprint_weights(
+        np.concatenate([[-89.], np.arange(-86., 87., 4.), [89.]]), 
+        np.arange(-180., 180., 5.), 
+        center_lats[:, None] + 3*np.sin(angles),
+        center_lons[:, None] + 4*np.cos(angles))
+    np.testing.assert_allclose(np.bincount(obs, weights=weight), 1)
+
+
+
+def test_footprint_operator(tmp_path):
+    model, satellite = read_benchmark_data(tmp_path)
+    conc_vars = operators.get_conc_vars(model)
+    satellite = satellite.assign(
+        LATITUDE_BOUNDS=(("N_OBS", "N_CORNERS"), np.clip(
+            satellite["LATITUDE"].values[:, None] 
+            + np.array([-2, -2, 2, 2]), -90, 90)),
+        LONGITUDE_BOUNDS=(("N_OBS", "N_CORNERS"), 
+            satellite["LONGITUDE"].values[:, None] 
+            + np.array([-2.5, 2.5, 2.5, -2.5])))
+    operator = operators.ObservationOperator.build(model, satellite, "edges",
+                                                   footprint=True)
+    model_columns = operator.apply_to_model(model, conc_vars)
+    idx = operator.idx
+    assert operator.n_profiles == idx.sizes["N_PAIRS"] <= 4*operator.n_obs
+
+    # The weighted sum of the columns of observations moved to the center
+    # of each of the cells
+    obs = idx["obs"].values
+    moved = satellite.isel(N_OBS=obs).assign(
+        LATITUDE=("N_OBS", model["LATITUDE"].values[idx["lat"].values]),
+        LONGITUDE=("N_OBS", model["LONGITUDE"].values[idx["lon"].values]))
+    cell_columns = operators.ObservationOperator.build(
+        model, moved, "edges").apply_to_model(model, conc_vars)
+    expected = np.stack([np.bincount(obs, weights=idx["weight"].values 
+                                     * cell_columns[:, k])
+                         for k in range(len(conc_vars))], axis=1)
+    np.testing.assert_allclose(model_columns, expected, rtol=1e-10)
+
+    # The store only has room for the cells that each footprint may overlap
+    n_cells = util.get_footprint_cells(
+        model["LATITUDE"].values, model["LONGITUDE"].values,
+        satellite["LATITUDE_BOUNDS"].values, 
+        satellite["LONGITUDE_BOUNDS"].values)
+    store = operators.OperatorStore(
+        f"{tmp_path}/store", operator.n_obs, operator.n_model_levels, 
+        "footprint", n_cells=n_cells)
+    assert store.components["h"].shape[0] == n_cells.sum()
+    chunks = np.array_split(np.random.default_rng(0).permutation(
+        operator.n_obs), 3)
+    for chunk in chunks:
+        with contextlib.redirect_stdout(None):
+            chunk_operator = operators.ObservationOperator.build(
+                model, satellite.isel(N_OBS=chunk), "edges", footprint=True)
+        store.put(chunk, chunk_operator, model)
+    for chunk in [np.arange(operator.n_obs), np.arange(100, 300)]:
+        stored = store.get(chunk, model)
+        np.testing.assert_array_equal(
+            stored.apply_to_model(model, conc_vars), model_columns[chunk])
+
+
+# test that both EXECUTION modes write the observations in file order.
+
+def run_main(config, directory):
+    """ Runs main.py with config and returns what it printed. """
+    config_file = f"{directory}/config.yaml"
+    with open(config_file, "w") as f:
+        yaml.safe_dump(config, f)
+    return subprocess.run([sys.executable, "main.py", config_file], 
+                          check=True, 
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, text=True).stdout
+
+
+def test_execution_modes_keep_file_order(tmp_path):
+    dates = benchmark.get_dates(2)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10, 
+                                  n_tracers=2)
+    # Observations that are not sorted by time, so that the chunks (which 
+    # are grouped by date) do not follow the file order
+    observations = benchmark.make_observations(2000, 8, dates)
+    order = np.random.default_rng(0).permutation(2000)
+    observations = {k : v[order] for k, v in observations.items()}
+    os.makedirs(f"{tmp_path}/obs")
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_0.nc", observations)
+
+    outputs = {}
+    for execution in ["eager", "dask"]:
+        config = benchmark.make_config(
+            tmp_path, EXECUTION=execution, CHUNK_MEMORY_BUDGET=2e6,
+            SAVE_DIR=f"{tmp_path}/{execution}")
+        run_main(config, tmp_path)
+        outputs[execution] = xr.open_dataset(
+            f"{tmp_path}/{execution}/generic_0_operator.nc").load()
+    xr.testing.assert_equal(outputs["eager"], outputs["dask"])
+
+    # The observations (those with model data) are numbered and written in
+    # file order
+    output = outputs["eager"]
+    assert np.all(np.diff(output["N_OBS"].values) > 0)
+    file_index = pd.Index(observations["time"]).get_indexer(
+        output["TIME"].values)
+    assert np.all(file_index >= 0) and np.all(np.diff(file_index) > 0)
+
+
+# test that a run that is interrupted after a chunk is written resumes and
+# writes the same output.
+
+INTERRUPT_AFTER_CHUNK = """
+import os
+import runpy
+import sys
+sys.path.insert(0, os.getcwd())
+import utilities
+
+write_chunk = utilities.write_chunk
+n_written = []
+
+def write_chunk_and_exit(*args):
+    write_chunk(*args)
+    n_written.append(1)
+    if len(n_written) == {n_chunks}:
+        os._exit(1)
+
+utilities.write_chunk = write_chunk_and_exit
+sys.argv = ["main.py", "{config_file}"]
+runpy.run_path("main.py", run_name="__main__")
+"""
+
+
+def test_resume_after_interrupted_run(tmp_path):
+    dates = benchmark.get_dates(2)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10, 
+                                  n_tracers=2)
+    # One file sorted by time and one that is not (whose chunks are put 
+    # back in file order when they are combined)
+    observations = benchmark.make_observations(2000, 8, dates)
+    os.makedirs(f"{tmp_path}/obs")
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_0.nc", observations)
+    order = np.random.default_rng(0).permutation(2000)
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_1.nc", 
+                                {k : v[order] 
+                                 for k, v in observations.items()})
+
+    outputs = {}
+    # About 30 chunks per file. The runs are interrupted in the first and
+    # in the second file.
+    for name, n_chunks in [("reference", None), ("resumed", 3), 
+                           ("resumed_late", 40)]:
+        config = benchmark.make_config(tmp_path, CHUNK_MEMORY_BUDGET=1e5,
+                                       SAVE_DIR=f"{tmp_path}/{name}")
+        if n_chunks is not None:
+            config_file = f"{tmp_path}/config_{name}.yaml"
+            with open(config_file, "w") as f:
+                yaml.safe_dump(config, f)
+            result = subprocess.run(
+                [sys.executable, "-c", INTERRUPT_AFTER_CHUNK.format(
+                    n_chunks=n_chunks, config_file=config_file)],
+                cwd=os.path.dirname(os.path.abspath(__file__)), 
+                stdout=subprocess.DEVNULL)
+            assert result.returncode == 1
+            assert len(glob.glob(f"{tmp_path}/{name}/*_parts/chunk_*.nc")) > 0
+        run_main(config, tmp_path)
+        outputs[name] = [xr.open_dataset(
+            f"{tmp_path}/{name}/generic_{i}_operator.nc").load() 
+            for i in range(2)]
+
+    for name in ["resumed", "resumed_late"]:
+        for output, reference in zip(outputs[name], outputs["reference"]):
+            xr.testing.assert_identical(output, reference)
+    for output in outputs["reference"]:
+        assert np.all(np.diff(output["N_OBS"].values) > 0)
+
+
+# test that the operator store is reused with any chunking and rebuilt when
+# the observations or the settings change.
+
+def test_operator_store(tmp_path):
+    dates = benchmark.get_dates(2)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10, 
+                                  n_tracers=2)
+    observations = benchmark.make_observations(2000, 8, dates)
+    os.makedirs(f"{tmp_path}/obs")
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_0.nc", observations)
+
+    def run(name, **settings):
+        config = benchmark.make_config(
+            tmp_path, SAVE_DIR=f"{tmp_path}/{name}", **settings)
+        stdout = run_main(config, tmp_path)
+        output = xr.open_dataset(
+            f"{tmp_path}/{name}/generic_0_operator.nc").load()
+        return output, stdout
+
+    reference, _ = run("reference", CHUNK_MEMORY_BUDGET=1e5)
+
+    # The store is built with small chunks and reused with one chunk per 
+    # date and with settings that do not change the output
+    output, stdout = run("small", CHUNK_MEMORY_BUDGET=1e5, 
+                         SAVE_INTERPOLATION="True")
+    assert "pre-computed observation operator" not in stdout
+    xr.testing.assert_identical(output, reference)
+    for settings in [{"CHUNK_MEMORY_BUDGET" : 1e8}, 
+                     {"CHUNK_MEMORY_BUDGET" : 3e5, "N_THREADS" : 2}]:
+        output, stdout = run("large", SAVE_INTERPOLATION="True", **settings)
+        assert "(2000 of 2000 observations)" in stdout
+        assert "Computing time and space indices" not in stdout
+        xr.testing.assert_identical(output, reference)
+
+    # Settings that change the operator make the store stale
+    output, stdout = run("nearest", CHUNK_MEMORY_BUDGET=1e5, 
+                         SAVE_INTERPOLATION="True", TIME_MATCHING="nearest")
+    assert "are stale. Rebuilding." in stdout
+    expected, _ = run("nearest_reference", CHUNK_MEMORY_BUDGET=1e5,
+                      TIME_MATCHING="nearest")
+    xr.testing.assert_identical(output, expected)
+
+    # So do new averaging kernels in the satellite file
+    observations["averaging_kernel"] = observations["averaging_kernel"][::-1]
+    benchmark.make_generic_file(f"{tmp_path}/obs/generic_0.nc", observations)
+    output, stdout = run("changed", CHUNK_MEMORY_BUDGET=1e5, 
+                         SAVE_INTERPOLATION="True")
+    assert "are stale. Rebuilding." in stdout
+    expected, _ = run("changed_reference", CHUNK_MEMORY_BUDGET=1e5)
+    xr.testing.assert_identical(output, expected)
+    assert not output.equals(reference)
+
+
+# test that REPROCESS: 'False' only skips the satellite files whose inputs
+# have not changed.
+
+def test_reprocess_manifest(tmp_path):
+    dates = benchmark.get_dates(3)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10)
+    os.makedirs(f"{tmp_path}/obs")
+    # One satellite file on each of the first two dates
+    for i in range(2):
+        benchmark.make_generic_file(
+            f"{tmp_path}/obs/generic_{i}.nc",
+            benchmark.make_observations(500, 8, dates[i:i + 1], seed=i))
+
+    def get_processed(**settings):
+        config = benchmark.make_config(
+            tmp_path, **{"REPROCESS" : "False", **settings})
+        stdout = run_main(config, tmp_path)
+        return [i for i in range(2) if f"Processing generic_{i}.nc" in stdout]
+
+    assert get_processed() == [0, 1]
+    assert get_processed() == []
+    output = f"{tmp_path}/out/generic_0_operator.nc"
+    mtime = os.stat(output).st_mtime_ns
+
+    # A changed satellite file
+    benchmark.make_generic_file(
+        f"{tmp_path}/obs/generic_1.nc",
+        benchmark.make_observations(400, 8, dates[1:2], seed=2))
+    assert get_processed() == [1]
+
+    # Changed model files, which are only used for their own date
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates[2:], n_levels=10,
+                                  seed=1)
+    assert get_processed() == []
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates[:1], n_levels=10,
+                                  seed=1)
+    assert get_processed() == [0]
+    assert os.stat(output).st_mtime_ns != mtime
+
+    # Settings that do not change the output, and settings that do
+    assert get_processed(N_THREADS=2, MODEL_CACHE_SIZE=1e8) == []
+    assert get_processed(TIME_MATCHING="nearest") == [0, 1]
+    assert get_processed(TIME_MATCHING="nearest") == []
+
+    # A missing output file or manifest
+    os.remove(output)
+    os.remove(f"{tmp_path}/out/manifest/generic_1.json")
+    assert get_processed(TIME_MATCHING="nearest") == [0, 1]
+
+    # REPROCESS: 'True' processes every file
+    assert get_processed(TIME_MATCHING="nearest", REPROCESS="True") == [0, 1]
+
+
+# test appending to the output store and selecting observations from it.
+
+def get_output(n_obs, seed):
+    rng = np.random.default_rng(seed)
+    return xr.Dataset(
+        {"TIME" : ("N_OBS", np.datetime64("2020-01-01", "ns") 
+                   + np.sort(rng.integers(0, 86400, n_obs))
+                   .astype("timedelta64[s]")),
+         "LATITUDE" : ("N_OBS", rng.uniform(-90, 90, n_obs)),
+         "LONGITUDE" : ("N_OBS", rng.uniform(-180, 180, n_obs)),
+         "MODEL_COLUMN_CH4" : ("N_OBS", rng.uniform(1.7e-6, 1.9e-6, n_obs)),
+         "MODEL_COLUMN_RUNS" : (("N_OBS", "N_RUNS"), 
+                                rng.uniform(size=(n_obs, 2)))},
+        coords={"N_OBS" : np.arange(n_obs)})
+
+
+def check_selected(selected, expected):
+    xr.testing.assert_equal(
+        selected.drop_vars(["SOURCE_INDEX", *[
+            v for v in selected.data_vars if "SOURCE" in selected[v].dims]]),
+        expected.drop_vars("N_OBS"))
+
+
+@pytest.mark.parametrize("extension", ["nc", "zarr"])
+def test_output_store(tmp_path, extension):
+    if extension == "zarr" and util.zarr is None:
+        with pytest.raises(ImportError):
+            util.OutputStore(f"{tmp_path}/store.zarr")
+        pytest.skip("zarr is not installed")
+    path = f"{tmp_path}/store.{extension}"
+    store = util.OutputStore(path, chunk_size=30)
+    outputs = {"a.nc" : get_output(50, 0), "b.nc" : get_output(20, 1)}
+    for i, (name, output) in enumerate(outputs.items()):
+        store.append(output, name, mtime=i)
+    assert store.get_index() == {
+        "a.nc" : {"entry" : 0, "start" : 0, "count" : 50, "mtime" : 0},
+        "b.nc" : {"entry" : 1, "start" : 50, "count" : 20, "mtime" : 1}}
+    with util.open_output_store(path) as data:
+        check_selected(util.select_observations(data), 
+                       xr.concat(list(outputs.values()), dim="N_OBS"))
+        check_selected(util.select_observations(data, ["b.nc"]), 
+                       outputs["b.nc"])
+
+    # Appending a file again replaces its observations
+    outputs["a.nc"] = get_output(40, 2)
+    store.append(outputs["a.nc"], "a.nc", mtime=2, 
+                 previous=store.get_index()["a.nc"])
+    assert store.get_index() == {
+        "b.nc" : {"entry" : 1, "start" : 50, "count" : 20, "mtime" : 1},
+        "a.nc" : {"entry" : 2, "start" : 70, "count" : 40, "mtime" : 2}}
+    with util.open_output_store(path) as data:
+        assert data.sizes["N_OBS"] == 110
+        assert np.all(data["SOURCE_INDEX"].values[:50] == -1)
+        check_selected(util.select_observations(data), 
+                       xr.concat([outputs["b.nc"], outputs["a.nc"]], 
+                                 dim="N_OBS"))
+        check_selected(util.select_observations(data, ["a.nc"]), 
+                       outputs["a.nc"])
+
+        # Selecting by time and region, inclusive of the bounds
+        everything = xr.concat([outputs["b.nc"], outputs["a.nc"]], 
+                               dim="N_OBS")
+        times = everything["TIME"].values
+        time_range = (np.sort(times)[5], np.sort(times)[50])
+        lat_range, lon_range = (-30, 45.5), (0, 180)
+        expected = everything.isel(N_OBS=np.flatnonzero(
+            (times >= time_range[0]) & (times <= time_range[1])
+            & (everything["LATITUDE"].values >= lat_range[0])
+            & (everything["LATITUDE"].values <= lat_range[1])
+            & (everything["LONGITUDE"].values >= lon_range[0])))
+        assert 0 < expected.sizes["N_OBS"] < 60
+        check_selected(util.select_observations(
+            data, time_range=(str(time_range[0]), str(time_range[1])), 
+            lat_range=lat_range, lon_range=lon_range), expected)
+        assert util.select_observations(
+            data, ["b.nc"], lat_range=(91, 95)).sizes["N_OBS"] == 0
+
+    # Observations left by an append that did not finish are not selected
+    leftover = get_output(10, 3).drop_vars("N_OBS")
+    leftover["SOURCE_INDEX"] = ("N_OBS", np.full(10, -1, dtype=np.int32))
+    store._append(leftover, "N_OBS")
+    with util.open_output_store(path) as data:
+        assert data.sizes["N_OBS"] == 120
+        check_selected(util.select_observations(data), everything)
+
+    # Outputs with other variables are not mixed into the store
+    with pytest.raises(ValueError):
+        store.append(get_output(5, 4).drop_vars("MODEL_COLUMN_CH4"), 
+                     "c.nc", mtime=3)
+
+
+def test_output_store_main(tmp_path):
+    dates = benchmark.get_dates(2)
+    benchmark.make_geoschem_files(f"{tmp_path}/gc", dates, n_levels=10)
+    os.makedirs(f"{tmp_path}/obs")
+    for i in range(2):
+        benchmark.make_generic_file(
+            f"{tmp_path}/obs/generic_{i}.nc",
+            benchmark.make_observations(500, 8, dates, seed=i))
+    path = f"{tmp_path}/store.nc"
+    config = benchmark.make_config(tmp_path, OUTPUT_STORE=path, 
+                                   OUTPUT_STORE_CHUNK_SIZE=128)
+    stdout = run_main(config, tmp_path)
+    assert "Added 2 files" in stdout
+
+    # Unchanged outputs are not added again, and reprocessed ones replace
+    # their old observations
+    config["LOCAL_SETTINGS"]["REPROCESS"] = "False"
+    assert "Added 0 files" in run_main(config, tmp_path)
+    config["LOCAL_SETTINGS"]["REPROCESS"] = "True"
+    assert "Added 2 files" in run_main(config, tmp_path)
+    with util.open_output_store(path) as data:
+        assert data.sizes["N_OBS"] == 2000
+        for i in range(2):
+            with xr.open_dataset(
+                f"{tmp_path}/out/generic_{i}_operator.nc") as output:
+                check_selected(util.select_observations(
+                    data, [f"generic_{i}.nc"]), output)
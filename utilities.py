@@ -1,11 +1,37 @@
 import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import netCDF4
 import numpy as np
+import pandas as pd
 import xarray as xr
 
-def get_file_lists(local_config):
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+def get_file_lists(local_config, config_fingerprint=None, time_name="time"):
     '''
     Build lists of satellite, model edge, and model concentration files to process. 
     Directories and file name formats come from config.yaml LOCAL_SETTINGS.
+    The model files are returned as catalogs of their time steps (see 
+    get_model_catalog, which reads the time_name coordinate): one for the 
+    model edge files and a list with one for the concentration files of 
+    each model run (see get_model_concentration_dirs).
+
+    If REPROCESS is 'False', satellite files whose inputs have not changed 
+    since they were last processed (see is_processed) are skipped. 
+    config_fingerprint is from get_config_fingerprint.
     '''
 
     sat_files = f"{local_config['OBS_DIR']}/{local_config['OBS_FILE_FORMAT']}"
@@ -16,9 +42,11 @@ def get_file_lists(local_config):
                      f"{local_config['LEVEL_EDGE_FILE_FORMAT']}")
     model_edge_files = np.array(sorted(glob.glob(model_edge_files)))
 
-    model_conc_files = (f"{local_config['MODEL_CONCENTRATION_DIR']}/"
-                        f"{local_config['CONCENTRATION_FILE_FORMAT']}")
-    model_conc_files = np.array(sorted(glob.glob(model_conc_files)))
+    # In batch mode, there is one list of concentration files per model run
+    model_conc_files = []
+    for conc_dir in get_model_concentration_dirs(local_config):
+        conc_files = f"{conc_dir}/{local_config['CONCENTRATION_FILE_FORMAT']}"
+        model_conc_files.append(np.array(sorted(glob.glob(conc_files))))
 
     # Require that all of these lists contain files.
     if len(sat_files) == 0:
@@ -32,111 +60,1259 @@ def get_file_lists(local_config):
               f"{local_config['LEVEL_EDGE_FILE_FORMAT']}")
         raise ValueError("Model edge files are empty.")
     
-    if len(model_conc_files) == 0:
-        print(f"Model concentration directory: "
-              f"{local_config['MODEL_CONCENTRATION_DIR']}/"
-              f"{local_config['CONCENTRATION_FILE_FORMAT']}")
-        raise ValueError("Model concentration files are empty.")
+    for conc_dir, conc_files in zip(get_model_concentration_dirs(local_config),
+                                    model_conc_files):
+        if len(conc_files) == 0:
+            print(f"Model concentration directory: "
+                  f"{conc_dir}/{local_config['CONCENTRATION_FILE_FORMAT']}")
+            raise ValueError("Model concentration files are empty.")
+
+    # Catalog the time steps in the model files
+    model_edge_files = get_model_catalog(model_edge_files, local_config, 
+                                         time_name)
+    model_conc_files = [get_model_catalog(conc_files, local_config, time_name)
+                        for conc_files in model_conc_files]
     
-    # If not reprocess, remove 
+    # If not reprocess, remove the files whose inputs have not changed
     if local_config["REPROCESS"].lower() == "false":
-        # Get list of processed files
-        proc_files = f"{local_config['SAVE_DIR']}/*"
-        proc_files = np.array(sorted(glob.glob(proc_files)))
-
-        # Compare to the staellite files
-        proc_files = [f.split("/")[-1].split("_operator.nc")[0] 
-                      for f in proc_files]
-        excl_files = [f.split("/")[-1] for f in sat_files
-                      if f.split("/")[-1].split(".")[0] in proc_files]
-        sat_files = [f for f in sat_files 
-                     if f.split("/")[-1].split(".")[0] not in proc_files]
+        processed = [is_processed(f, model_edge_files, model_conc_files, 
+                                  local_config["SAVE_DIR"], config_fingerprint)
+                     for f in sat_files]
+        excl_files = [f.split("/")[-1] for f, p in zip(sat_files, processed) 
+                      if p]
+        sat_files = [f for f, p in zip(sat_files, processed) if not p]
 
         print(f"  Skipping ", excl_files)
 
     return sat_files, model_edge_files, model_conc_files
 
 
-def get_gc_dates(file_names):
+def _get_file_stat(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_input_record(satellite_file, satellite_dates, model_edge_catalog, 
+                     model_conc_catalogs, config_fingerprint=None):
+    '''
+    Gets a record of the inputs used to process a satellite file: the size 
+    and modification time of the satellite file and of the model files for
+    satellite_dates (the dates in the satellite file, see 
+    ModelCatalog.get_files_for_dates), and the config fingerprint.
+    '''
+    model_files = np.concatenate(
+        [catalog.get_files_for_dates(satellite_dates) 
+         for catalog in [model_edge_catalog] + list(model_conc_catalogs)])
+    return {"satellite_file" : _get_file_stat(satellite_file),
+            "dates" : sorted(satellite_dates),
+            "model_files" : {str(f) : _get_file_stat(f) for f in model_files},
+            "config" : config_fingerprint}
+
+
+def get_manifest_file(satellite_file, save_dir):
+    name = satellite_file.split("/")[-1].split(".")[0]
+    return f"{save_dir}/manifest/{name}.json"
+
+
+def write_manifest(satellite_file, save_dir, record, output_file=None):
+    '''
+    Records the inputs (from get_input_record) used to write output_file, 
+    which is None if the satellite file had no output (e.g., no overlapping
+    model dates). There is one manifest file per satellite file in 
+    <SAVE_DIR>/manifest so that worker processes never write the same file.
+    This should be called after the output file is complete.
+    '''
+    manifest_file = get_manifest_file(satellite_file, save_dir)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    record = dict(record)
+    record["output"] = (None if output_file is None 
+                        else output_file.split("/")[-1])
+    _write_json(manifest_file, record)
+
+
+def is_processed(satellite_file, model_edge_catalog, model_conc_catalogs, 
+                 save_dir, config_fingerprint=None):
+    '''
+    Checks whether a satellite file was processed with the same inputs as 
+    it would be now: the satellite file, the model files for its dates, and
+    the config are unchanged, and its output file exists. Outputs without a
+    manifest (e.g., from an interrupted run) are not counted as processed.
+    '''
+    manifest_file = get_manifest_file(satellite_file, save_dir)
+    if not os.path.exists(manifest_file):
+        return False
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if (manifest["output"] is not None 
+        and not os.path.exists(f"{save_dir}/{manifest['output']}")):
+        return False
+    record = get_input_record(satellite_file, manifest["dates"], 
+                              model_edge_catalog, model_conc_catalogs, 
+                              config_fingerprint)
+    return all(record[k] == manifest[k] for k in record)
+
+
+def get_model_concentration_dirs(local_config):
     '''
-    TO DO: switch to YYYYMMDD reading of config.yaml inputs
-    so that this is more flexible if file formats ever change.
+    Gets the list of model concentration directories. In batch mode (e.g.,
+    for the perturbation simulations of a Jacobian), MODEL_CONCENTRATION_DIRS
+    lists one directory per model run, which all share the LevelEdgeDiags in
+    MODEL_LEVEL_EDGE_DIR. Otherwise, this is just MODEL_CONCENTRATION_DIR.
     '''
-    dates = [d.split("/")[-1].split(".")[-2].split("_")[0] 
-             for d in file_names]
-    dates = [f"{d[:4]}-{d[4:6]}-{d[6:]}" for d in dates]
-    return dates
+    if local_config.get("MODEL_CONCENTRATION_DIRS"):
+        return list(local_config["MODEL_CONCENTRATION_DIRS"])
+    return [local_config["MODEL_CONCENTRATION_DIR"]]
+
+
+def is_batch_mode(local_config):
+    return bool(local_config.get("MODEL_CONCENTRATION_DIRS"))
+
+
+def is_lazy(local_config):
+    """
+    Whether the satellite files are processed lazily with dask 
+    (EXECUTION: 'dask') rather than in an explicit loop over chunks 
+    (EXECUTION: 'eager', the default).
+    """
+    execution = str(local_config.get("EXECUTION", "eager")).lower()
+    if execution not in ["eager", "dask"]:
+        raise ValueError(f"EXECUTION must be 'eager' or 'dask', not "
+                         f"{execution}")
+    return execution == "dask"
+
+
+class ModelCatalog:
+    """
+    Catalog of the time steps in a list of model files (the LevelEdgeDiags 
+    files, or the SpeciesConc files of one model run), which is built once
+    per run (see get_model_catalog). Each model time step is mapped to the
+    file that contains it and its index in that file, so the files needed 
+    by a chunk of observations are found with a lookup, and the files can 
+    hold any number of time steps (e.g., hourly, daily, or monthly files).
+
+    files:    the model files
+    times:    the model times (sorted)
+    file_idx: the index in files of the file with each time
+    time_idx: the index of each time in its file
+
+    If the times are parsed from the file names (from_names, see 
+    get_model_catalog), there is one time per file, its start time, and 
+    each file is assumed to cover the times until the start of the next 
+    file (or, for the last file, as long as the file before it, or one day
+    if there is only one file).
+    """
+
+    def __init__(self, files, file_times, from_names=False):
+        self.files = np.asarray(files)
+        self.from_names = from_names
+        file_times = [np.asarray(t, dtype="datetime64[ns]").ravel() 
+                      for t in file_times]
+        n_times = [len(t) for t in file_times]
+        times = np.concatenate(file_times + [np.array([], "datetime64[ns]")])
+        file_idx = np.repeat(np.arange(len(file_times)), n_times)
+        time_idx = np.concatenate([np.arange(n) for n in n_times] 
+                                  + [np.array([], int)])
+        order = np.argsort(times, kind="stable")
+        self.times = times[order]
+        self.file_idx = file_idx[order]
+        self.time_idx = time_idx[order]
+
+        # The dates covered by each file
+        if from_names:
+            starts = self.times
+            ends = np.append(starts[1:], starts[-1:] + (
+                np.diff(starts[-2:]) if len(starts) > 1 
+                else np.timedelta64(1, "D")))
+            self.file_dates = [None] * len(self.files)
+            for k, start, end in zip(self.file_idx, starts, ends):
+                self.file_dates[k] = np.arange(
+                    start.astype("datetime64[D]"), 
+                    (end - np.timedelta64(1, "ns")).astype("datetime64[D]") 
+                    + np.timedelta64(1, "D"))
+        else:
+            self.file_dates = [np.unique(t.astype("datetime64[D]")) 
+                               for t in file_times]
+
+    def __repr__(self):
+        return (f"ModelCatalog({len(self.files)} files, "
+                f"{len(self.times)} times)")
+
+    def get_dates(self):
+        """
+        Gets the dates (YYYY-MM-DD) with model data.
+        """
+        dates = np.concatenate(self.file_dates 
+                               + [np.array([], "datetime64[D]")])
+        return np.unique(dates).astype(str)
+
+    def get_files_for_dates(self, dates):
+        """
+        Gets the files with model data on any of dates (YYYY-MM-DD).
+        """
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        return self.files[[np.isin(file_dates, dates).any() 
+                           for file_dates in self.file_dates]]
 
+    def get_files(self, obs_times, time_matching="floor", time_step=None):
+        """
+        Gets the files with the model time steps matched to obs_times (see 
+        get_time_index), in time order. If the times are parsed from the 
+        file names, these are the files that cover the observation times 
+        plus or minus one time step (time_step, or one hour by default).
+        """
+        obs_times = np.asarray(obs_times, dtype="datetime64[ns]")
+        obs_times = obs_times[~np.isnat(obs_times)]
+        if not self.from_names:
+            idx = get_time_index(obs_times, self.times, time_matching, 
+                                 time_step)
+            return self.files[np.unique(self.file_idx[idx[idx >= 0]])]
 
-def get_gc_files_for_dates(file_names, dates):
-    return file_names[np.in1d(get_gc_dates(file_names), dates)]
+        margin = np.timedelta64(1, "h")
+        if time_step is not None:
+            margin = pd.Timedelta(time_step).to_timedelta64()
+        first = np.searchsorted(self.times, obs_times - margin, side="right")
+        last = np.searchsorted(self.times, obs_times + margin, side="right")
+        needed = np.zeros(len(self.times) + 1, dtype=int)
+        np.add.at(needed, (first - 1).clip(0), 1)
+        np.add.at(needed, last, -1)
+        needed = np.cumsum(needed)[:-1] > 0
+        return self.files[self.file_idx[needed]]
 
 
-def get_missing_times(satellite_times, model_times):
-    satellite_times = satellite_times.dt.strftime("%Y-%m-%d.%H")
+# The strftime codes that can be used in MODEL_FILE_TIME_FORMAT
+_TIME_FORMAT_CODES = {"%Y" : r"\d{4}", "%m" : r"\d{2}", "%d" : r"\d{2}", 
+                      "%H" : r"\d{2}", "%M" : r"\d{2}", "%S" : r"\d{2}",
+                      "%j" : r"\d{3}"}
+
+
+def get_time_from_file_name(file_name, time_format):
+    """
+    Parses the time in a file name with a strftime format (e.g., 
+    '%Y%m%d_%H%Mz' for GEOSChem.SpeciesConc.20200101_0000z.nc4).
+    """
+    pattern = re.escape(time_format)
+    for code, regex in _TIME_FORMAT_CODES.items():
+        pattern = pattern.replace(re.escape(code), regex)
+    match = re.search(pattern, os.path.basename(file_name))
+    if match is None:
+        raise ValueError(f"{file_name} does not contain a time in the "
+                         f"format {time_format}.")
+    return pd.to_datetime(match.group(), format=time_format).to_datetime64()
+
+
+def get_model_catalog(file_names, local_config, time_name="time"):
+    """
+    Builds the ModelCatalog of a list of model files. The times are read 
+    from the time_name coordinate of each file, unless 
+    MODEL_FILE_TIME_FORMAT is set, in which case the start time of each 
+    file is parsed from its name with that format instead (see 
+    get_time_from_file_name).
+
+    If SAVE_MODEL_CATALOG is 'True', the times read from the files are 
+    saved to <SAVE_DIR>/model_catalog.json along with the size and 
+    modification time of each file, and later runs only read the files 
+    that are new or have changed.
+    """
+    time_format = str(local_config.get("MODEL_FILE_TIME_FORMAT", "none"))
+    if time_format.lower() != "none":
+        return ModelCatalog(
+            file_names, 
+            [[get_time_from_file_name(f, time_format)] for f in file_names],
+            from_names=True)
+
+    # Load the saved times
+    catalog_file = None
+    saved = {}
+    if str(local_config.get("SAVE_MODEL_CATALOG", "False")).lower() == "true":
+        catalog_file = f"{local_config['SAVE_DIR']}/model_catalog.json"
+        if os.path.exists(catalog_file):
+            with open(catalog_file, "r") as f:
+                saved = json.load(f)
+
+    # Read the times of the files that are not in the saved catalog
+    file_times = []
+    n_read = 0
+    for file_name in file_names:
+        key = os.path.abspath(file_name)
+        stat = _get_file_stat(file_name)
+        entry = saved.get(key)
+        if (entry is None or entry["stat"] != stat 
+            or entry["time"] != time_name):
+            with xr.open_dataset(file_name) as f:
+                times = f[time_name].values.astype("datetime64[ns]")
+            entry = {"stat" : stat, "time" : time_name,
+                     "times" : times.astype("int64").tolist()}
+            saved[key] = entry
+            n_read += 1
+        file_times.append(np.array(entry["times"], dtype="datetime64[ns]"))
+
+    # Save the catalog, dropping files that no longer exist
+    if catalog_file is not None and n_read > 0:
+        saved = {k : v for k, v in saved.items() if os.path.exists(k)}
+        os.makedirs(local_config["SAVE_DIR"], exist_ok=True)
+        _write_json(catalog_file, saved)
+    return ModelCatalog(file_names, file_times)
+
+
+# The storage and accumulation dtypes for each PRECISION. With 'mixed', the
+# data are stored in float32 but sums are accumulated in float64.
+PRECISIONS = {"float64" : (np.float64, np.float64),
+              "float32" : (np.float32, np.float32),
+              "mixed" : (np.float32, np.float64)}
+
+# Documented bound on the relative difference between the model columns 
+# computed with each PRECISION and with float64 (checked by test.py and 
+# reported by benchmark.py)
+PRECISION_TOLERANCE = {"float64" : 0.0, "float32" : 1e-5, "mixed" : 5e-6}
+
+
+def get_precision(local_config):
+    """
+    Gets PRECISION ('float64' by default, 'float32', or 'mixed') from 
+    LOCAL_SETTINGS.
+    """
+    precision = str(local_config.get("PRECISION", "float64")).lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"PRECISION must be one of {list(PRECISIONS)}, "
+                         f"not {precision}")
+    return precision
+
+
+def get_itemsize(local_config):
+    """
+    Gets the number of bytes per value stored with the PRECISION in 
+    LOCAL_SETTINGS (4 for 'float32' and 'mixed', 8 for 'float64').
+    """
+    return np.dtype(PRECISIONS[get_precision(local_config)][0]).itemsize
+
+
+# The satellite DATA_FIELDS that are only needed for footprint sampling
+FOOTPRINT_FIELDS = ["LATITUDE_BOUNDS", "LONGITUDE_BOUNDS", "N_CORNERS"]
+
+
+def get_horizontal_sampling(local_config):
+    """
+    Gets HORIZONTAL_SAMPLING ('nearest' by default or 'footprint') from 
+    LOCAL_SETTINGS.
+    """
+    sampling = str(local_config.get("HORIZONTAL_SAMPLING", "nearest")).lower()
+    if sampling not in ["nearest", "footprint"]:
+        raise ValueError(f"HORIZONTAL_SAMPLING must be 'nearest' or "
+                         f"'footprint', not {sampling}")
+    return sampling
+
+
+def get_time_matching_settings(local_config):
+    """
+    Gets the keyword arguments for get_time_index from LOCAL_SETTINGS. 
+    TIME_MATCHING is 'floor' (default) or 'nearest' and MODEL_TIME_STEP is
+    the model output frequency (e.g., '1h', '3h', '1D'), which is inferred
+    from the model times if 'none' or not given.
+    """
+    time_step = local_config.get("MODEL_TIME_STEP", "none")
+    if str(time_step).lower() == "none":
+        time_step = None
+    return {"time_matching" : local_config.get("TIME_MATCHING", "floor"),
+            "time_step" : time_step}
+
+
+def get_model_time_step(model_times, time_step=None):
+    """
+    Gets the model output frequency as a np.timedelta64. If time_step is not
+    given, we use the smallest difference between model times, or one hour 
+    if there is only one model time.
+    """
+    if time_step is not None:
+        return pd.Timedelta(time_step).to_timedelta64()
+    model_times = np.unique(model_times)
+    if len(model_times) < 2:
+        return np.timedelta64(1, "h")
+    return np.diff(model_times).min()
+
+
+def get_time_index(satellite_times, model_times, 
+                   time_matching="floor", time_step=None):
+    """
+    Finds the model time index for each satellite observation using 
+    searchsorted on the datetime64 values. 
+    
+    time_matching can be:
+        floor:   each model time step covers [t, t + time_step), where t is
+                 the model time floored to the time step. For hourly output,
+                 this matches observations to model data from the same hour
+                 regardless of whether the model time stamps are at the 
+                 start or middle of the hour. The same holds for 3-hourly
+                 output or daily means.
+        nearest: the closest model time within half a time step.
+
+    Returns an integer array (N_OBS) with -1 where there is no model time.
+    """
+    satellite_times = np.asarray(satellite_times, dtype="datetime64[ns]")
+    model_times = np.asarray(model_times, dtype="datetime64[ns]")
+    time_step = get_model_time_step(model_times, time_step).astype(
+        "timedelta64[ns]")
+
+    # Sort the model times for searchsorted
+    order = np.argsort(model_times, kind="stable")
+    sorted_times = model_times[order]
+
+    if time_matching == "floor":
+        epoch = np.datetime64(0, "ns")
+        sorted_times = sorted_times - (sorted_times - epoch) % time_step
+        idx = np.searchsorted(sorted_times, satellite_times, side="right") - 1
+        valid = idx >= 0
+        idx = idx.clip(0, len(sorted_times) - 1)
+        valid &= satellite_times < sorted_times[idx] + time_step
+    elif time_matching == "nearest":
+        idx = np.searchsorted(sorted_times, satellite_times)
+        before = (idx - 1).clip(0, len(sorted_times) - 1)
+        after = idx.clip(0, len(sorted_times) - 1)
+        use_before = (np.abs(satellite_times - sorted_times[before]) 
+                      <= np.abs(sorted_times[after] - satellite_times))
+        idx = np.where(use_before, before, after)
+        valid = np.abs(satellite_times - sorted_times[idx]) <= time_step / 2
+    else:
+        raise ValueError(f"time_matching must be 'floor' or 'nearest', "
+                         f"not {time_matching}")
+
+    # NaT times never match
+    valid &= ~np.isnat(satellite_times)
+    return np.where(valid, order[idx], -1)
+
+
+def get_missing_times(satellite_times, model_times, 
+                      time_matching="floor", time_step=None):
+    # Use the time step recorded by the GEOS-Chem reader if there is one
+    if time_step is None:
+        time_step = model_times.attrs.get("time_step")
     missing_times = xr.DataArray(
-        ~np.in1d(satellite_times, model_times.dt.strftime("%Y-%m-%d.%H")),
+        get_time_index(satellite_times.values, model_times.values, 
+                       time_matching, time_step) < 0,
         dims="N_OBS")
     if missing_times.sum() > 0:
         print(f"  Missing model data at the following"
               f" {missing_times.sum().values} times:")
-        print(satellite_times[missing_times].values)
+        print(satellite_times[missing_times].dt.strftime("%Y-%m-%d.%H").values)
     return missing_times
 
 
-def colocate_obs(model, satellite, save_dir=None):
+def get_chunk_size(local_config, n_model_levels, n_satellite_levels, 
+                   n_tracers, n_runs=1, n_cells=1):
+    """
+    Gets the number of observations to process at a time. If 
+    CHUNK_MEMORY_BUDGET (bytes) is set in LOCAL_SETTINGS, the chunk size is
+    estimated from the memory needed per observation, which scales with the
+    number of model levels, satellite levels, and tracers: the colocated 
+    tracers (and their stacked copy), the pressure edges and sparse 
+    interpolation map (and its temporaries), and the output columns (one 
+    per tracer and model run, since all n_runs runs of a chunk are kept 
+    until it is written in batch mode). Otherwise, we use 
+    FILE_LENGTH_THRESHOLD.
+
+    If TRACER_MEMORY_BUDGET is set, the colocated tracers are processed in
+    blocks that fit in that budget instead (see get_tracer_block_size), so
+    they are left out of the estimate and the chunk size only depends on
+    the number of tracers through the output columns.
+
+    With footprint sampling, everything but the output columns is needed 
+    for each of the (on average) n_cells model grid cells per observation.
+    The values are stored with the PRECISION in LOCAL_SETTINGS (see 
+    get_itemsize).
+    """
+    memory_budget = float(local_config.get("CHUNK_MEMORY_BUDGET", 0))
+    if memory_budget <= 0:
+        return max(int(local_config["FILE_LENGTH_THRESHOLD"]), 1)
+
+    colocated_tracers = n_tracers
+    if float(local_config.get("TRACER_MEMORY_BUDGET", 0)) > 0:
+        colocated_tracers = 0
+    itemsize = get_itemsize(local_config)
+    bytes_per_obs = itemsize * (n_cells * (2 * n_model_levels 
+                                           * colocated_tracers
+                                           + 8 * (n_model_levels 
+                                                  + n_satellite_levels))
+                                + n_tracers * n_runs)
+    return max(int(memory_budget // bytes_per_obs), 1)
+
+
+def get_tracer_block_size(local_config, n_obs, n_model_levels, n_tracers):
+    """
+    Gets the number of tracers to colocate and apply the operator to at a 
+    time for a chunk of n_obs observations. If TRACER_MEMORY_BUDGET (bytes)
+    is set in LOCAL_SETTINGS, the block size is estimated from the memory 
+    needed per tracer (the colocated profiles and the block they are copied
+    into, stored with the PRECISION in LOCAL_SETTINGS). Otherwise, all of 
+    the tracers are done at once.
+    """
+    memory_budget = float(local_config.get("TRACER_MEMORY_BUDGET", 0))
+    if memory_budget <= 0:
+        return max(n_tracers, 1)
+
+    itemsize = get_itemsize(local_config)
+    bytes_per_tracer = itemsize * 2 * n_obs * n_model_levels
+    return int(np.clip(memory_budget // bytes_per_tracer, 1, 
+                       max(n_tracers, 1)))
+
+
+def plan_chunks(satellite_times, chunk_size):
+    """
+    Plans the chunks used to process a satellite file. Observations are 
+    grouped by date so that each group needs a single day of model data, 
+    which is then read once for the whole group. Each group is split into
+    chunks of at most chunk_size observations. Observations keep their 
+    file order within each date, and combine_chunks restores the file 
+    order across dates.
+
+    Returns a list of (date, [index arrays for each chunk]).
+    """
+    dates = np.asarray(satellite_times, dtype="datetime64[D]")
+    unique_dates, group = np.unique(dates, return_inverse=True)
+    order = np.argsort(group, kind="stable")
+    bounds = np.searchsorted(group[order], np.arange(len(unique_dates) + 1))
+
+    plan = []
+    for k, date in enumerate(unique_dates):
+        idx = order[bounds[k]:bounds[k + 1]]
+        chunks = [idx[j:j + chunk_size] 
+                  for j in range(0, len(idx), chunk_size)]
+        plan.append((str(date), chunks))
+    return plan
+
+
+# LOCAL_SETTINGS that do not change the output
+RUNTIME_SETTINGS = ["REPROCESS", "N_THREADS", "N_WORKERS", 
+                    "WORKER_MEMORY_LIMIT", "MODEL_CACHE_SIZE", "RUN_REPORT",
+                    "BACKEND", "TRACER_MEMORY_BUDGET", "EXECUTION", 
+                    "DASK_SCHEDULER", "OUTPUT_STORE", 
+                    "OUTPUT_STORE_CHUNK_SIZE", "OUTPUT_STORE_COMPRESSION",
+                    "SPATIAL_INDEX_DIR", "SAVE_MODEL_CATALOG"]
+
+
+def get_fingerprint(*items):
+    """
+    Gets a hash of numpy arrays and/or json-serializable items (e.g., 
+    dictionaries from the config file).
+    """
+    fingerprint = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            fingerprint.update(np.ascontiguousarray(item).tobytes())
+        else:
+            fingerprint.update(
+                json.dumps(item, sort_keys=True, default=str).encode())
+    return fingerprint.hexdigest()
+
+
+def get_config_fingerprint(config):
+    """
+    Gets a hash of the config settings that affect the output.
+    """
+    config = dict(config)
+    config["LOCAL_SETTINGS"] = {k : v for k, v in config["LOCAL_SETTINGS"].items()
+                                if k not in RUNTIME_SETTINGS}
+    return get_fingerprint(config)
+
+
+def get_geometry_fingerprint(satellite, model_lats, model_lons, config):
+    """
+    Gets a hash of everything the observation operator depends on other 
+    than the model pressure edges: the satellite times, locations, pressure
+    grid, and averaging kernel inputs, the model grid, and the settings 
+    used to build the operator. This is used to detect stale operator 
+    components (see operators.OperatorStore).
+    """
+    local_config = config["LOCAL_SETTINGS"]
+    satellite_vars = ["TIME", "LATITUDE", "LONGITUDE", "PRESSURE_EDGES", 
+                      "PRESSURE_WEIGHT", "AVERAGING_KERNEL", "PRIOR_PROFILE"]
+    settings = [get_time_matching_settings(local_config)]
+    if get_horizontal_sampling(local_config) == "footprint":
+        satellite_vars += ["LATITUDE_BOUNDS", "LONGITUDE_BOUNDS"]
+        settings.append("footprint")
+    return get_fingerprint(
+        *[satellite[v].values for v in satellite_vars],
+        np.asarray(model_lats), np.asarray(model_lons),
+        config[local_config["SATELLITE_NAME"]],
+        *settings,
+        {k : local_config.get(k) for k in ["MODEL_LEVEL_EDGE_DIR", 
+                                           "LEVEL_EDGE_FILE_FORMAT"]})
+
+
+def _write_json(file_path, data):
+    # Write to a temporary file first so that the file is never half-written
+    with open(f"{file_path}.tmp", "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(f"{file_path}.tmp", file_path)
+
+
+def get_completed_chunks(parts_dir, fingerprint):
+    """
+    Gets the chunks that were already written to parts_dir by a previous run
+    with the same fingerprint (see write_chunk) so that we can resume from 
+    the last completed chunk. Chunks that were skipped (see write_chunk) 
+    count as completed. If there is no progress file or the fingerprint 
+    does not match, parts_dir is emptied and we start over.
+    """
+    progress_file = f"{parts_dir}/progress.json"
+    if os.path.exists(progress_file):
+        with open(progress_file, "r") as f:
+            progress = json.load(f)
+        if progress["fingerprint"] == fingerprint:
+            completed = [i for i in progress["completed"] 
+                         if os.path.exists(f"{parts_dir}/chunk_{i:04d}.nc")]
+            completed += progress.get("skipped", [])
+            print(f"  Resuming after {len(completed)} completed chunks.")
+            return completed
+
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+    _write_json(progress_file, {"fingerprint" : fingerprint, "completed" : [],
+                                "skipped" : []})
+    return []
+
+
+def write_chunk(data, parts_dir, i, fingerprint, completed):
+    """
+    Writes the output for chunk i to parts_dir as soon as it is finished and
+    records it in the progress file. If data is None (none of the 
+    observations in the chunk overlap the model times), the chunk is only 
+    recorded as skipped, so that a resumed run does not read its model data
+    again.
+    """
+    part_file = f"{parts_dir}/chunk_{i:04d}.nc"
+    if data is not None:
+        data.to_netcdf(f"{part_file}.tmp")
+        os.replace(f"{part_file}.tmp", part_file)
+    completed.append(i)
+    written = [j for j in completed 
+               if os.path.exists(f"{parts_dir}/chunk_{j:04d}.nc")]
+    _write_json(f"{parts_dir}/progress.json", 
+                {"fingerprint" : fingerprint, "completed" : written,
+                 "skipped" : [j for j in completed if j not in written]})
+
+
+def combine_chunks(parts_dir, completed, output_file):
+    """
+    Combines the chunks written by write_chunk into output_file (streaming
+    the data one chunk at a time) and removes parts_dir. The chunks are 
+    already in file order if the satellite file is sorted by time. 
+    Otherwise, the observations are put back in file order by their N_OBS
+    coordinate (see plan_chunks). Returns output_file, or None if every 
+    chunk was skipped.
+    """
+    part_files = [f"{parts_dir}/chunk_{i:04d}.nc" for i in sorted(completed)]
+    part_files = [f for f in part_files if os.path.exists(f)]
+    if len(part_files) == 0:
+        shutil.rmtree(parts_dir)
+        return None
+    with xr.open_mfdataset(part_files, combine="nested", concat_dim="N_OBS",
+                           data_vars="all") as data:
+        obs = data["N_OBS"].values
+        if np.any(np.diff(obs) < 0):
+            data = data.isel(N_OBS=np.argsort(obs, kind="stable"))
+        data.to_netcdf(f"{parts_dir}/combined.nc")
+    os.replace(f"{parts_dir}/combined.nc", output_file)
+    shutil.rmtree(parts_dir)
+    return output_file
+
+
+# The index of an output store: one entry per satellite file along SOURCE 
+OUTPUT_STORE_INDEX = ["SOURCE_FILE", "SOURCE_START", "SOURCE_COUNT", 
+                      "SOURCE_MTIME"]
+
+# Variables whose range in each satellite file is added to the index
+OUTPUT_STORE_BOUNDS = ["TIME", "LATITUDE", "LONGITUDE"]
+
+
+class OutputStore:
+    """
+    One store with the outputs of all of the processed satellite files,
+    concatenated along N_OBS so that the whole period can be opened at once
+    (see open_output_store and select_observations). The store is written 
+    with zarr if path ends in .zarr (requires zarr) and as a netCDF4 file 
+    with an unlimited N_OBS dimension otherwise. Variables are chunked 
+    along N_OBS (chunk_size observations per chunk) and compressed (zlib 
+    level compression for netCDF4; zarr uses its default compressor).
+
+    Satellite files are indexed along the SOURCE dimension by their name 
+    (SOURCE_FILE), first observation (SOURCE_START), number of observations
+    (SOURCE_COUNT), the modification time of their output file 
+    (SOURCE_MTIME), and the range of TIME, LATITUDE, and LONGITUDE if they
+    are saved (e.g., SOURCE_TIME_MIN and SOURCE_TIME_MAX). SOURCE_INDEX 
+    gives the entry of each observation. Observations with SOURCE_INDEX -1 
+    are not part of the store: they were replaced when their satellite file
+    was added again, or were left by an append that did not finish.
+    """
+    def __init__(self, path, chunk_size=100000, compression=4):
+        self.path = path.rstrip("/")
+        self.chunk_size = int(chunk_size)
+        self.compression = int(compression)
+        self.format = "zarr" if self.path.endswith(".zarr") else "netcdf"
+        if self.format == "zarr" and zarr is None:
+            raise ImportError(f"zarr is required to write {self.path} "
+                              f"(conda install zarr). Use a .nc path to "
+                              f"write a netCDF4 store instead.")
+
+    def __repr__(self):
+        return f"OutputStore({self.path})"
+
+    def get_index(self):
+        """
+        Gets {satellite file name : {"entry", "start", "count", "mtime"}} 
+        for the satellite files in the store.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open_output_store(self.path) as store:
+            index = store[OUTPUT_STORE_INDEX].load()
+        return {str(f) : {"entry" : i, "start" : int(start), 
+                          "count" : int(count), "mtime" : int(mtime)}
+                for i, (f, start, count, mtime) in enumerate(zip(
+                    *[index[v].values for v in OUTPUT_STORE_INDEX]))
+                if count > 0}
+
+    def append(self, data, source_file, mtime, previous=None):
+        """
+        Appends data (the output for source_file, whose output file was
+        modified at mtime) to the store, chunk_size observations at a 
+        time. previous is the index entry (from get_index) of an earlier 
+        version of source_file, whose observations are removed from the 
+        index once the new ones are written.
+        """
+        data = data.drop_vars(list(data.coords))
+        n_obs = data.sizes["N_OBS"]
+        start = self._get_size("N_OBS")
+
+        # The observations are written first and only indexed once they are
+        # all written, so that an interrupted append leaves no partial file
+        for i in range(0, n_obs, self.chunk_size):
+            chunk = data.isel(N_OBS=slice(i, i + self.chunk_size)).load()
+            chunk["SOURCE_INDEX"] = ("N_OBS", 
+                                     np.full(chunk.sizes["N_OBS"], -1, 
+                                             dtype=np.int32))
+            self._append(chunk, "N_OBS")
+
+        entry = {"SOURCE_FILE" : np.array([source_file], dtype=object),
+                 "SOURCE_START" : [start], "SOURCE_COUNT" : [n_obs],
+                 "SOURCE_MTIME" : [mtime]}
+        for v in OUTPUT_STORE_BOUNDS:
+            if v in data.data_vars:
+                entry[f"SOURCE_{v}_MIN"] = [data[v].min().values]
+                entry[f"SOURCE_{v}_MAX"] = [data[v].max().values]
+        entry = xr.Dataset({k : ("SOURCE", np.asarray(v)) 
+                            for k, v in entry.items()})
+        entry["SOURCE_START"] = entry["SOURCE_START"].astype(np.int64)
+        entry["SOURCE_COUNT"] = entry["SOURCE_COUNT"].astype(np.int64)
+        entry["SOURCE_MTIME"] = entry["SOURCE_MTIME"].astype(np.int64)
+        i_entry = self._get_size("SOURCE")
+        self._append(entry, "SOURCE")
+
+        self._set("SOURCE_INDEX", "N_OBS", slice(start, start + n_obs), 
+                  np.full(n_obs, i_entry, dtype=np.int32))
+        if previous is not None:
+            old = slice(previous["start"], 
+                        previous["start"] + previous["count"])
+            self._set("SOURCE_INDEX", "N_OBS", old,
+                      np.full(previous["count"], -1, dtype=np.int32))
+            self._set("SOURCE_COUNT", "SOURCE", 
+                      slice(previous["entry"], previous["entry"] + 1),
+                      np.zeros(1, dtype=np.int64))
+
+    def _get_size(self, dim):
+        if not os.path.exists(self.path):
+            return 0
+        if self.format == "zarr":
+            with xr.open_zarr(self.path) as store:
+                return store.sizes.get(dim, 0)
+        with netCDF4.Dataset(self.path, "r") as store:
+            return (len(store.dimensions[dim]) 
+                    if dim in store.dimensions else 0)
+
+    def _append(self, data, dim):
+        """ Appends data to the store along dim (N_OBS or SOURCE). """
+        if self.format == "zarr":
+            self._append_zarr(data, dim)
+        else:
+            self._append_netcdf(data, dim)
+
+    def _set(self, name, dim, region, values):
+        """ Overwrites variable name in region (a slice along dim). """
+        if self.format == "zarr":
+            xr.Dataset({name : (dim, values)}).to_zarr(
+                self.path, region={dim : region})
+            return
+        with netCDF4.Dataset(self.path, "a") as store:
+            store[name][region] = values
+
+    def _append_zarr(self, data, dim):
+        if not os.path.exists(self.path):
+            data.to_zarr(self.path, mode="w-", consolidated=True,
+                         encoding=self._get_encoding(data, dim))
+            return
+        with xr.open_zarr(self.path) as store:
+            has_dim = dim in store.dims
+        if has_dim:
+            self._check_variables(data, dim, store)
+            data.to_zarr(self.path, append_dim=dim, consolidated=True)
+        else:
+            # The first entry of the index (or the first observations)
+            data.to_zarr(self.path, mode="a", consolidated=True,
+                         encoding=self._get_encoding(data, dim))
+
+    def _append_netcdf(self, data, dim):
+        mode = "a" if os.path.exists(self.path) else "w"
+        with netCDF4.Dataset(self.path, mode, format="NETCDF4") as store:
+            if dim not in store.dimensions:
+                store.createDimension(dim, None)
+                for d, size in data.sizes.items():
+                    if d not in store.dimensions:
+                        store.createDimension(d, size)
+                encoding = self._get_encoding(data, dim)
+                for name, variable in data.data_vars.items():
+                    values, attrs = _encode_for_netcdf(variable.values)
+                    var = store.createVariable(
+                        name, str if values.dtype == object else values.dtype,
+                        variable.dims, **encoding[name])
+                    var.setncatts({**variable.attrs, **attrs})
+            self._check_variables(data, dim, store.variables)
+            start = len(store.dimensions[dim])
+            for name, variable in data.data_vars.items():
+                values, _ = _encode_for_netcdf(variable.values)
+                store[name][start:start + data.sizes[dim]] = values
+
+    def _get_encoding(self, data, dim):
+        """ Gets the chunking and compression of each variable. """
+        encoding = {}
+        for name, variable in data.data_vars.items():
+            chunks = tuple(self.chunk_size if d == dim else data.sizes[d] 
+                           for d in variable.dims)
+            if self.format == "zarr":
+                encoding[name] = {"chunks" : chunks}
+            elif variable.dtype == object:
+                encoding[name] = {}
+            else:
+                encoding[name] = {
+                    "chunksizes" : chunks, "shuffle" : True, 
+                    "compression" : "zlib" if self.compression > 0 else None,
+                    "complevel" : max(self.compression, 1)}
+        return encoding
+
+    def _check_variables(self, data, dim, store_variables):
+        store_variables = [v for v in store_variables 
+                           if dim in _get_dims(store_variables[v])]
+        if set(data.data_vars) != set(store_variables):
+            raise ValueError(
+                f"The variables in the output do not match {self.path} "
+                f"({sorted(data.data_vars)} vs. {sorted(store_variables)}), "
+                f"e.g., because the config changed. Remove the store to "
+                f"rebuild it.")
+
+
+def _get_dims(variable):
+    # netCDF4 variables have .dimensions and xarray variables have .dims
+    return getattr(variable, "dimensions", getattr(variable, "dims", ()))
+
+
+def _encode_for_netcdf(values):
+    """
+    Converts datetimes to nanoseconds since 1970 (decoded by xarray when 
+    the store is opened). Returns the values and the attributes to add.
+    """
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = (values.astype("datetime64[ns]") 
+                  - np.datetime64("1970-01-01", "ns")).astype(np.int64)
+        return values, {"units" : "nanoseconds since 1970-01-01", 
+                        "calendar" : "proleptic_gregorian"}
+    return values, {}
+
+
+def get_output_store(local_config):
+    """
+    Gets the OutputStore at OUTPUT_STORE in LOCAL_SETTINGS, or None if 
+    OUTPUT_STORE is 'none' (the default).
+    """
+    path = str(local_config.get("OUTPUT_STORE", "none"))
+    if path.lower() == "none":
+        return None
+    return OutputStore(
+        path, 
+        chunk_size=float(local_config.get("OUTPUT_STORE_CHUNK_SIZE", 1e5)),
+        compression=local_config.get("OUTPUT_STORE_COMPRESSION", 4))
+
+
+def update_output_store(local_config):
+    """
+    Adds the output files of the processed satellite files (from the 
+    manifests in <SAVE_DIR>/manifest) to the output store, in the order of
+    the satellite files. Files that are already in the store are skipped 
+    unless their output file was rewritten (e.g., reprocessed) since they 
+    were added. This is only called from the main process, after the 
+    satellite files are processed, so that one process writes the store.
+    """
+    store = get_output_store(local_config)
+    if store is None:
+        return
+    save_dir = local_config["SAVE_DIR"]
+    index = store.get_index()
+    sat_files = sorted(glob.glob(f"{local_config['OBS_DIR']}/"
+                                 f"{local_config['OBS_FILE_FORMAT']}"))
+    added = []
+    for sf in sat_files:
+        manifest_file = get_manifest_file(sf, save_dir)
+        if not os.path.exists(manifest_file):
+            continue
+        with open(manifest_file, "r") as f:
+            output = json.load(f)["output"]
+        if output is None or not os.path.exists(f"{save_dir}/{output}"):
+            continue
+        short_name = sf.split("/")[-1]
+        mtime = os.stat(f"{save_dir}/{output}").st_mtime_ns
+        if short_name in index and index[short_name]["mtime"] == mtime:
+            continue
+        with xr.open_dataset(f"{save_dir}/{output}") as data:
+            store.append(data, short_name, mtime, index.get(short_name))
+        added.append(short_name)
+    print(f"Added {len(added)} files to {store.path}: ", added)
+
+
+def open_output_store(path, **kwargs):
+    """
+    Opens an output store (see OutputStore) lazily as an xarray dataset.
+    """
+    path = path.rstrip("/")
+    if path.endswith(".zarr"):
+        return xr.open_zarr(path, **kwargs)
+    return xr.open_dataset(path, **kwargs)
+
+
+def select_observations(store, source_files=None, time_range=None, 
+                        lat_range=None, lon_range=None):
+    """
+    Selects the observations in an output store (from open_output_store) 
+    from the satellite files in source_files and/or within time_range, 
+    lat_range, and lon_range ((min, max), inclusive). The index is used to
+    read only the satellite files that overlap the ranges.
+    """
+    index = store[[v for v in store.data_vars 
+                   if "SOURCE" in store[v].dims]].load()
+    keep = index["SOURCE_COUNT"].values > 0
+    if source_files is not None:
+        keep &= np.isin(index["SOURCE_FILE"].values.astype(str), 
+                        source_files)
+    ranges = {"TIME" : time_range, "LATITUDE" : lat_range, 
+              "LONGITUDE" : lon_range}
+    ranges = {v : r for v, r in ranges.items() if r is not None}
+    for v, (low, high) in ranges.items():
+        if f"SOURCE_{v}_MIN" not in index:
+            raise ValueError(f"{v} is not in the output store. Set "
+                             f"SAVE_SATELLITE_DATA: 'True' to save it.")
+        if v == "TIME":
+            low, high = pd.Timestamp(low), pd.Timestamp(high)
+            ranges[v] = (low.to_datetime64(), high.to_datetime64())
+        keep &= ((index[f"SOURCE_{v}_MAX"].values >= ranges[v][0]) 
+                 & (index[f"SOURCE_{v}_MIN"].values <= ranges[v][1]))
+
+    idx = np.concatenate(
+        [np.arange(0)] 
+        + [np.arange(start, start + count) for start, count in zip(
+            index["SOURCE_START"].values[keep], 
+            index["SOURCE_COUNT"].values[keep])])
+    data = store.isel(N_OBS=idx)
+
+    # Remove the observations outside of the ranges
+    mask = data["SOURCE_INDEX"].values >= 0
+    for v, (low, high) in ranges.items():
+        values = data[v].values
+        mask &= (values >= low) & (values <= high)
+    return data.isel(N_OBS=np.flatnonzero(mask))
+
+
+# The colocation index names and model dimensions of the horizontal grid,
+# keyed by the number of dimensions of the model LATITUDE: 1 for the 
+# rectilinear GEOS-Chem Classic grids, 2 for other curvilinear grids, and 3
+# for the GCHP cubed-sphere grid (nf x Ydim x Xdim). They are in the order
+# that the model dimensions are stored (see parsers.read_geoschem_file).
+HORIZONTAL_DIMS = {1 : {"lon" : "LONGITUDE", "lat" : "LATITUDE"},
+                   2 : {"y" : "Y", "x" : "X"},
+                   3 : {"face" : "FACE", "y" : "Y", "x" : "X"}}
+
+
+def get_horizontal_dims(model):
+    """
+    Gets the colocation index names and model dimensions of the horizontal
+    grid of model (see HORIZONTAL_DIMS).
+    """
+    return HORIZONTAL_DIMS[model["LATITUDE"].ndim]
+
+
+def get_model_indexers(model, idx):
+    """
+    Gets the indexers for model.isel that colocate the model with the 
+    observations, from colocation indices (see get_colocation_indices).
+    """
+    indexers = {"TIME" : idx["time"]}
+    indexers.update({dim : idx[name] 
+                     for name, dim in get_horizontal_dims(model).items()})
+    return indexers
+
+
+def get_colocated_dims(idx):
+    """
+    Gets the observation dimension of colocation indices: N_OBS, or 
+    N_PAIRS with footprint sampling.
+    """
+    return [d for d in ["N_OBS", "N_PAIRS"] if d in idx.dims]
+
+
+def get_spatial_index_dir(local_config):
+    """
+    Gets the directory that spatial indices of curvilinear model grids are
+    saved to (see SpatialIndex): SPATIAL_INDEX_DIR from LOCAL_SETTINGS, or
+    SAVE_DIR if it is not given.
+    """
+    index_dir = local_config.get("SPATIAL_INDEX_DIR", "none")
+    if str(index_dir).lower() == "none":
+        index_dir = local_config["SAVE_DIR"]
+    return index_dir
+
+
+def colocate_obs(model, satellite, save_dir=None, 
+                 time_matching="floor", time_step=None):
+    """
+    Subsets the model data to the grid cells and times that are coincident
+    with each satellite observation (see get_colocation_indices).
+    """
+    idx = get_colocation_indices(model, satellite, save_dir, 
+                                 time_matching, time_step)
+    return model.isel(get_model_indexers(model, idx))
+
+
+def get_colocation_indices(model, satellite, save_dir=None,
+                           time_matching="floor", time_step=None,
+                           footprint=False, spatial_index_dir=None):
     """
     directly from Hannah's code
     get gridcells which are coincident with each satellite observation
     assumes model pixel size >> satellite pixel size
-    fast implementation, credit Nick
-    TO DO : This could be sped up using Nick's implementation, but that
-    requires knowledge of the latitude and longitude delta
+    fast implementation, credit Nick: for regular grids, the grid cell is
+    found from the latitude and longitude edges (see get_grid_index)
+
+    Returns an xarray dataset with the time, lat, and lon indices (N_OBS)
+    of the model data. time_matching and time_step are passed to 
+    get_time_index.
+
+    On curvilinear grids (e.g., the GCHP cubed-sphere grid), there is one
+    index per model grid dimension instead of lat and lon (face, y, and x 
+    on the cubed sphere, see HORIZONTAL_DIMS), and each observation is 
+    matched to the grid cell with the closest center with a SpatialIndex, 
+    which is saved to spatial_index_dir.
+
+    If footprint is True, each observation is instead matched to every 
+    model grid cell that its footprint (LATITUDE_BOUNDS and 
+    LONGITUDE_BOUNDS) overlaps: the indices have one entry per pair of an 
+    observation (obs) and a cell (dimension N_PAIRS), and weight is the 
+    fraction of the footprint in each cell (see get_footprint_indices).
     """
     # We need to get indices in time and space (lat/lon). We begin by trying to
     # load these indices, because for Jacobian simulations, it can save time.
-    # If this fails, we will calculate them.
-    try:
-        idx = xr.open_dataset(f'{save_dir}_idx.nc')
+    # If they are missing or do not match, we will calculate them.
+    idx_file = f"{save_dir}_idx.nc"
+    if save_dir is not None and os.path.exists(idx_file):
+        idx = xr.open_dataset(idx_file).load()
 
-        # Subset the data
-        model = model.isel(TIME=idx['time'], 
-                           LONGITUDE=idx['lon'], LATITUDE=idx['lat'])
         # Ensure that the pre-computed time and space indices are actually 
         # correct
-        if model.sizes['N_OBS'] != satellite.sizes['N_OBS']:
-            raise ValueError('Model dimension does not match satellite dimension.')
-        print("  Using pre-computed time and space indices.")
-    except:
-        print("  Computing time and space indices.")
-        # Now get indices, beginning with time
-        time_idx = np.where(satellite["TIME"].dt.strftime("%Y-%m-%d.%H") 
-                            == model["TIME"].dt.strftime("%Y-%m-%d.%H"))
-        if len(time_idx) == 2:
-            time_idx = time_idx[1]
-        elif len(time_idx) == 1:
-            time_idx = time_idx[0]
-        else:
-            raise ValueError('Time index is not recognized.')
-        time_idx = xr.DataArray(time_idx, dims="N_OBS")
-
-        # Longitude and latitude index
-        lon_idx = get_closest_index(model["LONGITUDE"].values, 
-                                    satellite["LONGITUDE"].values)
-        lat_idx = get_closest_index(model["LATITUDE"].values, 
-                                    satellite["LATITUDE"].values)
-        
-        idx = xr.Dataset({"lat" : lat_idx, "lon" : lon_idx, "time" : time_idx})
-        
-        # Save out
+        n_obs = idx.attrs.get("n_obs", idx.sizes.get("N_OBS"))
+        if (n_obs == satellite.sizes['N_OBS'] 
+            and ("weight" in idx) == footprint
+            and all(name in idx for name in get_horizontal_dims(model))):
+            print("  Using pre-computed time and space indices.")
+            return idx
+        print("  Pre-computed time and space indices do not match the "
+              "satellite dimension.")
+
+    print("  Computing time and space indices.")
+    # Now get indices, beginning with time. Use the time step recorded 
+    # by the GEOS-Chem reader if there is one.
+    if time_step is None:
+        time_step = model["TIME"].attrs.get("time_step")
+    time_idx = get_time_index(satellite["TIME"].values, 
+                              model["TIME"].values,
+                              time_matching, time_step)
+    if np.any(time_idx < 0):
+        raise ValueError('Some observations have no model time. Remove '
+                         'them with get_missing_times first.')
+    time_idx = xr.DataArray(time_idx, dims="N_OBS")
+
+    # Grid cell indices on a curvilinear grid
+    if model["LATITUDE"].ndim > 1:
+        if footprint:
+            raise ValueError("Footprint sampling needs a rectilinear model "
+                             "grid.")
+        index = SpatialIndex.load(model["LATITUDE"].values, 
+                                  model["LONGITUDE"].values, 
+                                  spatial_index_dir)
+        cell_idx = index.query(satellite["LATITUDE"].values, 
+                               satellite["LONGITUDE"].values)
+        idx = xr.Dataset({name : xr.DataArray(i, dims="N_OBS") 
+                          for name, i in zip(get_horizontal_dims(model), 
+                                             cell_idx)})
+        idx["time"] = time_idx
         if save_dir is not None:
-            idx.to_netcdf(f"{save_dir}_idx.nc")
+            idx.to_netcdf(idx_file)
+        return idx
+
+    # Longitude and latitude index
+    lon_idx = get_grid_index(model["LONGITUDE"].values, 
+                             satellite["LONGITUDE"].values,
+                             periodic=is_global_longitude(
+                                 model["LONGITUDE"].values))
+    lat_idx = get_grid_index(model["LATITUDE"].values, 
+                             satellite["LATITUDE"].values)
+    
+    idx = xr.Dataset({"lat" : lat_idx, "lon" : lon_idx, "time" : time_idx})
+    if footprint:
+        idx = get_footprint_indices(model, satellite, idx)
+    
+    # Save out
+    if save_dir is not None:
+        idx.to_netcdf(idx_file)
+
+    return idx
+
+
+def get_colocation_values(model, idx):
+    """
+    Gets the model time and horizontal coordinate values (the latitude and
+    longitude, or the position of the cell in the full grid on curvilinear
+    grids) for colocation indices from get_colocation_indices. Unlike the
+    indices, these do not depend on which part of the model grid was read.
+    The footprint observations and weights are included if there are any.
+    """
+    dims = {"time" : "TIME", **get_horizontal_dims(model)}
+    values = {name : model[dim].values[idx[name].values] 
+              for name, dim in dims.items()}
+    if "weight" in idx:
+        values["obs"] = idx["obs"].values
+        values["weight"] = idx["weight"].values
+    return values
 
-        # Subset the data
-        model = model.isel(TIME=idx['time'], 
-                        LONGITUDE=idx['lon'], LATITUDE=idx['lat'])
 
-    return model
+def get_colocation_indices_from_values(model, values):
+    """
+    Inverse of get_colocation_values. Returns the colocation indices into
+    model, or None if any of the values are not on the model grid (e.g., 
+    because that time step or grid cell was not read).
+    """
+    idx = {}
+    obs_dim = "N_PAIRS" if "weight" in values else "N_OBS"
+    for name, dim in {"time" : "TIME", **get_horizontal_dims(model)}.items():
+        model_values = model[dim].values
+        order = np.argsort(model_values, kind="stable")
+        i = np.searchsorted(model_values[order], values[name])
+        i = i.clip(0, len(model_values) - 1)
+        if np.any(model_values[order][i] != values[name]):
+            return None
+        idx[name] = xr.DataArray(order[i], dims=obs_dim)
+    attrs = {}
+    if "weight" in values:
+        for name in ["obs", "weight"]:
+            idx[name] = xr.DataArray(values[name], dims=obs_dim)
+        # Every observation has at least one pair
+        attrs["n_obs"] = int(values["obs"].max(initial=-1)) + 1
+    return xr.Dataset(idx, attrs=attrs)
+
+
+def _get_unit_vectors(lats, lons):
+    """
+    Converts latitudes and longitudes (degrees) to 3D unit vectors 
+    (... x 3).
+    """
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.stack([np.cos(lats) * np.cos(lons), 
+                     np.cos(lats) * np.sin(lons), 
+                     np.sin(lats)], axis=-1)
+
+
+# The spatial indices used by this process, keyed by the model grid 
+# fingerprint (see SpatialIndex.load)
+_spatial_indices = {}
+
+
+class SpatialIndex:
+    """
+    Finds the model grid cell closest to each observation on grids where 
+    LATITUDE and LONGITUDE are not 1D, such as the GCHP cubed-sphere grid 
+    (nf x Ydim x Xdim), so that the cells cannot be found by searching the
+    latitude and longitude edges separately (see get_grid_index).
+
+    The grid cell centers are converted to 3D unit vectors and stored in a
+    KD-tree, so each observation is matched to the cell with the closest 
+    center (by great circle distance) in O(log n_cells) and there is no 
+    special case for the poles, the dateline, or the cube edges. For the 
+    nearly square cells of the cubed sphere, this is the cell that contains
+    the observation except very close to the cell edges.
+
+    The tree only depends on the model grid, so it is built once per grid
+    and saved (see load). This needs scipy.
+    """
+
+    def __init__(self, model_lats, model_lons):
+        if cKDTree is None:
+            raise ImportError("scipy is required to colocate observations "
+                              "with curvilinear (e.g., cubed-sphere) model "
+                              "grids.")
+        self.shape = np.shape(model_lats)
+        self.tree = cKDTree(
+            _get_unit_vectors(model_lats, model_lons).reshape(-1, 3))
+
+    def __repr__(self):
+        return f"SpatialIndex({self.shape})"
+
+    def query(self, lats, lons):
+        """
+        Gets the index of the closest grid cell along each model grid 
+        dimension (e.g., face, y, and x on the cubed sphere) for each 
+        observation.
+        """
+        _, cell = self.tree.query(_get_unit_vectors(lats, lons), workers=-1)
+        return np.unravel_index(cell, self.shape)
+
+    @classmethod
+    def load(cls, model_lats, model_lons, index_dir=None):
+        """
+        Gets the spatial index of a model grid: from memory if it was
+        already used by this process, from index_dir if it was saved there,
+        and otherwise by building it (and saving it to index_dir). The 
+        saved index is keyed by a fingerprint of the grid.
+        """
+        fingerprint = get_fingerprint(np.asarray(model_lats), 
+                                      np.asarray(model_lons))
+        if fingerprint in _spatial_indices:
+            return _spatial_indices[fingerprint]
+
+        index_file = None
+        if index_dir is not None:
+            index_file = f"{index_dir}/spatial_index_{fingerprint}.pkl"
+        if index_file is not None and os.path.exists(index_file):
+            with open(index_file, "rb") as f:
+                index = pickle.load(f)
+        else:
+            print("  Building the spatial index of the model grid.")
+            index = cls(model_lats, model_lons)
+            if index_file is not None:
+                # Write to a temporary file first so that the file is never
+                # half-written
+                os.makedirs(index_dir, exist_ok=True)
+                with open(f"{index_file}.tmp", "wb") as f:
+                    pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{index_file}.tmp", index_file)
+
+        # Only keep the most recent grid in memory
+        _spatial_indices.clear()
+        _spatial_indices[fingerprint] = index
+        return index
+
 
 def get_closest_index(model_data, satellite_data, xarray=True, dims="N_OBS"):
     idx = np.abs(
@@ -145,3 +1321,315 @@ def get_closest_index(model_data, satellite_data, xarray=True, dims="N_OBS"):
     if xarray:
         idx = xr.DataArray(idx, dims=dims)
     return idx
+
+
+def get_grid_edges(model_centers):
+    """
+    Gets the edges between the cells of a monotonically increasing grid
+    (n_model - 1). Interior edges are halfway between the centers. The 
+    first and last edges are placed half of a typical grid spacing from the 
+    second and second to last centers, which accounts for the half-polar 
+    boxes used in the global GEOS-Chem grids (e.g., centers at -89 and -86 
+    and an edge at -88 for the 4x5 grid).
+    """
+    edges = 0.5 * (model_centers[:-1] + model_centers[1:])
+    if len(model_centers) > 2:
+        spacing = np.median(np.diff(model_centers))
+        edges[0] = model_centers[1] - 0.5 * spacing
+        edges[-1] = model_centers[-2] + 0.5 * spacing
+    return edges
+
+
+def is_global_longitude(model_centers):
+    """
+    Checks whether a longitude grid wraps around the globe.
+    """
+    if len(model_centers) < 2:
+        return False
+    spacing = np.median(np.diff(model_centers))
+    return bool(np.isclose(len(model_centers) * spacing, 360))
+
+
+def get_grid_index(model_data, satellite_data, periodic=False, 
+                   xarray=True, dims="N_OBS"):
+    """
+    Finds the model grid cell that contains each observation by searching
+    the grid edges, which costs O(n_obs log n_model) rather than the 
+    (n_model x n_obs) difference matrix used by get_closest_index. This 
+    works for the global GEOS-Chem grids (4x5, 2x2.5, 0.25x0.3125) and for
+    nested domains. Observations outside of a nested domain are assigned to
+    the closest boundary cell.
+
+    If periodic is True (i.e., a global longitude grid), observations are
+    wrapped around +/-180 so that, e.g., 178 is assigned to the -180 cell 
+    on the 4x5 grid.
+
+    Grids that are not monotonic fall back to get_closest_index.
+    """
+    model_data = np.asarray(model_data)
+    satellite_data = np.asarray(satellite_data)
+    n_model = len(model_data)
+
+    # Support both increasing and decreasing grids
+    diff = np.diff(model_data)
+    if np.all(diff > 0):
+        centers = model_data
+    elif np.all(diff < 0):
+        centers = model_data[::-1]
+    else:
+        return get_closest_index(model_data, satellite_data, xarray, dims)
+
+    edges = get_grid_edges(centers)
+    if periodic:
+        # Shift the observations into [first edge, first edge + 360)
+        first_edge = centers[0] - 0.5 * np.median(np.diff(centers))
+        satellite_data = (satellite_data - first_edge) % 360 + first_edge
+    idx = np.searchsorted(edges, satellite_data, side="left")
+    idx = idx.clip(0, n_model - 1)
+    if centers is not model_data:
+        idx = n_model - 1 - idx
+
+    if xarray:
+        idx = xr.DataArray(idx, dims=dims)
+    return idx
+
+
+def get_grid_bounds(model_centers, periodic=False):
+    """
+    Gets the bounds of the cells of a monotonically increasing grid 
+    (n_model + 1): the edges from get_grid_edges and the outer bounds of 
+    the first and last cells, which are as far from their centers as the 
+    first and last edges are. For a periodic (global longitude) grid, the 
+    last bound is 360 degrees after the first.
+    """
+    edges = get_grid_edges(model_centers)
+    if len(model_centers) < 2:
+        spacing = 1.0
+        return np.array([model_centers[0] - spacing/2, 
+                         model_centers[0] + spacing/2])
+    first = 2*model_centers[0] - edges[0]
+    last = 2*model_centers[-1] - edges[-1]
+    if periodic:
+        first = model_centers[0] - 0.5*np.median(np.diff(model_centers))
+        last = first + 360
+    return np.concatenate([[first], edges, [last]])
+
+
+def get_polygon_overlap_area(x, y, x_min, x_max, y_min, y_max):
+    """
+    Gets the area of the overlap between each polygon, with vertices x and 
+    y (n x n_vertices), and the rectangle [x_min, x_max] x [y_min, y_max] 
+    (n). The polygons are clipped to each side of the rectangle in turn 
+    (Sutherland-Hodgman), vectorized over the polygons, and the area of the 
+    clipped polygon is found with the shoelace formula.
+    """
+    points = np.stack([x, y], axis=-1).astype(np.float64)
+    n_vertices = np.full(len(points), points.shape[1])
+    for axis, bound, sign in [(0, x_min, 1), (0, x_max, -1), 
+                              (1, y_min, 1), (1, y_max, -1)]:
+        points, n_vertices = _clip_polygons(points, n_vertices, axis, 
+                                            np.asarray(bound), sign)
+
+    # Pad with the first vertex (padded edges have no area) and measure 
+    # from the first vertex to limit round-off
+    i = np.arange(points.shape[1])
+    points = np.where((i < n_vertices[:, None])[:, :, None], points, 
+                      points[:, :1])
+    points = points - points[:, :1]
+    x, y = points[:, :, 0], points[:, :, 1]
+    return 0.5*np.abs(np.sum(x*np.roll(y, -1, axis=1) 
+                             - np.roll(x, -1, axis=1)*y, axis=1))
+
+
+def _clip_polygons(points, n_vertices, axis, bound, sign):
+    """
+    Keeps the part of each polygon (points, n x max_vertices x 2, with the
+    first n_vertices valid) where sign*(coordinate - bound) >= 0. Each 
+    vertex is kept if it is inside, followed by the crossing point if the 
+    edge to the next vertex crosses the bound.
+    """
+    n, max_vertices, _ = points.shape
+    i = np.arange(max_vertices)
+    valid = i < n_vertices[:, None]
+    next_i = np.where(i + 1 < n_vertices[:, None], i + 1, 0)
+    following = np.take_along_axis(points, next_i[:, :, None], axis=1)
+    distance = sign*(points[:, :, axis] - bound[:, None])
+    next_distance = sign*(following[:, :, axis] - bound[:, None])
+    inside = distance >= 0
+    crosses = valid & (inside != (next_distance >= 0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(crosses, distance / (distance - next_distance), 0)
+    crossing = points + t[:, :, None]*(following - points)
+
+    # Move the kept vertices to the front of each row, in order
+    clipped = np.stack([points, crossing], axis=2).reshape(n, -1, 2)
+    keep = np.stack([valid & inside, crosses], axis=2).reshape(n, -1)
+    position = np.cumsum(keep, axis=1) - 1
+    n_vertices = position[:, -1] + 1
+    rows, columns = np.nonzero(keep)
+    points = np.zeros((n, max(n_vertices.max(initial=0), 1), 2))
+    points[rows, position[rows, columns]] = clipped[rows, columns]
+    return points, n_vertices
+
+
+def _get_candidate_cells(model_lats, model_lons, lat_bounds, lon_bounds):
+    """
+    Finds the box of model grid cells that may overlap each footprint from
+    the cell bounds (see get_footprint_weights). Returns the bounds of the
+    (sorted) grid cells, the corners of the footprints with longitudes 
+    shifted to match those bounds, the first cell and number of cells in 
+    latitude and longitude for each footprint, and whether each footprint
+    is entirely inside one cell.
+    """
+    model_lats = np.asarray(model_lats)
+    model_lons = np.asarray(model_lons)
+    for name, centers in [("latitude", model_lats), 
+                          ("longitude", model_lons)]:
+        diff = np.diff(centers)
+        if not (np.all(diff > 0) or np.all(diff < 0)):
+            raise ValueError(f"Footprint sampling requires a monotonic "
+                             f"model {name} grid.")
+    periodic = is_global_longitude(model_lons)
+    lat_edges = get_grid_bounds(np.sort(model_lats)).clip(-90, 90)
+    lon_edges = get_grid_bounds(np.sort(model_lons), periodic)
+
+    # Unwrap the corners around the first corner so that footprints that
+    # cross the date line are not stretched around the globe. On a global
+    # grid, the footprints are then shifted to start in the first period of
+    # the grid and the cell bounds are repeated for a second period.
+    lat_bounds = np.asarray(lat_bounds, dtype=np.float64)
+    lon_bounds = np.asarray(lon_bounds, dtype=np.float64)
+    lon_bounds = (lon_bounds[:, :1] 
+                  + (lon_bounds - lon_bounds[:, :1] + 180) % 360 - 180)
+    if periodic:
+        shift = 360*np.floor((lon_bounds.min(axis=1) - lon_edges[0]) / 360)
+        lon_bounds = lon_bounds - shift[:, None]
+        lon_edges = np.concatenate([lon_edges, lon_edges[1:] + 360])
+
+    cells = []
+    inside = np.ones(len(lat_bounds), dtype=bool)
+    for edges, bounds in [(lat_edges, lat_bounds), (lon_edges, lon_bounds)]:
+        n_cells = len(edges) - 1
+        low, high = bounds.min(axis=1), bounds.max(axis=1)
+        first = (np.searchsorted(edges, low, side="right") 
+                 - 1).clip(0, n_cells - 1)
+        last = (np.searchsorted(edges, high, side="left") 
+                - 1).clip(0, n_cells - 1)
+        cells += [first, np.maximum(last - first + 1, 1)]
+        inside &= (low >= edges[first]) & (high <= edges[first + 1])
+    return lat_edges, lon_edges, lat_bounds, lon_bounds, cells, inside
+
+
+def get_footprint_cells(model_lats, model_lons, lat_bounds, lon_bounds):
+    """
+    Gets the number of model grid cells that each footprint may overlap 
+    (the candidates in get_footprint_weights), which is an upper bound on 
+    the number of cells that it does overlap.
+    """
+    if np.ndim(model_lats) > 1:
+        raise ValueError("Footprint sampling needs a rectilinear model grid.")
+    if len(lat_bounds) == 0:
+        return np.ones(0, dtype=int)
+    _, _, _, _, (_, n_lat, _, n_lon), _ = _get_candidate_cells(
+        model_lats, model_lons, lat_bounds, lon_bounds)
+    return n_lat*n_lon
+
+
+def get_footprint_weights(model_lats, model_lons, lat_bounds, lon_bounds,
+                          block_size=2**17):
+    """
+    Gets the fraction of each satellite footprint (the polygons with corners
+    lat_bounds and lon_bounds, n_obs x n_corners) in each model grid cell, 
+    as a sparse matrix in coordinate form: the observation, the latitude 
+    and longitude index of the model grid cell, and the weight of each 
+    overlapping pair, sorted by observation. The weights of each 
+    observation sum to 1. Observations whose footprint is entirely outside 
+    of the model grid have no pairs.
+
+    The candidate cells of each footprint are found from the cell bounds 
+    (the box of cells around the footprint's latitude and longitude range),
+    so there are only a few candidates per observation when the footprints
+    are about the size of the model grid cells or smaller. Footprints that
+    are inside one cell get a weight of 1, and the overlap area of the 
+    other candidates is computed exactly, block_size pairs at a time (see 
+    get_polygon_overlap_area). Areas are computed with the sine of the 
+    latitude (an equal-area projection), so that the area of a degree of 
+    longitude shrinks with cos(latitude) as it does on the sphere. This is 
+    exact for the parts of a footprint between lines of constant latitude
+    and longitude and a close approximation along its other edges.
+    """
+    lat_edges, lon_edges, lat_bounds, lon_bounds, cells, inside = (
+        _get_candidate_cells(model_lats, model_lons, lat_bounds, lon_bounds))
+    first_lat, n_lat, first_lon, n_lon = cells
+
+    # One pair per observation and candidate cell
+    n_candidates = n_lat*n_lon
+    obs = np.repeat(np.arange(len(n_candidates)), n_candidates)
+    k = np.arange(len(obs)) - np.repeat(np.cumsum(n_candidates) 
+                                        - n_candidates, n_candidates)
+    lat_idx = first_lat[obs] + k // n_lon[obs]
+    lon_idx = first_lon[obs] + k % n_lon[obs]
+
+    area = inside[obs].astype(np.float64)
+    clip = np.flatnonzero(~inside[obs])
+    sin_lat_bounds = np.sin(np.radians(lat_bounds.clip(-90, 90)))
+    sin_lat_edges = np.sin(np.radians(lat_edges))
+    for start in range(0, len(clip), block_size):
+        block = clip[start:start + block_size]
+        o = obs[block]
+        area[block] = get_polygon_overlap_area(
+            lon_bounds[o], sin_lat_bounds[o], 
+            lon_edges[lon_idx[block]], lon_edges[lon_idx[block] + 1],
+            sin_lat_edges[lat_idx[block]], sin_lat_edges[lat_idx[block] + 1])
+
+    # Normalize by the area of each footprint inside the model grid
+    total = np.bincount(obs, weights=area, minlength=len(n_candidates))
+    overlap = area > 0
+    obs, lat_idx, lon_idx = obs[overlap], lat_idx[overlap], lon_idx[overlap]
+    weight = area[overlap] / total[obs]
+
+    # Go back to the model grid's own order (and longitudes in one period)
+    n_model_lons = len(model_lons)
+    lon_idx = lon_idx % n_model_lons
+    if model_lats[0] > model_lats[-1]:
+        lat_idx = len(model_lats) - 1 - lat_idx
+    if model_lons[0] > model_lons[-1]:
+        lon_idx = n_model_lons - 1 - lon_idx
+    return obs, lat_idx, lon_idx, weight
+
+
+def get_footprint_indices(model, satellite, idx):
+    """
+    Gets the colocation indices for footprint sampling from the indices of
+    the nearest cells, idx, from get_colocation_indices. Like the sparse 
+    interpolation map, the footprint weights (see get_footprint_weights) 
+    are kept in coordinate form, with one entry per pair of an observation
+    and a model grid cell that its footprint overlaps: obs, time, lat, lon,
+    and weight all have dimension N_PAIRS and are sorted by observation. 
+    Observations that are outside of the model grid keep their nearest 
+    cell with a weight of 1, so every observation has at least one pair. 
+    The number of observations is kept in the n_obs attribute.
+    """
+    n_obs = satellite.sizes["N_OBS"]
+    for v in ["LATITUDE_BOUNDS", "LONGITUDE_BOUNDS"]:
+        if v not in satellite:
+            raise ValueError(f"Footprint sampling requires {v} in the "
+                             f"satellite DATA_FIELDS.")
+    obs, lat_idx, lon_idx, weight = get_footprint_weights(
+        model["LATITUDE"].values, model["LONGITUDE"].values,
+        satellite["LATITUDE_BOUNDS"].transpose("N_OBS", ...).values,
+        satellite["LONGITUDE_BOUNDS"].transpose("N_OBS", ...).values)
+
+    # Observations outside of the model grid keep their nearest cell
+    outside = np.flatnonzero(np.bincount(obs, minlength=n_obs) == 0)
+    obs = np.concatenate([obs, outside])
+    order = np.argsort(obs, kind="stable")
+    pairs = {
+        "obs" : obs[order],
+        "time" : idx["time"].values[obs[order]],
+        "lat" : np.concatenate([lat_idx, idx["lat"].values[outside]])[order],
+        "lon" : np.concatenate([lon_idx, idx["lon"].values[outside]])[order],
+        "weight" : np.concatenate([weight, np.ones(len(outside))])[order]}
+    return xr.Dataset({name : ("N_PAIRS", values) 
+                       for name, values in pairs.items()},
+                      attrs={"n_obs" : n_obs})